@@ -0,0 +1,184 @@
+# coding: utf-8
+"""
+Measures send_to_server.Delivery.run and send_to_scielo.Delivery.run against
+local SFTP and FTP servers (see servers.py) on a synthetic site (see
+sites.py), with an optional simulated round trip time.
+
+Each scenario is run repeat times to a new destiny directory and the best
+time is printed. --history appends the results as JSON lines, with the git
+revision, so changes to paperboy.communicator can be tracked over time.
+
+python benchmarks/bench_delivery.py --server_type sftp ftp --latency 50 --issues 10 --workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from paperboy import send_to_scielo, send_to_server
+
+from servers import LatencyProxy, LocalFTPServer, LocalSFTPServer
+from sites import make_site
+
+USER = u'scielo'
+PASSWORD = u'scielo'
+
+
+def revision():
+
+    try:
+        return subprocess.check_output(
+            [u'git', u'rev-parse', u'--short', u'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def to_server(args, source, destiny, server_type, port):
+
+    delivery = send_to_server.Delivery(
+        None, u'', source + u'/serial/scilista.lst', source, destiny, False,
+        u'127.0.0.1', server_type, port, USER, PASSWORD,
+        workers=args.workers,
+        issue_jobs=args.issue_jobs,
+        tar_stream=args.tar_stream,
+        compression=args.compression
+    )
+    delivery.run()
+
+    return delivery.summary.sent_files, delivery.summary.sent_bytes
+
+
+def to_scielo(args, source, destiny, server_type, port):
+
+    delivery = send_to_scielo.Delivery(
+        u'isos' if args.cisis_dir else u'reports', args.cisis_dir, source,
+        destiny, u'127.0.0.1', server_type, port, USER, PASSWORD, False,
+        jobs=args.workers,
+        stream=bool(args.cisis_dir),
+        compression=args.compression
+    )
+    delivery.run()
+
+    return None, delivery.sent_bytes + delivery.client.sent_bytes
+
+
+def measure(args, name, function, source, server_type, port):
+
+    best = None
+
+    for attempt in range(args.repeat):
+        destiny = tempfile.mkdtemp(prefix=u'paperboy-bench-destiny')
+
+        try:
+            start = time.time()
+            files, size = function(args, source, destiny, server_type, port)
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(destiny, ignore_errors=True)
+
+        if best is None or elapsed < best[0]:
+            best = (elapsed, files, size)
+
+    elapsed, files, size = best
+    print(u'%-10s %-5s %8.2fs %8.2f MB/s %8s files/s' % (
+        name,
+        server_type,
+        elapsed,
+        size / 1048576.0 / elapsed,
+        u'%.1f' % (files / elapsed) if files is not None else u'-'
+    ))
+
+    return {
+        u'scenario': name,
+        u'server_type': server_type,
+        u'seconds': round(elapsed, 3),
+        u'files': files,
+        u'bytes': size
+    }
+
+
+def run_scenarios(args, source, server_type, port):
+
+    results = []
+
+    if args.latency:
+        with LatencyProxy(port, args.latency / 1000.0) as proxy:
+            port = proxy.port
+            for name, function in ((u'server', to_server), (u'scielo', to_scielo)):
+                results.append(measure(args, name, function, source, server_type, port))
+    else:
+        for name, function in ((u'server', to_server), (u'scielo', to_scielo)):
+            results.append(measure(args, name, function, source, server_type, port))
+
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=u'Benchmark of the deliveries against local SFTP and FTP servers')
+    parser.add_argument(u'--server_type', nargs=u'+', choices=[u'sftp', u'ftp'], default=[u'sftp', u'ftp'])
+    parser.add_argument(u'--latency', type=float, default=0, help=u'simulated round trip time in milliseconds')
+    parser.add_argument(u'--journals', type=int, default=2)
+    parser.add_argument(u'--issues', type=int, default=5, help=u'issues per journal')
+    parser.add_argument(u'--pdfs', type=int, default=20, help=u'pdfs per issue')
+    parser.add_argument(u'--images', type=int, default=40, help=u'images per issue')
+    parser.add_argument(u'--pdf_size', type=int, default=300000)
+    parser.add_argument(u'--image_size', type=int, default=20000)
+    parser.add_argument(u'--workers', type=int, default=1)
+    parser.add_argument(u'--issue_jobs', type=int, default=1)
+    parser.add_argument(u'--tar_stream', action=u'store_true')
+    parser.add_argument(u'--compression', choices=[u'on', u'off', u'auto'], default=u'off')
+    parser.add_argument(u'--no_exec', action=u'store_true', help=u'SSH server refusing remote commands')
+    parser.add_argument(u'--cisis_dir', default=u'', help=u'send the ISO files made by mx instead of the reports')
+    parser.add_argument(u'--repeat', type=int, default=3)
+    parser.add_argument(u'--history', default=None, help=u'file receiving the results as JSON lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # conexoes encerradas pelo cliente sao registradas como erro pelo servidor
+    logging.getLogger(u'paramiko').setLevel(logging.CRITICAL)
+
+    source = tempfile.mkdtemp(prefix=u'paperboy-bench-site')
+
+    try:
+        files, size = make_site(
+            source, args.journals, args.issues, args.pdfs, args.images,
+            pdf_size=args.pdf_size, image_size=args.image_size)
+        print(u'site: %d issues, %d files, %.1f MB, latency %.0f ms' % (
+            args.journals * args.issues, files, size / 1048576.0, args.latency))
+
+        results = []
+
+        for server_type in args.server_type:
+            if server_type == u'sftp':
+                server = LocalSFTPServer(allow_exec=not args.no_exec)
+            else:
+                server = LocalFTPServer(USER, PASSWORD)
+
+            with server:
+                results.extend(run_scenarios(args, source, server_type, server.port))
+    finally:
+        shutil.rmtree(source)
+
+    if args.history:
+        options = dict(
+            (name, value) for name, value in vars(args).items()
+            if name not in (u'history', u'server_type', u'repeat'))
+        with open(args.history, 'a') as fl:
+            for result in results:
+                result.update(
+                    timestamp=time.time(), revision=revision(),
+                    python=sys.version.split()[0], options=options)
+                fl.write(json.dumps(result, sort_keys=True) + u'\n')
+
+
+if __name__ == '__main__':
+    main()
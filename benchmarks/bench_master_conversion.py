@@ -0,0 +1,92 @@
+# coding: utf-8
+"""
+Compares the in process database converter (paperboy.isis.convert_master)
+with crunchmf on a synthetic master file shaped like the
+serial/<acron>/<issue>/base databases.
+
+python benchmarks/bench_master_conversion.py --records 200000 --cisis_dir /var/www/scielo/proc/cisis
+"""
+import argparse
+import binascii
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from paperboy.isis import Record, MasterFile, write_master, convert_master
+
+
+def synthetic_records(records, seed=0):
+
+    rnd = random.Random(seed)
+
+    for mfn in range(1, records + 1):
+        fields = [(706, b'h'), (35, b'0034-8910'), (65, b'20160300')]
+        for tag in (10, 12, 14, 30, 83):
+            for occ in range(rnd.randint(1, 6)):
+                fields.append(
+                    (tag, b'^a' + binascii.hexlify(os.urandom(rnd.randint(5, 200)))))
+        yield Record(mfn, fields, deleted=rnd.random() < 0.01)
+
+
+def make_master(path, records, layout):
+
+    with open(path + '.mst', 'wb') as mst:
+        with open(path + '.xrf', 'wb') as xrf:
+            write_master(synthetic_records(records), mst, xrf, layout)
+
+
+def timed(label, function, *args):
+
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print(u'%-10s %8.2fs' % (label, elapsed))
+
+    return result, elapsed
+
+
+def crunchmf(cisis_dir, mst_input, mst_output):
+
+    command = os.path.join(cisis_dir, 'crunchmf') if cisis_dir else 'crunchmf'
+
+    return subprocess.call([command, mst_input, mst_output])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=u'Benchmark of the native database converter against crunchmf')
+    parser.add_argument(u'--records', type=int, default=100000)
+    parser.add_argument(u'--layout', choices=[u'packed', u'aligned'], default=u'packed')
+    parser.add_argument(u'--cisis_dir', default=u'')
+    parser.add_argument(u'--skip_crunchmf', action=u'store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix=u'paperboy-bench')
+
+    try:
+        source = os.path.join(workdir, u'base')
+        make_master(source, args.records, args.layout)
+        print(u'master: %d records, %.1f MB' % (
+            args.records, os.path.getsize(source + u'.mst') / 1048576.0))
+
+        timed(u'native', convert_master, source, os.path.join(workdir, u'native'))
+
+        with MasterFile(os.path.join(workdir, u'native')) as master:
+            print(u'native output: %s %s, %d records' % (
+                master.layout, master.byteorder, sum(1 for i in master.records(deleted=True))))
+
+        if not args.skip_crunchmf:
+            try:
+                timed(u'crunchmf', crunchmf, args.cisis_dir, source, os.path.join(workdir, u'crunchmf'))
+            except OSError:
+                print(u'crunchmf not available, use --cisis_dir')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# coding: utf-8
+"""
+Compares sending a directory of small files one by one through SFTP with
+sending it as a single tar stream extracted by the server
+(paperboy.communicator.SFTP.tar_put), on synthetic directories shaped like
+htdocs/img/revistas/<acron>/<issue>.
+
+The server must accept SSH logins with shell access. Files are written under
+destiny_dir/per_file and destiny_dir/tar_stream.
+
+python benchmarks/bench_tar_stream.py --server localhost --user scielo --password scielo --destiny_dir /tmp/bench --files 2000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from paperboy.communicator import SFTP
+
+
+def make_directory(path, files, min_size, max_size, seed=0):
+
+    rnd = random.Random(seed)
+    names = []
+
+    for i in range(files):
+        subdir = u'img%d' % (i % 10)
+        name = u'%s/fig%05d.gif' % (subdir, i)
+        if not os.path.isdir(os.path.join(path, subdir)):
+            os.makedirs(os.path.join(path, subdir))
+        with open(os.path.join(path, name), 'wb') as fl:
+            fl.write(os.urandom(rnd.randint(min_size, max_size)))
+        names.append(name)
+
+    return names
+
+
+def timed(label, function, *args):
+
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print(u'%-10s %8.2fs' % (label, elapsed))
+
+    return result, elapsed
+
+
+def per_file(client, source, names, remote_dir):
+
+    client.mkdir(remote_dir)
+
+    for name in names:
+        subdir = name.rsplit(u'/', 1)[0]
+        client.mkdir(remote_dir + u'/' + subdir)
+        client.put(os.path.join(source, name), remote_dir + u'/' + name)
+
+
+def tar_stream(client, source, names, remote_dir):
+
+    return client.tar_put(
+        [(os.path.join(source, name), name) for name in names], remote_dir)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=u'Benchmark of the tar stream upload against one SFTP put per file')
+    parser.add_argument(u'--server', default=u'localhost')
+    parser.add_argument(u'--port', type=int, default=22)
+    parser.add_argument(u'--user', required=True)
+    parser.add_argument(u'--password', required=True)
+    parser.add_argument(u'--destiny_dir', required=True)
+    parser.add_argument(u'--files', type=int, default=1000)
+    parser.add_argument(u'--min_size', type=int, default=512)
+    parser.add_argument(u'--max_size', type=int, default=20480)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix=u'paperboy-bench')
+
+    try:
+        names = make_directory(workdir, args.files, args.min_size, args.max_size)
+        size = sum(os.path.getsize(os.path.join(workdir, name)) for name in names)
+        print(u'directory: %d files, %.1f MB' % (len(names), size / 1048576.0))
+
+        client = SFTP(args.server, args.port, args.user, args.password)
+
+        try:
+            client.mkdir(args.destiny_dir)
+            timed(u'per file', per_file, client, workdir, names,
+                  args.destiny_dir + u'/per_file')
+            status, elapsed = timed(u'tar', tar_stream, client, workdir, names,
+                                    args.destiny_dir + u'/tar_stream')
+            if not status:
+                print(u'tar stream not available on this server')
+        finally:
+            client.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+# coding: utf-8
+"""
+In process SFTP and FTP servers listening on the loopback, used by the
+benchmarks as stand-ins for the SciELO servers.
+
+The servers work on the local file system without chroot, remote paths are
+local paths. Network latency is simulated by LatencyProxy, which delays the
+bytes relayed in each direction without limiting the requests in flight, so
+pipelined SFTP writes behave as on a real long distance link.
+
+Only for benchmarks: any password is accepted and the SSH server runs the
+commands it receives (tar, rm -rf, mkdir -p) when allow_exec is set.
+"""
+import collections
+import errno
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+logger = logging.getLogger(__name__)
+
+_host_key = None
+
+
+def _server_key():
+
+    global _host_key
+
+    if _host_key is None:
+        _host_key = paramiko.RSAKey.generate(2048)
+
+    return _host_key
+
+
+def _listen():
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(100)
+
+    return sock
+
+
+def _daemon(target, *args):
+
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+class _Handle(SFTPHandle):
+
+    def stat(self):
+
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+
+        return paramiko.SFTP_OK
+
+
+class _SFTPInterface(SFTPServerInterface):
+    """
+    SFTP requests served from the local file system.
+    """
+
+    def _attributes(self, path, function=os.stat):
+
+        try:
+            return SFTPAttributes.from_stat(function(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def _call(self, function, *args):
+
+        try:
+            function(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+        result = []
+
+        for name in names:
+            attributes = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+            attributes.filename = name
+            result.append(attributes)
+
+        return result
+
+    def stat(self, path):
+
+        return self._attributes(path)
+
+    def lstat(self, path):
+
+        return self._attributes(path, os.lstat)
+
+    def open(self, path, flags, attr):
+
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        fl = os.fdopen(fd, mode)
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = fl
+        handle.writefile = fl
+
+        return handle
+
+    def remove(self, path):
+
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+
+        if os.path.exists(newpath):
+            return paramiko.SFTP_FAILURE
+
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+
+        return self._call(os.rename, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+
+        return paramiko.SFTP_OK
+
+
+class _SSHInterface(paramiko.ServerInterface):
+
+    def __init__(self, allow_exec):
+        self.allow_exec = allow_exec
+
+    def get_allowed_auths(self, username):
+
+        return 'password'
+
+    def check_auth_password(self, username, password):
+
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_REFUSED
+
+    def check_channel_exec_request(self, channel, command):
+
+        if not self.allow_exec:
+            return False
+
+        _daemon(self._exec, channel, command)
+
+        return True
+
+    def _exec(self, channel, command):
+
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+
+        def feed():
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                process.stdin.write(data)
+            process.stdin.close()
+
+        feeder = _daemon(feed)
+
+        for data in iter(lambda: process.stdout.read(32768), b''):
+            channel.sendall(data)
+
+        feeder.join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class LocalSFTPServer(object):
+    """
+    SSH server with the SFTP subsystem.
+
+    with LocalSFTPServer() as server:
+        SFTP(u'127.0.0.1', server.port, u'user', u'password')
+    """
+
+    def __init__(self, allow_exec=True):
+        self.allow_exec = allow_exec
+        self.port = None
+        self._sock = None
+        self._transports = []
+
+    def __enter__(self):
+
+        _server_key()
+        self._sock = _listen()
+        self.port = self._sock.getsockname()[1]
+        _daemon(self._accept)
+
+        return self
+
+    def _accept(self):
+
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except (OSError, socket.error):
+                return
+
+            # como o OpenSSH, sem o atraso do algoritmo de Nagle
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_server_key())
+            transport.set_subsystem_handler('sftp', SFTPServer, _SFTPInterface)
+            transport.start_server(server=_SSHInterface(self.allow_exec))
+            self._transports.append(transport)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._sock.close()
+
+        for transport in self._transports:
+            transport.close()
+
+        return False
+
+
+class LocalFTPServer(object):
+    """
+    pyftpdlib FTP server, one thread per connection. Data connections use
+    passive mode.
+    """
+
+    def __init__(self, user=u'scielo', password=u'scielo'):
+        self.user = user
+        self.password = password
+        self.port = None
+        self._server = None
+
+    def __enter__(self):
+
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(self.user, self.password, u'/', perm=u'elradfmwMT')
+
+        handler = type('Handler', (FTPHandler,), {})
+        handler.authorizer = authorizer
+        handler.use_sendfile = False
+
+        self._server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self._server.max_cons = 256
+        self.port = self._server.address[1]
+        _daemon(self._server.serve_forever)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._server.close_all()
+
+        return False
+
+
+class LatencyProxy(object):
+    """
+    TCP relay adding latency seconds of round trip time to the connections
+    to the target port, half of it in each direction.
+
+    For FTP only the control connection is delayed, which accounts for the
+    round trips of the commands.
+    """
+
+    def __init__(self, target_port, latency):
+        self.target_port = target_port
+        self.latency = latency
+        self.port = None
+        self._sock = None
+
+    def __enter__(self):
+
+        self._sock = _listen()
+        self.port = self._sock.getsockname()[1]
+        _daemon(self._accept)
+
+        return self
+
+    def _accept(self):
+
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except (OSError, socket.error):
+                return
+
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+
+            for sock in (conn, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._relay(conn, upstream)
+            self._relay(upstream, conn)
+
+    def _relay(self, source, destiny):
+
+        queue = collections.deque()
+        ready = threading.Condition()
+        delay = self.latency / 2.0
+
+        def receive():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except (OSError, socket.error):
+                    data = b''
+                with ready:
+                    queue.append((time.time() + delay, data))
+                    ready.notify()
+                if not data:
+                    return
+
+        def send():
+            while True:
+                with ready:
+                    while not queue:
+                        ready.wait()
+                    deliver_at, data = queue.popleft()
+                wait = deliver_at - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    if not data:
+                        destiny.shutdown(socket.SHUT_WR)
+                        return
+                    destiny.sendall(data)
+                except (OSError, socket.error) as e:
+                    if e.errno not in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.EBADF):
+                        logger.debug(u'Fail while relaying data: %s', e)
+                    return
+
+        _daemon(receive)
+        _daemon(send)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._sock.close()
+
+        return False
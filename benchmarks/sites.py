@@ -0,0 +1,123 @@
+# coding: utf-8
+"""
+Synthetic SciELO site trees for the benchmarks, shaped as the source_dir of
+send_to_server and send_to_scielo:
+
+    serial/scilista.lst
+    serial/<acron>/<issue>/base/<acron>.mst|xrf
+    serial/issue/issue.mst|xrf, serial/title/title.mst|xrf
+    bases/pdf|translation|xml/<acron>/<issue>/...
+    htdocs/img/revistas/<acron>/<issue>/...
+    bases/issue/issue.mst|xrf (sections of static_section_catalog.txt)
+"""
+import os
+import random
+
+from paperboy.isis import Record, write_master
+
+
+def _write(path, size, rnd):
+
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, 'wb') as fl:
+        # conteudo pouco compressivel, como pdfs e imagens
+        fl.write(bytes(bytearray(rnd.getrandbits(8) for i in range(min(size, 4096)))) * (size // 4096 + 1))
+        fl.truncate(size)
+
+    return size
+
+
+def _master(path, records):
+
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path + u'.mst', 'wb') as mst:
+        with open(path + u'.xrf', 'wb') as xrf:
+            write_master(records, mst, xrf)
+
+    return os.path.getsize(path + u'.mst') + os.path.getsize(path + u'.xrf')
+
+
+def _issue_records(issues):
+
+    for mfn, (acron, label) in enumerate(issues, 1):
+        yield Record(mfn, [
+            (35, b'0034-8910'),
+            (65, b'20160300'),
+            (36, b'2016' + str(mfn % 1000).zfill(3).encode('ascii')),
+            (49, b'^lpt^cRSP' + str(mfn).encode('ascii') + b'^tArtigos'),
+            (49, b'^len^cRSP' + str(mfn).encode('ascii') + b'^tArticles'),
+        ])
+
+
+def make_site(root, journals=2, issues=5, pdfs=20, images=40, translations=5,
+              xmls=10, pdf_size=300000, image_size=20000, text_size=40000,
+              deleted=0, seed=0):
+    """
+    Writes a site with journals * issues scilista issues under root and
+    returns (files, bytes) of the content sent by send_to_server. deleted
+    adds del lines to the scilista.
+    """
+
+    rnd = random.Random(seed)
+    issue_list = []
+    files = 0
+    size = 0
+
+    for j in range(journals):
+        acron = u'jrn%d' % j
+        for i in range(issues):
+            issue_list.append((acron, u'v%dn%d' % (i // 4 + 1, i % 4 + 1)))
+
+    entries = []
+
+    for acron, label in issue_list:
+        for n in range(pdfs):
+            entries.append((
+                os.path.join(root, u'bases/pdf', acron, label, u'a%02d.pdf' % n),
+                rnd.randint(pdf_size // 2, pdf_size * 3 // 2)))
+        for n in range(images):
+            entries.append((
+                os.path.join(root, u'htdocs/img/revistas', acron, label, u'a%02d' % (n % 10), u'i%03d.jpg' % n),
+                rnd.randint(image_size // 2, image_size * 3 // 2)))
+        for n in range(translations):
+            entries.append((
+                os.path.join(root, u'bases/translation', acron, label, u'en_a%02d.htm' % n),
+                rnd.randint(text_size // 2, text_size * 3 // 2)))
+        for n in range(xmls):
+            entries.append((
+                os.path.join(root, u'bases/xml', acron, label, u'a%02d.xml' % n),
+                rnd.randint(text_size // 2, text_size * 3 // 2)))
+
+    for path, length in entries:
+        size += _write(path, length, rnd)
+        files += 1
+
+    for acron, label in issue_list:
+        size += _master(
+            os.path.join(root, u'serial', acron, label, u'base', acron),
+            _issue_records([(acron, label)]))
+        files += 2
+
+    for database in (u'issue', u'title'):
+        size += _master(
+            os.path.join(root, u'serial', database, database),
+            _issue_records(issue_list))
+        files += 2
+
+    _master(os.path.join(root, u'bases/issue/issue'), _issue_records(issue_list))
+
+    with open(os.path.join(root, u'serial/scilista.lst'), 'w') as fl:
+        for acron, label in issue_list:
+            fl.write(u'%s %s\n' % (acron, label))
+        for n in range(deleted):
+            fl.write(u'%s v99n%d del\n' % (issue_list[0][0], n + 1))
+
+    return files, size
@@ -0,0 +1,689 @@
+# coding: utf-8
+"""
+asyncio transfer backend, available on Python 3.7 or newer.
+
+AsyncSFTP (asyncssh) keeps hundreds of requests in flight over a single SSH
+connection, AsyncFTP (aioftp) spreads them over a small set of connections,
+as FTP runs one transfer per connection. AsyncDelivery runs a
+send_to_server.Delivery through them, bounding the transfers in flight with a
+semaphore instead of a thread per connection.
+
+Both libraries are optional dependencies, only needed by the backend using
+them.
+"""
+import asyncio
+import errno
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+try:
+    import aioftp
+except ImportError:
+    aioftp = None
+
+from paperboy.communicator import SFTP, RetryPolicy, _ftp_timestamp
+from paperboy.manifest import file_md5
+from paperboy.send_to_server import (
+    CONTENT_PATHS, DATABASE_EXTENSIONS, conversion_context, native_conversion,
+    native_master_conversor
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCommunicator(object):
+    """
+    Coroutine version of communicator.Communicator. Operations get a session
+    through _acquire and give it back through _release, a failing operation
+    is replayed following retry_policy on a new session.
+    """
+
+    retry_policy = RetryPolicy()
+    # Options of communicator.client_options, ignored by the protocols not
+    # supporting them. Uploads are not resumable, main rejects
+    # --resume_threshold with this backend.
+    compression = u'off'
+    window_size = None
+    max_packet_size = None
+    put_confirm = True
+    # Errors meaning the session is lost, always worth a new try.
+    connection_errors = (OSError, EOFError, asyncio.TimeoutError)
+
+    def __init__(self, host, port, user, password):
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        # Remote directories created or found during this session, each one
+        # is resolved once even when requested by concurrent transfers.
+        self.known_dirs = {}
+        self.avoided_roundtrips = 0
+        self.retries = 0
+        self.sent_bytes = 0
+
+    async def _acquire(self):
+        raise NotImplementedError
+
+    def _release(self, client, broken=False):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def _interrupted(self, error):
+
+        return isinstance(error, self.connection_errors) or self.retry_policy.retryable(error)
+
+    async def _retry(self, description, function, *args):
+        """
+        Runs function(client, *args) with a session of the pool following the
+        retry_policy.
+        """
+
+        policy = self.retry_policy
+        attempt = 1
+
+        while True:
+            client = await self._acquire()
+
+            try:
+                result = await function(client, *args)
+            except Exception as e:
+                broken = self._interrupted(e)
+                self._release(client, broken)
+
+                if attempt >= policy.attempts or not broken:
+                    raise
+
+                delay = policy.delay(attempt)
+                attempt += 1
+                self.retries += 1
+
+                logger.warning(
+                    u'Fail while %s, retrying in %.1f seconds (attempt %d of %d): %s',
+                    description,
+                    delay,
+                    attempt,
+                    policy.attempts,
+                    e
+                )
+
+                await asyncio.sleep(delay)
+                continue
+
+            self._release(client)
+
+            return result
+
+    async def mkdir(self, path):
+        """
+        Creates the remote directory, at most once per session.
+        """
+
+        if path in self.known_dirs:
+            roundtrips = await self.known_dirs[path]
+            self.avoided_roundtrips += roundtrips or 0
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self.known_dirs[path] = future
+
+        try:
+            roundtrips = await self._retry(
+                u'creating directory (%s)' % path, self._mkdir, path)
+        except Exception as e:
+            logger.error(u'Fail while creating directory (%s): %s', path, e)
+            del self.known_dirs[path]
+            future.set_result(None)
+            raise
+
+        future.set_result(roundtrips)
+
+    async def put(self, from_fl, to_fl):
+
+        logger.info(u'Copying file from (%s) to (%s)', from_fl, to_fl)
+
+        await self._retry(u'copying file (%s)' % to_fl, self._put, from_fl, to_fl)
+        self.sent_bytes += os.path.getsize(from_fl)
+
+        logger.debug(u'File has being copied (%s)', to_fl)
+
+    async def stat(self, path):
+        """
+        Returns a tuple (size, mtime) for the remote file, or None when it
+        does not exist.
+        """
+
+        return await self._retry(u'checking file (%s)' % path, self._stat, path)
+
+
+class AsyncSFTP(AsyncCommunicator):
+    """
+    All operations share one SSH connection and one SFTP channel. A single
+    session serves the whole run, so compression auto is taken as off.
+    """
+
+    def __init__(self, host, port, user, password):
+
+        super(AsyncSFTP, self).__init__(host, port, user, password)
+        self._conn = None
+        self._sftp = None
+        self._lock = asyncio.Lock()
+
+    async def _acquire(self):
+
+        async with self._lock:
+            if self._sftp is None:
+                if asyncssh is None:
+                    raise ImportError(u'asyncssh is required by the asyncio SFTP backend')
+
+                logger.info(
+                    u'Conecting through SSH to the server (%s:%s)',
+                    self.host,
+                    self.port
+                )
+
+                options = {}
+
+                if self.window_size:
+                    options[u'window'] = int(self.window_size)
+
+                if self.max_packet_size:
+                    options[u'max_pktsize'] = int(self.max_packet_size)
+
+                self._conn = await asyncssh.connect(
+                    self.host,
+                    port=int(self.port),
+                    username=self.user,
+                    password=self.password,
+                    known_hosts=None,
+                    compression_algs=[u'zlib@openssh.com', u'zlib', u'none'] if self.compression == u'on' else [u'none'],
+                    **options
+                )
+                self._sftp = await self._conn.start_sftp_client()
+
+        return self._sftp
+
+    def _release(self, client, broken=False):
+
+        # Only the first operation failing on a session drops it
+        if broken and client is self._sftp:
+            self._sftp = None
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+
+        if self._conn is None:
+            return
+
+        logger.info(u'Closing SSH session (%s:%s)', self.host, self.port)
+
+        self._sftp.exit()
+        self._conn.close()
+        await self._conn.wait_closed()
+        self._sftp = None
+        self._conn = None
+
+    def _interrupted(self, error):
+
+        if asyncssh and isinstance(error, asyncssh.SFTPError):
+            return False
+
+        if asyncssh and isinstance(error, asyncssh.Error):
+            return True
+
+        return super(AsyncSFTP, self)._interrupted(error)
+
+    async def _mkdir(self, sftp, path):
+
+        logger.info(u'Creating directory (%s)', path)
+
+        try:
+            await sftp.mkdir(path)
+        except asyncssh.SFTPError:
+            if await sftp.isdir(path):
+                logger.debug(u'Directory already exists (%s)', path)
+                return 2
+            raise
+
+        logger.debug(u'Directory has being created (%s)', path)
+
+        return 1
+
+    async def _put(self, sftp, from_fl, to_fl):
+
+        await sftp.put(from_fl, to_fl, preserve=True)
+
+        if not self.put_confirm:
+            return
+
+        size = os.path.getsize(from_fl)
+        remote_size = (await sftp.stat(to_fl)).size
+
+        if remote_size != size:
+            raise IOError(
+                errno.EIO,
+                u'remote size %s differs from local size %d' % (remote_size, size))
+
+    async def _stat(self, sftp, path):
+
+        try:
+            attrs = await sftp.stat(path)
+        except asyncssh.SFTPError as e:
+            if e.code == asyncssh.FX_NO_SUCH_FILE:
+                return None
+            raise
+
+        return (attrs.size, attrs.mtime)
+
+
+class AsyncFTP(AsyncCommunicator):
+    """
+    FTP runs one command at a time per connection, operations take one of up
+    to connections sessions, opened on demand.
+    """
+
+    def __init__(self, host, port, user, password, connections=4):
+
+        super(AsyncFTP, self).__init__(host, port, user, password)
+        self._sessions = asyncio.Queue()
+
+        for i in range(connections):
+            self._sessions.put_nowait(None)
+
+    async def _acquire(self):
+
+        client = await self._sessions.get()
+
+        if client is not None:
+            return client
+
+        if aioftp is None:
+            self._sessions.put_nowait(None)
+            raise ImportError(u'aioftp is required by the asyncio FTP backend')
+
+        logger.info(u'Conecting through FTP to the server (%s)', self.host)
+
+        client = aioftp.Client()
+
+        try:
+            await client.connect(self.host, int(self.port))
+            await client.login(self.user, self.password)
+        except Exception:
+            client.close()
+            self._sessions.put_nowait(None)
+            raise
+
+        return client
+
+    def _release(self, client, broken=False):
+
+        if broken:
+            client.close()
+            client = None
+
+        self._sessions.put_nowait(client)
+
+    async def close(self):
+
+        while not self._sessions.empty():
+            client = self._sessions.get_nowait()
+
+            if client is None:
+                continue
+
+            logger.info(u'Closing FTP session (%s)', self.host)
+
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+    def _interrupted(self, error):
+
+        if aioftp and isinstance(error, aioftp.StatusCodeError):
+            # respostas 4xx sao temporarias, 5xx definitivas
+            return any(str(code).startswith(u'4') for code in error.received_codes)
+
+        return super(AsyncFTP, self)._interrupted(error)
+
+    async def _mkdir(self, client, path):
+
+        logger.info(u'Creating directory (%s)', path)
+
+        try:
+            await client.make_directory(path, parents=False)
+        except aioftp.StatusCodeError:
+            if await client.is_dir(path):
+                logger.debug(u'Directory already exists (%s)', path)
+                return 2
+            raise
+
+        logger.debug(u'Directory has being created (%s)', path)
+
+        return 1
+
+    async def _put(self, client, from_fl, to_fl):
+
+        await client.upload(from_fl, to_fl, write_into=True)
+
+    async def _stat(self, client, path):
+
+        try:
+            info = await client.stat(path)
+        except aioftp.StatusCodeError:
+            return None
+
+        return (int(info.get(u'size', 0)), _ftp_timestamp(info.get(u'modify', u'19700101000000')))
+
+
+class AsyncDelivery(object):
+    """
+    Runs a send_to_server.Delivery through the asyncio backend.
+
+    The configuration, the manifest and the summary of delivery are reused.
+    The scilista and the issue and title databases are sent first, then the
+    local tree of every scilista issue is walked while the transfers are
+    scheduled, with at most concurrency transfers in flight. Database
+    conversions (compatibility mode) and md5 sums run in a thread pool of
+    conversion_jobs threads.
+    """
+
+    def __init__(self, delivery, concurrency=100, connections=4):
+
+        self.delivery = delivery
+        self.concurrency = int(concurrency)
+        self.summary = delivery.summary
+
+        host, port, user, password = delivery._credentials
+
+        if issubclass(delivery._communicator, SFTP):
+            self.client = AsyncSFTP(host, port, user, password)
+        else:
+            self.client = AsyncFTP(host, port, user, password, connections)
+
+        for name, value in delivery._client_options.items():
+            if hasattr(self.client, name):
+                setattr(self.client, name, value)
+        self._executor = ThreadPoolExecutor(max(1, delivery.conversion_jobs))
+        self._processes = None
+        if delivery._master_conversor is native_master_conversor:
+            self._processes = ProcessPoolExecutor(
+                max(1, delivery.conversion_jobs),
+                mp_context=conversion_context()
+            )
+        self._semaphore = None
+        self._tasks = set()
+
+    def _content_paths(self, source_type):
+
+        if source_type in [content for content, pattern in CONTENT_PATHS]:
+            return [(content, pattern) for content, pattern in CONTENT_PATHS if content == source_type]
+
+        return CONTENT_PATHS
+
+    async def run(self, source_type=None):
+
+        delivery = self.delivery
+        source_type = source_type if source_type else delivery.source_type
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        try:
+            content_paths = self._content_paths(source_type)
+
+            if u'databases' in [content for content, pattern in content_paths]:
+                await self._send_serial()
+
+            for content, pattern in content_paths:
+                for journal_acronym, issue_label, delete in delivery._scilista:
+                    # pulando itens do scilista indicados para exclusao, ex: rsap v12n3 del
+                    if delete:
+                        continue
+
+                    logger.info(
+                        u'Copying %s from %s %s',
+                        content,
+                        journal_acronym,
+                        issue_label
+                    )
+
+                    base_path = pattern % (journal_acronym, issue_label)
+
+                    if content == u'databases':
+                        await self._schedule_databases(base_path)
+                    else:
+                        await self._schedule_tree(delivery.source_dir, base_path)
+
+            if self._tasks:
+                await asyncio.gather(*self._tasks)
+        finally:
+            await self.client.close()
+            self._executor.shutdown()
+            if self._processes is not None:
+                self._processes.shutdown()
+
+            if delivery.manifest:
+                delivery.manifest.close()
+
+            self.summary.collect(self.client)
+            self.summary.log()
+
+    async def _send_serial(self):
+        """
+        Sends the scilista and the issue and title databases, and waits for
+        them before the content of the issues is scheduled, as
+        send_to_server.Delivery.run_serial.
+        """
+
+        delivery = self.delivery
+
+        await self._makedirs(delivery.destiny_dir + u'/serial')
+
+        logger.info(u'Copying scilista.lst file')
+        await self._schedule(self._transfer(
+            delivery.scilista, delivery.destiny_dir + u'/serial/scilista.lst'))
+
+        logger.info(u'Copying issue database')
+        await self._schedule_databases(u'serial/issue')
+
+        logger.info(u'Copying title database')
+        await self._schedule_databases(u'serial/title')
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _schedule(self, coroutine):
+        """
+        Starts coroutine as soon as there is room for one more transfer in
+        flight.
+        """
+
+        await self._semaphore.acquire()
+
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+
+        self._tasks.discard(task)
+        self._semaphore.release()
+
+    async def _makedirs(self, path):
+        """
+        Creates path and its parents under destiny_dir. Directories already
+        resolved cost nothing, see AsyncCommunicator.mkdir.
+        """
+
+        destiny_dir = self.delivery.destiny_dir
+        current = destiny_dir
+
+        for item in path[len(destiny_dir):].strip(u'/').split(u'/'):
+            current += u'/' + item
+            await self.client.mkdir(current)
+
+    async def _schedule_tree(self, source_dir, base_path, extensions=None):
+
+        destiny_dir = self.delivery.destiny_dir
+
+        await self._makedirs(destiny_dir + u'/' + base_path)
+
+        for root, dirs, files in os.walk(source_dir + u'/' + base_path):
+            root = root.replace(u'\\', u'/')
+            current = root.replace(source_dir + u'/', u'')
+
+            await self._makedirs(destiny_dir + u'/' + current)
+
+            for fl in files:
+                if extensions and not fl[-3:].lower() in extensions:
+                    continue
+
+                await self._schedule(self._transfer(
+                    root + u'/' + fl,
+                    destiny_dir + u'/' + current + u'/' + fl
+                ))
+
+    async def _schedule_databases(self, base_path):
+
+        delivery = self.delivery
+
+        if not delivery.compatibility_mode:
+            await self._schedule_tree(
+                delivery.serial_source_dir, base_path, DATABASE_EXTENSIONS)
+            return
+
+        source = delivery.serial_source_dir + u'/' + base_path
+        converted = set()
+
+        await self._makedirs(delivery.destiny_dir + u'/' + base_path)
+
+        for root, dirs, files in os.walk(source):
+            root = root.replace(u'\\', u'/')
+            current = root.replace(delivery.serial_source_dir + u'/', u'')
+
+            await self._makedirs(delivery.destiny_dir + u'/' + current)
+
+            for fl in files:
+                if not fl[-3:].lower() in DATABASE_EXTENSIONS:
+                    continue
+
+                from_fl_name = root + u'/' + fl[:-4]
+
+                if from_fl_name in converted:
+                    continue
+
+                converted.add(from_fl_name)
+
+                await self._schedule(self._convert_and_transfer(
+                    from_fl_name,
+                    from_fl_name + u'_converted',
+                    delivery.destiny_dir + u'/' + current + u'/' + fl[:-4]
+                ))
+
+    async def _convert_and_transfer(self, mst_input, mst_output, to_fl):
+
+        delivery = self.delivery
+        loop = asyncio.get_event_loop()
+
+        if self._processes is not None:
+            result = await loop.run_in_executor(
+                self._processes,
+                native_conversion,
+                (mst_input, mst_output, to_fl)
+            )
+            status = delivery._native_done(result)[2]
+        else:
+            status = await loop.run_in_executor(
+                self._executor,
+                delivery._master_conversor,
+                mst_input,
+                mst_output,
+                delivery.cisis_dir
+            )
+
+        if not status:
+            return
+
+        for extension in DATABASE_EXTENSIONS:
+            converted_fl = mst_output + u'.' + extension
+            await self._transfer(converted_fl, to_fl + u'.' + extension)
+            delivery._local_remove(converted_fl)
+
+    async def _unchanged(self, from_fl, to_fl, local):
+        """
+        Same rules of send_to_server.Delivery._unchanged.
+        """
+
+        delivery = self.delivery
+
+        if delivery.manifest and not delivery.verify_remote:
+            return delivery.manifest.unchanged(from_fl, to_fl, local)
+
+        if not (delivery.sync or delivery.verify_remote):
+            return False
+
+        remote = await self.client.stat(to_fl)
+
+        if remote is None:
+            return False
+
+        remote_size, remote_mtime = remote
+        unchanged = remote_size == local.st_size and remote_mtime >= int(local.st_mtime)
+
+        if unchanged and delivery.manifest:
+            delivery.manifest.update(to_fl, remote_size, remote_mtime)
+
+        return unchanged
+
+    async def _transfer(self, from_fl, to_fl):
+
+        try:
+            local = os.stat(from_fl)
+        except OSError:
+            logger.error(u'Fail while copying file (%s), file not found', to_fl)
+            self.summary.failed(from_fl, to_fl, u'file not found')
+            return
+
+        try:
+            if await self._unchanged(from_fl, to_fl, local):
+                logger.debug(u'File unchanged, skipping (%s)', to_fl)
+                self.summary.skipped(to_fl, local.st_size)
+                return
+
+            await self.client.put(from_fl, to_fl)
+        except Exception as e:
+            logger.error(u'Fail while copying file (%s): %s', to_fl, e)
+            self.summary.failed(from_fl, to_fl, repr(e))
+            return
+
+        self.summary.sent(to_fl, local.st_size)
+
+        if self.delivery.manifest:
+            md5 = await asyncio.get_event_loop().run_in_executor(
+                self._executor, file_md5, from_fl)
+            self.delivery.manifest.update(
+                to_fl, local.st_size, local.st_mtime, md5)
+
+
+def run(delivery, source_type=None, concurrency=100, connections=4):
+    """
+    Runs delivery through the asyncio backend. The removal of the scilista
+    del items, when requested, runs first through the threaded client.
+    """
+
+    if delivery.delete or delivery.delete_dry_run:
+        try:
+            delivery.remove_deleted()
+        finally:
+            delivery.client.close()
+
+    asyncio.run(
+        AsyncDelivery(delivery, concurrency, connections).run(source_type))
@@ -1,16 +1,280 @@
 # coding: utf-8
+import calendar
+import errno
 import logging
+import os
+import random
+import shutil
+import socket
+import stat
+import tarfile
+import threading
+import time
 import paramiko
 from paramiko.client import SSHClient
 from paramiko import ssh_exception
+from paramiko.sftp import CMD_ATTRS, CMD_MKDIR, CMD_STAT, CMD_STATUS
 from ftplib import FTP as FTPLIB
 import ftplib
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 logger = logging.getLogger(__name__)
 
 
+def _parse_mlst_facts(response):
+    """
+    Parses the facts of a MLST response, ex:
+    250-Listing /bases/pdf/rsap/v12n3/a01.pdf
+     size=1234;modify=20160101120000;type=file; /bases/pdf/rsap/v12n3/a01.pdf
+    250 End
+    """
+
+    for line in response.splitlines():
+        if line.startswith(u' '):
+            return _parse_facts(line.strip().split(u' ', 1)[0])
+
+    return {}
+
+
+def _parse_facts(text):
+    """
+    Parses MLST/MLSD facts, ex: size=1234;modify=20160101120000;type=file;
+    """
+
+    facts = {}
+
+    for fact in text.split(u';'):
+        if u'=' in fact:
+            key, value = fact.split(u'=', 1)
+            facts[key.lower()] = value
+
+    return facts
+
+
+def _ftp_timestamp(value):
+    """
+    Converts a MLST/MDTM timestamp (YYYYMMDDHHMMSS[.sss], UTC) to epoch.
+    """
+
+    return calendar.timegm(time.strptime(value[:14], u'%Y%m%d%H%M%S'))
+
+
+# Content already compressed, SSH compression only spends CPU on them.
+COMPRESSED_EXTENSIONS = set([
+    u'pdf', u'jpg', u'jpeg', u'gif', u'png', u'tif', u'tiff', u'gz', u'tgz',
+    u'zip', u'bz2', u'xz', u'epub', u'mp3', u'mp4', u'docx', u'odt'
+])
+
+
+def compressible(path):
+    """
+    Tells whether the file content is worth compressing on the wire, judged
+    by its extension.
+    """
+
+    return path.rsplit(u'.', 1)[-1].lower() not in COMPRESSED_EXTENSIONS
+
+
+class ConnectionFailure(Exception):
+    """
+    Raised when a session with the server can not be established for reasons
+    a new attempt will not fix, such as invalid credentials.
+    """
+
+
+# Socket errors caused by the network or the server load, worth a new try.
+TRANSIENT_ERRNOS = set([
+    errno.ECONNRESET,
+    errno.ECONNREFUSED,
+    errno.ECONNABORTED,
+    errno.EPIPE,
+    errno.ETIMEDOUT,
+    errno.EHOSTUNREACH,
+    errno.ENETUNREACH,
+    errno.ENETDOWN,
+    errno.EIO
+])
+
+
+def transient_error(error):
+    """
+    Tells whether the operation failing with error may work after
+    reconnecting to the server. Invalid credentials, FTP permanent replies
+    (5xx) and SFTP status errors (no such file, permission denied) are final.
+    """
+
+    if isinstance(error, (ConnectionFailure, ssh_exception.AuthenticationException, ftplib.error_perm)):
+        return False
+
+    if isinstance(error, ssh_exception.NoValidConnectionsError):
+        return True
+
+    if isinstance(error, (EOFError, socket.timeout, ssh_exception.SSHException, ftplib.error_temp, ftplib.error_reply)):
+        return True
+
+    if isinstance(error, (IOError, OSError)):
+        return error.errno in TRANSIENT_ERRNOS
+
+    return False
+
+
+class RetryPolicy(object):
+    """
+    How failed remote operations are replayed.
+
+    An operation is tried up to attempts times. Before each new try the
+    session is closed, so it is reopened on demand, and the delay
+    backoff * 2 ** (try - 1) seconds, limited to max_backoff, is waited. The
+    delay is spread by up to +/- jitter of its value, so several workers do
+    not reconnect at the same time. retryable(error) decides which errors are
+    worth a new try.
+    """
+
+    def __init__(self, attempts=3, backoff=1, max_backoff=30, jitter=0.5,
+                 retryable=transient_error):
+        self.attempts = max(1, int(attempts))
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.jitter = float(jitter)
+        self.retryable = retryable
+
+    def delay(self, attempt):
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+# Port used when none is configured.
+DEFAULT_PORTS = {u'sftp': 22, u'ftp': 21}
+
+
+def server_port(server_type, port=None):
+    """
+    Returns the port of the server, the protocol default when port is not
+    given. Port 22 with FTP is taken as the SFTP default left in the
+    configuration and replaced by 21: the FTP client always connected to
+    port 21 before the configured port was used.
+    """
+
+    server_type = str(server_type)
+
+    if port is None or str(port).strip() == u'':
+        return DEFAULT_PORTS[server_type]
+
+    port = int(port)
+
+    if server_type == u'ftp' and port == DEFAULT_PORTS[u'sftp']:
+        logger.warning(u'Port 22 is the SSH port, connecting through FTP to port 21')
+        return DEFAULT_PORTS[u'ftp']
+
+    return port
+
+
+def client_options(resume_threshold=None, retries=3, retry_backoff=1,
+                   compression=u'off', window_size=None,
+                   max_packet_size=None, put_confirm=True, batch_mkdir=False):
+    """
+    Builds the attributes set on every communicator of a delivery from the
+    command line options. resume_threshold is given in MB. Options not
+    supported by a protocol are ignored by it.
+    """
+
+    options = {
+        u'retry_policy': RetryPolicy(retries, retry_backoff),
+        u'compression': compression,
+        u'put_confirm': put_confirm,
+        u'batch_mkdir': batch_mkdir
+    }
+
+    if resume_threshold is not None:
+        options[u'resume_threshold'] = int(float(resume_threshold) * 1024 * 1024)
+
+    if window_size:
+        options[u'window_size'] = int(window_size)
+
+    if max_packet_size:
+        options[u'max_packet_size'] = int(max_packet_size)
+
+    return options
+
+
+def _command_chunks(paths, limit=32768):
+    """
+    Splits paths in groups fitting a command line of about limit characters.
+    """
+
+    chunk = []
+    length = 0
+
+    for path in paths:
+        if chunk and length + len(path) + 3 > limit:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(path)
+        length += len(path) + 3
+
+    if chunk:
+        yield chunk
+
+
+class _Replies(object):
+    """
+    Receives the replies of pipelined SFTP requests, paramiko hands them to
+    the object given to _async_request.
+    """
+
+    def __init__(self):
+        self.received = {}
+
+    def _async_response(self, t, msg, num):
+        self.received[num] = (t, msg)
+
+
+def _directory_attributes():
+
+    attributes = paramiko.SFTPAttributes()
+    attributes.st_mode = 0o777
+
+    return attributes
+
+
+def _pipelined(client, requests):
+    """
+    Sends every (command, *arguments) request through the SFTP client before
+    waiting for the replies, returned as (type, message) in the order of the
+    requests.
+    """
+
+    replies = _Replies()
+    numbers = [client._async_request(replies, request[0], *request[1:]) for request in requests]
+
+    while len(replies.received) < len(numbers):
+        client._read_response()
+
+    return [replies.received[num] for num in numbers]
+
+
 class Communicator(object):
 
+    # Files of at least resume_threshold bytes are sent to a temporary name
+    # (to_fl + partial_suffix), resumed from the size already sent when the
+    # transfer is interrupted and renamed to to_fl once complete. A part left
+    # by an earlier put is overwritten, never resumed.
+    resume_threshold = 16 * 1024 * 1024
+    partial_suffix = u'.part'
+    # Errors reported by a failed operation once its retries are exhausted.
+    transfer_errors = (IOError, OSError, EOFError, socket.error)
+    retry_policy = RetryPolicy()
+    # makedirs creates every missing directory in a single batch, when the
+    # protocol supports it.
+    batch_mkdir = False
+
     def __init__(self, host, port, user, password):
 
         self.host = host
@@ -18,20 +282,403 @@ class Communicator(object):
         self.user = user
         self.password = password
         self._active_client = None
+        # Remote directories already created or found during this session,
+        # with the number of round trips spent to resolve each one.
+        self.known_dirs = {}
+        self.avoided_roundtrips = 0
+        # Number of operations replayed after a transient failure.
+        self.retries = 0
+        # Bytes written to the server during this session.
+        self.sent_bytes = 0
+
+    def close(self):
+        """
+        Closes the session kept with the server, if any. A new session will be
+        opened on demand by the next operation.
+        """
+        self._active_client = None
+
+    def _retry(self, description, function, *args):
+        """
+        Runs function(*args) following the retry_policy. The session is
+        reopened before each new try, so function must reach the server
+        through self.client. The last error is raised when every try fails or
+        the error is not retryable.
+        """
+
+        policy = self.retry_policy
+        attempt = 1
+
+        while True:
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt >= policy.attempts or not self._interrupted(e):
+                    raise
+
+                delay = policy.delay(attempt)
+                attempt += 1
+                self.retries += 1
+
+                logger.warning(
+                    u'Fail while %s, retrying in %.1f seconds (attempt %d of %d): %s',
+                    description,
+                    delay,
+                    attempt,
+                    policy.attempts,
+                    e
+                )
+
+                self._reset()
+                time.sleep(delay)
+
+    def _interrupted(self, error):
+        """
+        Tells whether the operation failing with error is worth a new try:
+        the error is retryable for the retry_policy or it broke the session.
+        """
+
+        if isinstance(error, ConnectionFailure):
+            return False
+
+        if self.retry_policy.retryable(error):
+            return True
+
+        return isinstance(error, self.transfer_errors) and not self._connected()
+
+    def _connected(self):
+        """
+        Tells whether the session with the server is still usable.
+        """
+        return True
+
+    def _reset(self):
+        """
+        Drops a session broken by a failure. Errors are expected here, the
+        connection is usually already lost.
+        """
+
+        try:
+            self.close()
+        except Exception as e:
+            logger.debug(u'Fail while closing broken session: %s', e)
+
+    def mkdir(self, path):
+        """
+        Creates the remote directory. Each directory is created or probed at
+        most once per session, later calls for the same path are answered
+        from known_dirs.
+        """
+
+        if path in self.known_dirs:
+            logger.debug(u'Directory already available (%s)', path)
+            self.avoided_roundtrips += self.known_dirs[path]
+            return
+
+        roundtrips = self._retry(
+            u'creating directory (%s)' % path, self._mkdir, path)
+
+        if roundtrips:
+            self.known_dirs[path] = roundtrips
+
+    def _mkdir(self, path):
+        """
+        Creates the remote directory and returns the number of round trips
+        used, or None when the directory is not available.
+        """
+        raise NotImplementedError
+
+    def makedirs(self, paths):
+        """
+        Creates the remote directories, parents listed before their children.
+        With batch_mkdir the directories not in known_dirs are created at
+        once by _makedirs, otherwise, or when the batch fails, one mkdir is
+        sent per directory.
+        """
+
+        pending = []
+
+        for path in paths:
+            if path in self.known_dirs:
+                self.avoided_roundtrips += self.known_dirs[path]
+            elif path not in pending:
+                pending.append(path)
+
+        if len(pending) > 1 and self.batch_mkdir:
+            logger.info(u'Creating %d directories in batch', len(pending))
+
+            try:
+                created = self._retry(
+                    u'creating %d directories' % len(pending),
+                    self._makedirs,
+                    pending
+                )
+            except self.transfer_errors as e:
+                logger.warning(u'Fail while creating directories in batch: %s', e)
+                created = False
+
+            if created:
+                for path in pending:
+                    self.known_dirs[path] = 1
+                self.avoided_roundtrips += len(pending) - 1
+                return
+
+            logger.info(u'Creating the directories one by one')
+
+        for path in pending:
+            self.mkdir(path)
+
+    def _makedirs(self, paths):
+        """
+        Creates every directory of paths with the fewest round trips. Returns
+        False when the protocol has no batch operation or some directory was
+        not created.
+        """
+        return False
+
+    def open(self, path):
+        """
+        Returns a writable file object for the remote path. Only available
+        for protocols able to keep several files open at the same time.
+        """
+        raise NotImplementedError
+
+    def tar_put(self, files, remote_dir):
+        """
+        Sends files, a list of (from_fl, name) tuples, as a single tar stream
+        extracted by the server under remote_dir, name being the path of the
+        file relative to remote_dir. Returns False when the server could not
+        extract the stream. Only available for protocols able to run remote
+        commands.
+        """
+        raise NotImplementedError
+
+    def _compress(self, path=None):
+        """
+        Chooses the wire compression for the next transfer of path, for the
+        protocols supporting it.
+        """
+
+    def _remote_size(self, path):
+        """
+        Returns the size of the remote file, or None when it does not exist.
+        """
+        raise NotImplementedError
+
+    def _upload(self, fl, path, offset=0):
+        """
+        Writes the content read from fl to the remote file starting at offset
+        and returns the number of bytes written.
+        """
+        raise NotImplementedError
+
+    def rename(self, from_path, to_path):
+        """
+        Renames the remote file, replacing to_path when it already exists.
+        Returns False when the file could not be renamed.
+        """
+
+        logger.debug(u'Renaming file (%s) to (%s)', from_path, to_path)
+
+        try:
+            self._retry(
+                u'renaming file (%s)' % from_path,
+                self._rename,
+                from_path,
+                to_path
+            )
+        except self.transfer_errors as e:
+            logger.error(
+                u'Fail while renaming file (%s) to (%s): %s',
+                from_path,
+                to_path,
+                e
+            )
+            return False
+
+        return True
+
+    def _rename(self, from_path, to_path):
+        raise NotImplementedError
+
+    def remove(self, path):
+
+        logger.info(u'Removing file (%s)', path)
+
+        try:
+            self._retry(u'removing file (%s)' % path, self._remove, path)
+        except self.transfer_errors as e:
+            logger.error(u'Fail while removing file (%s): %s', path, e)
+            return False
+
+        return True
+
+    def _remove(self, path):
+        raise NotImplementedError
+
+    def rmtree(self, path):
+        """
+        Removes the remote directory and everything under it. Returns False
+        when the tree could not be removed, a missing directory is not an
+        error.
+        """
+
+        logger.info(u'Removing directory tree (%s)', path)
+
+        try:
+            self._retry(u'removing directory tree (%s)' % path, self._rmtree, path)
+        except self.transfer_errors as e:
+            logger.error(u'Fail while removing directory tree (%s): %s', path, e)
+            return False
+
+        logger.debug(u'Directory tree has being removed (%s)', path)
+
+        return True
+
+    def _rmtree(self, path):
+        raise NotImplementedError
+
+    def _resumable_put(self, from_fl, to_fl):
+        """
+        Sends from_fl to a temporary remote name and renames it to to_fl once
+        the remote size matches the local one. The first attempt overwrites
+        any part left on the server, which may hold an older version of the
+        file, and each retry continues from the size it already sent. The
+        server never sees a partially written to_fl.
+        """
+
+        part = to_fl + self.partial_suffix
+        attempts = []
+
+        def put_part():
+            resume = bool(attempts)
+            attempts.append(resume)
+            self._put_part(from_fl, part, resume)
+
+        self._retry(u'copying file (%s)' % to_fl, put_part)
+
+        logger.debug(u'File has being copied (%s)', to_fl)
+
+        return self.rename(part, to_fl)
+
+    def _put_part(self, from_fl, part, resume=False):
+
+        size = os.path.getsize(from_fl)
+        offset = (self._remote_size(part) or 0) if resume else 0
+
+        if offset > size:
+            offset = 0
+
+        if offset:
+            logger.info(u'Resuming copy of (%s) from byte %d', part, offset)
+
+        with open(from_fl, 'rb') as fl:
+            fl.seek(offset)
+            self.sent_bytes += self._upload(fl, part, offset)
+
+        remote_size = self._remote_size(part)
+
+        if remote_size != size:
+            raise IOError(
+                errno.EIO,
+                u'remote size %s differs from local size %d' % (remote_size, size))
+
+    def putfo(self, fl, to_fl):
+        """
+        Copies the content read from the file object fl to the remote file.
+        The content is written to a temporary name and renamed to to_fl only
+        when the whole stream was sent. Only seekable file objects are sent
+        again after a failure, streams can not be replayed.
+        """
+
+        logger.info(u'Copying stream to (%s)', to_fl)
+
+        self._compress(to_fl)
+        part = to_fl + self.partial_suffix
+        replayable = hasattr(fl, 'seek')
+        start = fl.tell() if replayable else 0
+
+        def upload():
+            if replayable:
+                fl.seek(start)
+            self.sent_bytes += self._upload(fl, part)
+
+        try:
+            if replayable:
+                self._retry(u'copying stream (%s)' % to_fl, upload)
+            else:
+                upload()
+        except self.transfer_errors as e:
+            logger.error(u'Fail while copying stream (%s): %s', to_fl, e)
+            return False
+
+        logger.debug(u'File has being copied (%s)', to_fl)
+
+        return self.rename(part, to_fl)
 
 
 class FTP(Communicator):
     ftp_client = None
+    _last_activity = 0
+    transfer_errors = ftplib.all_errors
+
+    # Seconds a session may stay idle before being checked with NOOP.
+    keepalive_interval = 30
 
     @property
     def client(self):
-        self.ftp_client = FTPLIB(self.host)
+
+        if self.ftp_client and self._is_alive():
+            self._last_activity = time.time()
+            return self.ftp_client
+
+        self.ftp_client = self._client()
+        self._last_activity = time.time()
+
+        return self.ftp_client
+
+    def _is_alive(self):
+
+        if time.time() - self._last_activity < self.keepalive_interval:
+            return True
+
         try:
-            self.ftp_client.login(user=self.user, passwd=self.password)
-        except ftplib.error_perm:
+            self.ftp_client.voidcmd(u'NOOP')
+        except ftplib.all_errors:
+            logger.info(u'FTP session is no longer active, reconnecting')
+            self.ftp_client.close()
+            return False
+
+        return True
+
+    def _client(self):
+
+        logger.info(u'Conecting through FTP to the server (%s)', self.host)
+
+        ftp_client = FTPLIB()
+        ftp_client.connect(self.host, int(self.port))
+        try:
+            ftp_client.login(user=self.user, passwd=self.password)
+        except ftplib.error_perm as e:
             logger.error(u'Fail while connecting through FTP. Check your creadentials.')
+            ftp_client.close()
+            raise ConnectionFailure(u'FTP login refused by %s: %s' % (self.host, e))
         else:
-            return self.ftp_client
+            return ftp_client
+
+    def close(self):
+
+        if self.ftp_client is None:
+            return
+
+        logger.info(u'Closing FTP session (%s)', self.host)
+
+        try:
+            self.ftp_client.quit()
+        except ftplib.all_errors:
+            self.ftp_client.close()
+
+        self.ftp_client = None
 
     def exists_dir(self, path):
         logger.info(u'Checking if directory already exists (%s)', path)
@@ -45,35 +692,105 @@ class FTP(Communicator):
 
         return False
 
-    def mkdir(self, path):
+    def _mkdir(self, path):
 
         logger.info(u'Creating directory (%s)', path)
 
         try:
             self.client.mkd(path)
             logger.debug(u'Directory has being created (%s)', path)
+            return 1
         except ftplib.error_perm as e:
-            if not self.exists_dir(path):
-                logger.error(
-                    u'Fail while creating directory (%s): %s',
-                    path,
-                    e.message
-                )
+            if self.exists_dir(path):
+                return 2
+
+            logger.error(
+                u'Fail while creating directory (%s): %s',
+                path,
+                e
+            )
 
     def chdir(self, path):
 
         logger.info(u'Changing to directory (%s)', path)
 
         try:
-            self.client.chdir(path)
-        except IOError as e:
+            self._retry(
+                u'accessing directory (%s)' % path,
+                lambda: self.client.cwd(path)
+            )
+        except ftplib.all_errors as e:
             logger.error(
                 u'Fail while accessing directory (%s): %s',
                 path,
-                e.strerror
+                e
             )
             raise(e)
 
+    def stat(self, path):
+        """
+        Returns a tuple (size, mtime) for the remote file, or None when it
+        does not exist. MLST is used when the server supports it, otherwise
+        the SIZE and MDTM commands.
+        """
+
+        logger.debug(u'Checking remote file (%s)', path)
+
+        return self._retry(u'checking file (%s)' % path, self._stat, path)
+
+    def _stat(self, path):
+
+        try:
+            response = self.client.sendcmd(u'MLST %s' % path)
+        except ftplib.error_perm:
+            response = None
+
+        if response:
+            facts = _parse_mlst_facts(response)
+            if u'size' in facts and u'modify' in facts:
+                return (int(facts[u'size']), _ftp_timestamp(facts[u'modify']))
+
+        try:
+            self.client.voidcmd(u'TYPE I')
+            size = self.client.size(path)
+            mtime = self.client.sendcmd(u'MDTM %s' % path).split()[-1]
+        except ftplib.error_perm:
+            return None
+
+        return (int(size), _ftp_timestamp(mtime))
+
+    def walk(self, path):
+        """
+        Yields a tuple (path, size, mtime) for every file under the remote
+        path. The server must support the MLSD command.
+        """
+
+        def listing():
+            lines = []
+            self.client.retrlines(u'MLSD %s' % path, lines.append)
+            return lines
+
+        try:
+            lines = self._retry(u'listing directory (%s)' % path, listing)
+        except ftplib.error_perm as e:
+            logger.warning(u'Fail while listing directory (%s): %s', path, e)
+            return
+
+        for line in lines:
+            facts, name = line.split(u' ', 1)
+            facts = _parse_facts(facts)
+            full_path = path + u'/' + name
+
+            if facts.get(u'type') == u'dir':
+                for item in self.walk(full_path):
+                    yield item
+            elif facts.get(u'type') == u'file':
+                yield (
+                    full_path,
+                    int(facts.get(u'size', 0)),
+                    _ftp_timestamp(facts.get(u'modify', u'19700101000000'))
+                )
+
     def put(self, from_fl, to_fl, binary=True):
 
         logger.info(
@@ -82,41 +799,201 @@ class FTP(Communicator):
             to_fl
         )
 
-        read_type = u'rb'
-
-        if not binary:
-            read_type = u'r'
+        if not os.path.isfile(from_fl):
+            logger.error(u'File not found (%s)', from_fl)
+            return False
 
         try:
-            command = u'STOR %s' % to_fl
+            if binary and os.path.getsize(from_fl) >= self.resume_threshold:
+                return self._resumable_put(from_fl, to_fl)
+
+            self._retry(
+                u'copying file (%s)' % to_fl,
+                self._store,
+                from_fl,
+                to_fl,
+                binary
+            )
+        except ftplib.all_errors as e:
+            logger.error(u'Fail while copying file (%s): %s', to_fl, e)
+            return False
+
+        self.sent_bytes += os.path.getsize(from_fl)
+
+        logger.debug(u'File has being copied (%s)', to_fl)
+        return True
+
+    def _store(self, from_fl, to_fl, binary=True):
+
+        command = u'STOR %s' % to_fl
+
+        with open(from_fl, u'rb' if binary else u'r') as fl:
             if binary:
-                self.client.storbinary(
-                    command.encode('utf-8'), open(from_fl, read_type)
-                )
+                self.client.storbinary(command, fl)
             else:
-                self.client.storlines(
-                    command.encode('utf-8'), open(from_fl, read_type)
-                )
+                self.client.storlines(command, fl)
 
-        except IOError:
-            logger.error(u'File not found (%s)', from_fl)
+    def _remote_size(self, path):
 
-        logger.debug(u'File has being copied (%s)', to_fl)
+        try:
+            self.client.voidcmd(u'TYPE I')
+            return self.client.size(path)
+        except ftplib.error_perm:
+            return None
+
+    def _upload(self, fl, path, offset=0):
+
+        written = [0]
+
+        def count(block):
+            written[0] += len(block)
+
+        self.client.storbinary(
+            u'STOR %s' % path, fl, callback=count, rest=offset or None)
+
+        return written[0]
+
+    def _rename(self, from_path, to_path):
+
+        try:
+            self.client.rename(from_path, to_path)
+        except ftplib.error_perm:
+            self.client.delete(to_path)
+            self.client.rename(from_path, to_path)
+
+    def _remove(self, path):
+
+        self.client.delete(path)
+
+    def _rmtree(self, path):
+        """
+        Only a missing path counts as removed. The path is checked with CWD,
+        a refused CWD on an existing file is an error.
+        """
+
+        current = self.client.pwd()
+
+        try:
+            self.client.cwd(path)
+        except ftplib.error_perm:
+            if self._stat(path) is not None:
+                raise ftplib.error_perm(u'550 %s: not a directory' % path)
+            logger.debug(u'Directory tree does not exist (%s)', path)
+            return
+
+        self.client.cwd(current)
+        self._remove_tree(path)
+
+    def _remove_tree(self, path):
+
+        lines = []
+
+        try:
+            self.client.retrlines(u'MLSD %s' % path, lines.append)
+        except ftplib.error_perm as e:
+            # 500 e 502: servidor sem MLSD
+            if not type(u'')(e)[:3] in (u'500', u'502'):
+                raise
+            self._remove_tree_nlst(path)
+            return
+
+        for line in lines:
+            facts, name = line.split(u' ', 1)
+            facts = _parse_facts(facts)
+            full_path = path + u'/' + name
+
+            if facts.get(u'type') == u'dir':
+                self._remove_tree(full_path)
+            elif facts.get(u'type') == u'file':
+                self.client.delete(full_path)
+
+        self.client.rmd(path)
+
+    def _remove_tree_nlst(self, path):
+        """
+        Removes the tree listed with NLST, which does not tell files from
+        directories: the names that can not be deleted as files are removed
+        as directories.
+        """
+
+        try:
+            names = self.client.nlst(path)
+        except ftplib.error_perm:
+            # alguns servidores respondem 550 para diretorios vazios
+            names = []
+
+        for name in names:
+            name = name.replace(u'\\', u'/').rstrip(u'/').rsplit(u'/', 1)[-1]
+
+            if name in (u'', u'.', u'..'):
+                continue
+
+            full_path = path + u'/' + name
+
+            try:
+                self.client.delete(full_path)
+            except ftplib.error_perm:
+                self._remove_tree_nlst(full_path)
+
+        self.client.rmd(path)
 
 
 class SFTP(Communicator):
     ssh_client = None
+    transfer_errors = Communicator.transfer_errors + (ssh_exception.SSHException,)
+
+    # SSH compression: u'on', u'off' or u'auto'. In auto mode the choice is
+    # made once per session, by the first file sent when it is opened. An
+    # open session is never closed to change it, since mixed directories
+    # would reconnect at almost every file.
+    compression = u'off'
+    # SFTP channel window and packet sizes in bytes, None for the paramiko
+    # defaults. Larger windows keep high latency links busy.
+    window_size = None
+    max_packet_size = None
+    # Whether put stats the remote file to confirm its size, one extra round
+    # trip per file.
+    put_confirm = True
+    # Whether writes are sent without waiting for each server reply.
+    pipelined = True
+    # Whether the server accepts remote commands (exec channels), False once
+    # a command was refused.
+    remote_commands = True
+    _compressed = None
 
     @property
     def client(self):
 
-        if self.ssh_client and self.ssh_client.get_transport().is_active():
+        if self._connected():
             return self._active_client
 
         self._active_client = self._client()
 
         return self._active_client
 
+    def _connected(self):
+
+        if self.ssh_client is None:
+            return False
+
+        transport = self.ssh_client.get_transport()
+
+        return transport is not None and transport.is_active()
+
+    def _compress(self, path=None):
+        """
+        Chooses the SSH compression of the session opened for the next
+        transfer of path. The compression of an open session is kept.
+        """
+
+        if self._connected():
+            return
+
+        if self.compression == u'auto':
+            self._compressed = path is None or compressible(path)
+        else:
+            self._compressed = self.compression == u'on'
+
     def _client(self):
 
         logger.info(
@@ -125,38 +1002,69 @@ class SFTP(Communicator):
             self.port
         )
 
+        if self._compressed is None:
+            self._compress()
+
+        ssh_client = SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
         try:
-            self.ssh_client = SSHClient()
-            self.ssh_client.set_missing_host_key_policy(
-                paramiko.AutoAddPolicy()
-            )
-            self.ssh_client.connect(
+            ssh_client.connect(
                 self.host,
+                port=int(self.port),
                 username=self.user,
                 password=self.password,
-                compress=True
+                compress=self._compressed
             )
-        except ssh_exception.AuthenticationException:
+        except ssh_exception.AuthenticationException as e:
             logger.error(
                 u'Fail while connecting through SSH. Check your creadentials.')
-            return None
+            ssh_client.close()
+            raise ConnectionFailure(
+                u'SSH authentication refused by %s: %s' % (self.host, e))
         except ssh_exception.NoValidConnectionsError:
             logger.error(u'Fail while connecting through SSH. Check your credentials or the server availability.')
-            return None
-        else:
-            return self.ssh_client.open_sftp()
+            ssh_client.close()
+            raise
 
-    def mkdir(self, path):
+        self.ssh_client = ssh_client
+
+        return paramiko.SFTPClient.from_transport(
+            ssh_client.get_transport(),
+            window_size=self.window_size,
+            max_packet_size=self.max_packet_size
+        )
+
+    def close(self):
+
+        if self.ssh_client is None:
+            return
+
+        logger.info(u'Closing SSH session (%s:%s)', self.host, self.port)
+
+        if self._active_client is not None:
+            self._active_client.close()
+
+        self.ssh_client.close()
+        self.ssh_client = None
+        self._active_client = None
+
+    def _mkdir(self, path):
 
         logger.info(u'Creating directory (%s)', path)
 
         try:
             self.client.mkdir(path)
             logger.debug(u'Directory has being created (%s)', path)
+            return 1
         except IOError as e:
+            if self._interrupted(e):
+                raise
+
             try:
                 self.client.stat(path)
                 logger.warning(u'Directory already exists (%s)', path)
+                return 2
             except IOError as e:
                 logger.error(
                     u'Fail while creating directory (%s): %s',
@@ -165,12 +1073,68 @@ class SFTP(Communicator):
                 )
                 raise(e)
 
+    def _makedirs(self, paths):
+        """
+        Creates the directories with mkdir -p over an exec channel, or with
+        pipelined SFTP mkdir requests when the server does not run commands.
+        """
+
+        if self.remote_commands:
+            try:
+                for chunk in _command_chunks(paths):
+                    self._exec(u'mkdir -p -- ' + u' '.join(quote(path) for path in chunk))
+                logger.debug(u'Directories have being created through mkdir -p')
+                return True
+            except IOError as e:
+                if self.remote_commands:
+                    logger.warning(u'Fail while creating directories through mkdir -p: %s', e)
+                    return False
+                logger.info(u'Remote commands not available, creating directories through pipelined SFTP requests')
+
+        return self._mkdir_pipelined(paths)
+
+    def _mkdir_pipelined(self, paths):
+        """
+        Sends every SFTP mkdir request before reading the replies. Servers
+        handle the requests of a channel in order, so the parents, listed
+        first, exist before their children. Refused directories are checked
+        afterwards with stat, also pipelined, as they may already exist.
+        """
+
+        client = self.client
+
+        replies = _pipelined(
+            client, [(CMD_MKDIR, path, _directory_attributes()) for path in paths])
+        refused = [
+            path for path, (t, msg) in zip(paths, replies)
+            if t != CMD_STATUS or msg.get_int() != paramiko.SFTP_OK
+        ]
+
+        if not refused:
+            return True
+
+        replies = _pipelined(client, [(CMD_STAT, path) for path in refused])
+
+        for path, (t, msg) in zip(refused, replies):
+            if t != CMD_ATTRS:
+                logger.warning(u'Fail while creating directory (%s)', path)
+                return False
+
+            if not stat.S_ISDIR(paramiko.SFTPAttributes._from_msg(msg).st_mode or 0):
+                logger.warning(u'Fail while creating directory (%s): not a directory', path)
+                return False
+
+        return True
+
     def chdir(self, path):
 
         logger.info(u'Changing to directory (%s)', path)
 
         try:
-            self.client.chdir(path)
+            self._retry(
+                u'accessing directory (%s)' % path,
+                lambda: self.client.chdir(path)
+            )
         except IOError as e:
             logger.error(
                 u'Fail while accessing directory (%s): %s',
@@ -179,6 +1143,53 @@ class SFTP(Communicator):
             )
             raise(e)
 
+    def stat(self, path):
+        """
+        Returns a tuple (size, mtime) for the remote file, or None when it
+        does not exist.
+        """
+
+        logger.debug(u'Checking remote file (%s)', path)
+
+        try:
+            attr = self._retry(
+                u'checking file (%s)' % path,
+                lambda: self.client.stat(path)
+            )
+        except IOError as e:
+            if self._interrupted(e):
+                raise
+            return None
+
+        return (attr.st_size, attr.st_mtime)
+
+    def walk(self, path):
+        """
+        Yields a tuple (path, size, mtime) for every file under the remote
+        path.
+        """
+
+        try:
+            entries = self._retry(
+                u'listing directory (%s)' % path,
+                lambda: self.client.listdir_attr(path)
+            )
+        except IOError as e:
+            if self._interrupted(e):
+                raise
+            logger.warning(
+                u'Fail while listing directory (%s): %s', path, e.strerror)
+            return
+
+        for entry in entries:
+            full_path = path + u'/' + entry.filename
+
+            if stat.S_ISDIR(entry.st_mode):
+                for item in self.walk(full_path):
+                    yield item
+            else:
+                yield (full_path, entry.st_size, entry.st_mtime)
+
     def put(self, from_fl, to_fl):
 
         logger.info(
@@ -187,17 +1198,235 @@ class SFTP(Communicator):
             to_fl
         )
 
-        try:
-            self.client.put(from_fl, to_fl)
-            logger.debug(u'File has being copied (%s)', to_fl)
-        except OSError as e:
+        if not os.path.isfile(from_fl):
             logger.error(
                 u'Fail while copying file (%s), file not found',
                 to_fl
             )
-        except IOError as e:
+            return False
+
+        self._compress(from_fl)
+
+        try:
+            if os.path.getsize(from_fl) >= self.resume_threshold:
+                return self._resumable_put(from_fl, to_fl)
+
+            self._retry(
+                u'copying file (%s)' % to_fl,
+                self._put,
+                from_fl,
+                to_fl
+            )
+            logger.debug(u'File has being copied (%s)', to_fl)
+        except self.transfer_errors as e:
             logger.error(
                 u'Fail while copying file (%s): %s',
                 to_fl,
-                e.strerror
+                e
             )
+            return False
+
+        return True
+
+    def _put(self, from_fl, to_fl):
+
+        with open(from_fl, 'rb') as fl:
+            self.sent_bytes += self._upload(fl, to_fl)
+
+        if self.put_confirm:
+            size = os.path.getsize(from_fl)
+            remote_size = self._remote_size(to_fl)
+            if remote_size != size:
+                raise IOError(
+                    errno.EIO,
+                    u'remote size %s differs from local size %d' % (remote_size, size))
+
+    def _remote_size(self, path):
+
+        try:
+            return self.client.stat(path).st_size
+        except IOError as e:
+            if self._interrupted(e):
+                raise
+            return None
+
+    def _upload(self, fl, path, offset=0):
+
+        remote = self.client.open(path, 'r+b' if offset else 'wb')
+
+        try:
+            remote.set_pipelined(self.pipelined)
+            remote.seek(offset)
+            shutil.copyfileobj(fl, remote, 32768)
+            written = remote.tell() - offset
+        finally:
+            remote.close()
+
+        return written
+
+    def _rename(self, from_path, to_path):
+        """
+        The POSIX rename extension is used when available, so the replacement
+        is atomic.
+        """
+
+        posix_rename = getattr(self.client, 'posix_rename', None)
+
+        if posix_rename:
+            try:
+                posix_rename(from_path, to_path)
+                return
+            except IOError as e:
+                if self._interrupted(e):
+                    raise
+
+        try:
+            self.client.rename(from_path, to_path)
+        except IOError as e:
+            if self._interrupted(e):
+                raise
+            self.client.remove(to_path)
+            self.client.rename(from_path, to_path)
+
+    def _remove(self, path):
+
+        self.client.remove(path)
+
+    def open(self, path):
+
+        logger.info(u'Opening remote file for writing (%s)', path)
+
+        def open_remote():
+            fl = self.client.open(path, 'wb')
+            fl.set_pipelined(self.pipelined)
+            return fl
+
+        return self._retry(u'opening file (%s)' % path, open_remote)
+
+    def tar_put(self, files, remote_dir):
+
+        if not self.remote_commands:
+            return False
+
+        logger.info(
+            u'Streaming %d files to (%s) through tar', len(files), remote_dir)
+
+        # A tar mixing both kinds of file is compressed when most of them are
+        # compressible.
+        compressible_files = sum(1 for from_fl, name in files if compressible(from_fl))
+        self._compress(u'.tar' if compressible_files * 2 > len(files) else u'.tar.gz')
+
+        try:
+            self._retry(
+                u'streaming files to (%s)' % remote_dir,
+                self._tar_put,
+                files,
+                remote_dir
+            )
+        except self.transfer_errors as e:
+            logger.error(
+                u'Fail while streaming files to (%s): %s', remote_dir, e)
+            return False
+
+        logger.debug(u'Files have being extracted at (%s)', remote_dir)
+
+        return True
+
+    def _tar_put(self, files, remote_dir):
+
+        command = u'mkdir -p %s && tar -xf - -C %s' % (
+            quote(remote_dir), quote(remote_dir))
+
+        def feed(stdin):
+            tar = tarfile.open(fileobj=stdin, mode='w|')
+
+            for from_fl, name in files:
+                tar.add(from_fl, arcname=name, recursive=False)
+                self.sent_bytes += os.path.getsize(from_fl)
+
+            tar.close()
+
+        self._exec(command, feed)
+
+    def _exec(self, command, feed=None):
+        """
+        Runs command on the server through an exec channel. feed, when given,
+        is called with a file object writing to the standard input of the
+        command. Raises IOError when the command fails or the server does not
+        allow remote commands.
+        """
+
+        # client opens the session when needed
+        self.client
+        channel = self.ssh_client.get_transport().open_session()
+        # stderr junto da saida, lida enquanto o comando roda: uma saida
+        # maior que a janela do canal bloquearia o comando remoto
+        channel.set_combine_stderr(True)
+        output = []
+        reader = threading.Thread(
+            target=lambda: output.append(channel.makefile('rb').read()))
+        reader.daemon = True
+
+        try:
+            try:
+                channel.exec_command(command)
+            except ssh_exception.SSHException as e:
+                if not self._connected():
+                    raise
+                self.remote_commands = False
+                raise IOError(u'remote commands are not allowed: %s' % e)
+
+            reader.start()
+
+            if feed is not None:
+                stdin = channel.makefile('wb')
+                feed(stdin)
+                stdin.close()
+
+            channel.shutdown_write()
+
+            status = channel.recv_exit_status()
+            reader.join()
+            error = output[0] if output else b''
+        finally:
+            channel.close()
+
+        if status == 127:
+            self.remote_commands = False
+
+        if status != 0:
+            # apenas o final de saidas longas, onde esta o erro
+            raise IOError(
+                u'(%s) finished with status %d: %s' % (command, status, error[-2000:].decode('utf-8', 'replace').strip()))
+
+    def _rmtree(self, path):
+
+        if self.remote_commands:
+            try:
+                self._exec(u'rm -rf -- %s' % quote(path))
+                return
+            except IOError:
+                if self.remote_commands:
+                    raise
+                logger.info(u'Remote commands not available, removing (%s) through SFTP', path)
+
+        self._rmtree_sftp(path)
+
+    def _rmtree_sftp(self, path):
+
+        try:
+            entries = self.client.listdir_attr(path)
+        except IOError as e:
+            if self._interrupted(e):
+                raise
+            return
+
+        for entry in entries:
+            full_path = path + u'/' + entry.filename
+
+            if stat.S_ISDIR(entry.st_mode):
+                self._rmtree_sftp(full_path)
+            else:
+                self.client.remove(full_path)
+
+        self.client.rmdir(path)
@@ -0,0 +1,505 @@
+# coding: utf-8
+import logging
+import mmap
+import struct
+
+logger = logging.getLogger(__name__)
+
+MST_BLOCK_SIZE = 512
+MST_CONTROL_RECORD_LENGTH = 64
+MST_CONTROL_FORMAT = 'iiihhiiii'
+# Record leader layouts found in CISIS master files: packed (18 bytes) and
+# aligned, with two padding bytes after mfrl (20 bytes). Fields: mfn, mfrl,
+# mfbwb, mfbwp, base, nvf, status.
+MST_LEADER_FORMATS = [
+    (u'packed', 'ihihhhh'),
+    (u'aligned', 'ih2xihhhh'),
+]
+MST_DIRECTORY_FORMAT = 'HHH'
+MST_DIRECTORY_ENTRY_LENGTH = 6
+XRF_BLOCK_SIZE = 512
+XRF_POINTERS_PER_BLOCK = 127
+
+# CISIS breaks ISO 2709 records in lines of 80 characters.
+ISO_LINE_LENGTH = 80
+ISO_LEADER_LENGTH = 24
+ISO_DIRECTORY_ENTRY_LENGTH = 12
+ISO_FIELD_TERMINATOR = b'#'
+
+
+class IsoReader(object):
+    """
+    Iterates over the records of a CISIS ISO 2709 file, yielding each record
+    as a byte string without the line breaks.
+
+    newline keeps the line terminator found in the file, so records can be
+    written back in the same layout.
+    """
+
+    def __init__(self, fl):
+        self.fl = fl
+        self.newline = b'\n'
+
+    def __iter__(self):
+
+        record = b''
+        length = None
+
+        for line in self.fl:
+            content = line.rstrip(b'\r\n')
+
+            if not record and line[len(content):]:
+                self.newline = line[len(content):]
+
+            record += content
+
+            if length is None and len(record) >= 5:
+                length = int(record[:5])
+
+            if length is not None and len(record) >= length:
+                yield record[:length]
+                record = b''
+                length = None
+
+        if record.strip():
+            logger.warning(u'Incomplete ISO record discarded at the end of file')
+
+
+class IsoWriter(object):
+    """
+    Writes byte string records to a ISO 2709 file, breaking them in lines of
+    ISO_LINE_LENGTH characters as CISIS does.
+    """
+
+    def __init__(self, fl, newline=b'\n'):
+        self.fl = fl
+        self.newline = newline
+        self.count = 0
+
+    def write(self, record):
+
+        for i in range(0, len(record), ISO_LINE_LENGTH):
+            self.fl.write(record[i:i + ISO_LINE_LENGTH])
+            self.fl.write(self.newline)
+
+        self.count += 1
+
+
+def iso_fields(record):
+    """
+    Returns the fields of a ISO 2709 record as a list of (tag, value) tuples
+    in the order of the directory.
+    """
+
+    base = int(record[12:17])
+    directory = record[ISO_LEADER_LENGTH:base - 1]
+    fields = []
+
+    for i in range(0, len(directory), ISO_DIRECTORY_ENTRY_LENGTH):
+        entry = directory[i:i + ISO_DIRECTORY_ENTRY_LENGTH]
+        tag = int(entry[:3])
+        length = int(entry[3:7])
+        start = base + int(entry[7:12])
+        fields.append((tag, record[start:start + length - 1]))
+
+    return fields
+
+
+def iso_field(record, tag):
+    """
+    Returns the first occurrence of the field tag of a ISO 2709 record, or
+    None when the field is not present.
+    """
+
+    for field_tag, value in iso_fields(record):
+        if field_tag == tag:
+            return value
+
+
+def split_iso(fl, outputs, tag):
+    """
+    Reads the ISO file object fl once and routes each record to one of the
+    outputs according to the first occurrence of the field tag.
+
+    outputs: dict mapping the field value (case insensitive) to the binary
+    file object that will receive the records. Records with other values are
+    discarded.
+
+    Returns a dict with the number of records written to each output.
+    """
+
+    reader = IsoReader(fl)
+    writers = {}
+
+    for record in reader:
+        value = (iso_field(record, tag) or b'').strip().lower()
+        value = value.decode('ascii', 'replace')
+
+        if value not in outputs:
+            continue
+
+        if value not in writers:
+            writers[value] = IsoWriter(outputs[value], reader.newline)
+
+        writers[value].write(record)
+
+    return dict(
+        (value, writers[value].count if value in writers else 0)
+        for value in outputs
+    )
+
+
+class MasterFileError(ValueError):
+    pass
+
+
+def subfield(value, code):
+    """
+    Returns the content of the subfield code (^code) of a field value, or an
+    empty string when it is not present. The code * returns the content
+    before the first subfield delimiter, or the first subfield.
+    """
+
+    parts = value.split(b'^')
+
+    if code == b'*':
+        if parts[0] or len(parts) == 1:
+            return parts[0]
+        return parts[1][1:]
+
+    code = code.lower()
+
+    for part in parts[1:]:
+        if part[:1].lower() == code:
+            return part[1:]
+
+    return b''
+
+
+class Record(object):
+    """
+    ISIS record. fields is a list of (tag, value) tuples in the order of the
+    record directory, values are byte strings.
+    """
+
+    def __init__(self, mfn, fields, deleted=False):
+        self.mfn = mfn
+        self.fields = fields
+        self.deleted = deleted
+
+    def get(self, tag):
+        """
+        Returns the list of occurrences of the field tag.
+        """
+
+        return [value for field_tag, value in self.fields if field_tag == tag]
+
+    def first(self, tag, default=b''):
+        """
+        Returns the first occurrence of the field tag.
+        """
+
+        for field_tag, value in self.fields:
+            if field_tag == tag:
+                return value
+
+        return default
+
+
+class MasterFile(object):
+    """
+    Memory mapped reader for ISIS master files.
+
+    path is the database path without extension, the .mst and .xrf files
+    must be available. The byte order and the record leader layout are
+    detected from the file content.
+
+    with MasterFile('bases/issue/issue') as master:
+        for record in master:
+            print(record.first(35))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._files = []
+        self._mst = self._map(path + u'.mst')
+        self._xrf = self._map(path + u'.xrf')
+
+        if len(self._mst) < MST_CONTROL_RECORD_LENGTH:
+            self.close()
+            raise MasterFileError(u'Invalid master file (%s)' % path)
+
+        self._detect()
+
+    def _map(self, path):
+
+        fl = open(path, 'rb')
+        self._files.append(fl)
+
+        try:
+            return mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return b''
+
+    def _detect(self):
+
+        for byteorder in ('<', '>'):
+            control = struct.unpack_from(
+                byteorder + MST_CONTROL_FORMAT, self._mst, 0)
+
+            if control[0] != 0 or control[1] < 1:
+                continue
+
+            self.byteorder = byteorder
+            self.next_mfn = control[1]
+            self.mftype = control[4]
+
+            for layout, leader_format in MST_LEADER_FORMATS:
+                self.layout = layout
+                self._leader_format = byteorder + leader_format
+                self._leader_length = struct.calcsize(self._leader_format)
+
+                if self.next_mfn == 1:
+                    return
+
+                if len(self._mst) < MST_CONTROL_RECORD_LENGTH + self._leader_length:
+                    continue
+
+                leader = struct.unpack_from(
+                    self._leader_format, self._mst, MST_CONTROL_RECORD_LENGTH)
+                mfn, mfrl, mfbwb, mfbwp, base, nvf, status = leader
+
+                if mfn >= 1 and nvf >= 0 and base == self._leader_length + nvf * MST_DIRECTORY_ENTRY_LENGTH:
+                    return
+
+        raise MasterFileError(u'Unknown master file layout (%s)' % self.path)
+
+    def position(self, mfn):
+        """
+        Returns (offset, deleted) for the record mfn according to the cross
+        reference file. offset is None when the record does not exist.
+        """
+
+        block, slot = divmod(mfn - 1, XRF_POINTERS_PER_BLOCK)
+        offset = block * XRF_BLOCK_SIZE + 4 + slot * 4
+
+        if mfn < 1 or offset + 4 > len(self._xrf):
+            return None, False
+
+        pointer = struct.unpack_from(self.byteorder + 'i', self._xrf, offset)[0]
+        deleted = pointer < 0
+        pointer = abs(pointer)
+        mfb, mfp = pointer >> 11, pointer & 0x1FF
+
+        if mfb == 0:
+            return None, deleted
+
+        return (mfb - 1) * MST_BLOCK_SIZE + mfp, deleted
+
+    def read(self, offset):
+        """
+        Reads the record stored at offset in the master file.
+        """
+
+        leader = struct.unpack_from(self._leader_format, self._mst, offset)
+        mfn, mfrl, mfbwb, mfbwp, base, nvf, status = leader
+
+        directory_format = self.byteorder + MST_DIRECTORY_FORMAT
+        fields = []
+
+        for i in range(nvf):
+            tag, pos, length = struct.unpack_from(
+                directory_format,
+                self._mst,
+                offset + self._leader_length + i * MST_DIRECTORY_ENTRY_LENGTH
+            )
+            start = offset + base + pos
+            fields.append((tag, self._mst[start:start + length]))
+
+        return Record(mfn, fields, deleted=status != 0)
+
+    def record(self, mfn):
+        """
+        Returns the record mfn, or None when it does not exist.
+        """
+
+        offset, deleted = self.position(mfn)
+
+        if offset is None:
+            return None
+
+        record = self.read(offset)
+        record.deleted = record.deleted or deleted
+
+        return record
+
+    def records(self, deleted=False):
+        """
+        Iterates over the records in mfn order. Logically deleted records are
+        skipped unless deleted is True.
+        """
+
+        for mfn in range(1, self.next_mfn):
+            record = self.record(mfn)
+
+            if record is None or (record.deleted and not deleted):
+                continue
+
+            yield record
+
+    def __iter__(self):
+
+        return self.records()
+
+    def close(self):
+
+        for data in (getattr(self, '_mst', None), getattr(self, '_xrf', None)):
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        for fl in self._files:
+            fl.close()
+
+        self._files = []
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+        return False
+
+
+def write_master(records, mst_output, xrf_output, layout=u'packed',
+                 byteorder='<', next_mfn=1, mftype=0):
+    """
+    Writes an ISIS master file and its cross reference file.
+
+    records: iterable of Record in mfn order. Missing mfns are written as
+    physically deleted and records flagged as deleted as logically deleted.
+    mst_output, xrf_output: binary file objects, mst_output must be seekable
+    since the control record is written at the end.
+    layout: record leader layout, packed or aligned.
+    byteorder: < for little endian or > for big endian.
+    next_mfn: minimum next mfn of the control record.
+    """
+
+    leader_format = byteorder + dict(MST_LEADER_FORMATS)[layout]
+    leader_length = struct.calcsize(leader_format)
+    directory_format = byteorder + MST_DIRECTORY_FORMAT
+
+    mst_output.write(b'\0' * MST_CONTROL_RECORD_LENGTH)
+    offset = MST_CONTROL_RECORD_LENGTH
+    pointers = []
+
+    for record in records:
+        pointers.extend([-1] * (record.mfn - 1 - len(pointers)))
+
+        # the leader of a record never crosses a block boundary
+        if offset % MST_BLOCK_SIZE + leader_length > MST_BLOCK_SIZE:
+            padding = MST_BLOCK_SIZE - offset % MST_BLOCK_SIZE
+            mst_output.write(b'\0' * padding)
+            offset += padding
+
+        directory = []
+        data = []
+        position = 0
+        for tag, value in record.fields:
+            directory.append(
+                struct.pack(directory_format, tag, position, len(value)))
+            data.append(value)
+            position += len(value)
+
+        if position % 2:
+            data.append(b' ')
+
+        base = leader_length + len(record.fields) * MST_DIRECTORY_ENTRY_LENGTH
+        mfrl = base + position + position % 2
+
+        try:
+            leader = struct.pack(
+                leader_format, record.mfn, mfrl, 0, 0, base,
+                len(record.fields), 1 if record.deleted else 0
+            )
+        except struct.error:
+            raise MasterFileError(
+                u'Record %d is too large for the master file format' % record.mfn)
+
+        mst_output.write(leader)
+        mst_output.write(b''.join(directory))
+        mst_output.write(b''.join(data))
+
+        pointer = (offset // MST_BLOCK_SIZE + 1) * 2048 + offset % MST_BLOCK_SIZE
+        pointers.append(-pointer if record.deleted else pointer)
+        offset += mfrl
+
+    pointers.extend([-1] * (next_mfn - 1 - len(pointers)))
+
+    if offset % MST_BLOCK_SIZE:
+        mst_output.write(b'\0' * (MST_BLOCK_SIZE - offset % MST_BLOCK_SIZE))
+
+    mst_output.seek(0)
+    mst_output.write(struct.pack(
+        byteorder + MST_CONTROL_FORMAT,
+        0,
+        len(pointers) + 1,
+        offset // MST_BLOCK_SIZE + 1,
+        offset % MST_BLOCK_SIZE,
+        mftype,
+        0, 0, 0, 0
+    ))
+
+    blocks = max(1, -(-len(pointers) // XRF_POINTERS_PER_BLOCK))
+    for block in range(blocks):
+        chunk = pointers[block * XRF_POINTERS_PER_BLOCK:(block + 1) * XRF_POINTERS_PER_BLOCK]
+        chunk.extend([0] * (XRF_POINTERS_PER_BLOCK - len(chunk)))
+        xrxrpos = -(block + 1) if block == blocks - 1 else block + 1
+        xrf_output.write(struct.pack(
+            byteorder + 'i%di' % XRF_POINTERS_PER_BLOCK, xrxrpos, *chunk))
+
+
+def convert_master(input_path, output_path, layout=None, byteorder=None):
+    """
+    Rewrites the ISIS database input_path as output_path (paths without
+    extension), in process, as a replacement of crunchmf.
+
+    By default the record leader layout is switched between packed and
+    aligned and the byte order is kept. Only the current version of each
+    record is written, so the output is also compacted.
+
+    Returns a tuple (layout, byteorder) with the format written.
+    """
+
+    with MasterFile(input_path) as master:
+        if layout is None:
+            layout = u'aligned' if master.layout == u'packed' else u'packed'
+
+        if byteorder is None:
+            byteorder = master.byteorder
+
+        logger.debug(
+            u'Converting %s from %s %s to %s %s',
+            input_path,
+            master.layout,
+            master.byteorder,
+            layout,
+            byteorder
+        )
+
+        with open(output_path + u'.mst', 'wb') as mst:
+            with open(output_path + u'.xrf', 'wb') as xrf:
+                write_master(
+                    master.records(deleted=True),
+                    mst,
+                    xrf,
+                    layout,
+                    byteorder,
+                    master.next_mfn,
+                    master.mftype
+                )
+
+    return layout, byteorder
@@ -0,0 +1,146 @@
+# coding: utf-8
+import hashlib
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = u"""
+CREATE TABLE IF NOT EXISTS transfers (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    md5 TEXT,
+    PRIMARY KEY (host, path)
+)
+"""
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+
+    digest = hashlib.md5()
+
+    with open(path, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    Local record of the files already sent to a server.
+
+    Each entry is keyed by the destination host and the remote path and keeps
+    the size, the modification time and the md5 of the file that was sent.
+    Entries rebuilt from a remote listing have no md5 and keep the remote
+    modification time.
+    """
+
+    # Number of writes kept in the current transaction before committing.
+    commit_interval = 500
+
+    def __init__(self, filepath, host):
+        self.filepath = filepath
+        self.host = host
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+
+    def get(self, path):
+        """
+        Returns a tuple (size, mtime, md5) for the remote path or None when
+        the path is not in the manifest.
+        """
+
+        with self._lock:
+            cursor = self._conn.execute(
+                u'SELECT size, mtime, md5 FROM transfers WHERE host=? AND path=?',
+                (self.host, path)
+            )
+            return cursor.fetchone()
+
+    def update(self, path, size, mtime, md5=None):
+
+        with self._lock:
+            self._conn.execute(
+                u'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?)',
+                (self.host, path, size, int(mtime), md5)
+            )
+            self._written()
+
+    def remove(self, path):
+
+        with self._lock:
+            self._conn.execute(
+                u'DELETE FROM transfers WHERE host=? AND path=?',
+                (self.host, path)
+            )
+            self._written()
+
+    def remove_tree(self, path):
+        """
+        Removes the entries of every file under the remote directory path.
+        """
+
+        prefix = path.rstrip(u'/') + u'/'
+
+        with self._lock:
+            self._conn.execute(
+                u'DELETE FROM transfers WHERE host=? AND substr(path, 1, ?)=?',
+                (self.host, len(prefix), prefix)
+            )
+            self._written()
+
+    def unchanged(self, from_fl, to_fl, local):
+        """
+        Checks the local file against the manifest entry of to_fl. local is
+        the os.stat result of from_fl.
+
+        The file is unchanged when the sizes are equal and it was not modified
+        after the recorded time. A file touched without changes is recognized
+        through its md5, and its entry is refreshed.
+        """
+
+        entry = self.get(to_fl)
+
+        if entry is None:
+            return False
+
+        size, mtime, md5 = entry
+
+        if size != local.st_size:
+            return False
+
+        if int(local.st_mtime) <= mtime:
+            return True
+
+        if md5 and md5 == file_md5(from_fl):
+            self.update(to_fl, size, local.st_mtime, md5)
+            return True
+
+        return False
+
+    def commit(self):
+
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+
+        self.commit()
+        self._conn.close()
+        logger.debug(u'Manifest saved (%s)', self.filepath)
+
+    def _written(self):
+
+        self._pending += 1
+
+        if self._pending >= self.commit_interval:
+            self._conn.commit()
+            self._pending = 0
@@ -0,0 +1,469 @@
+# coding: utf-8
+"""
+Instrumentation of the delivery runs.
+
+Every measured operation (a remote put, mkdir, chdir, a database conversion,
+an ISO export, a report) is recorded in a registry with its latency, bytes
+and errors, by phase (databases, images, pdfs, translations, xmls, isos,
+reports) and scilista issue. The registry is dumped as JSON or as a
+Prometheus textfile at the end of the run.
+"""
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Phase of a path by the SciELO site layout, the groups of the per issue
+# patterns are the journal acronym and the issue label. The first match wins.
+PATH_PHASES = [
+    (u'databases', re.compile(u'/serial/([^/]+)/([^/]+)/base(/|$)')),
+    (u'images', re.compile(u'/htdocs/img/revistas/([^/]+)/([^/]+)(/|$)')),
+    (u'pdfs', re.compile(u'/bases/pdf/([^/]+)/([^/]+)(/|$)')),
+    (u'translations', re.compile(u'/bases/translation/([^/]+)/([^/]+)(/|$)')),
+    (u'xmls', re.compile(u'/bases/xml/([^/]+)/([^/]+)(/|$)')),
+    (u'databases', re.compile(u'/serial/')),
+    (u'isos', re.compile(u'\\.iso(\\.gz)?$')),
+    (u'reports', re.compile(u'/static_[^/]+\\.txt$')),
+]
+
+
+def path_labels(path):
+    """
+    Returns (phase, issue) of a local or remote site path, issue is empty for
+    the paths not belonging to a scilista issue. Returns None for unknown
+    paths.
+    """
+
+    path = u'/' + path.replace(u'\\', u'/').lstrip(u'/')
+
+    for phase, pattern in PATH_PHASES:
+        match = pattern.search(path)
+        if not match:
+            continue
+        if pattern.groups > 1:
+            return phase, u'%s %s' % (match.group(1), match.group(2))
+        return phase, u''
+
+    return None
+
+
+class Series(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds, size=0, error=False):
+
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += size
+
+        if error:
+            self.errors += 1
+
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def merge(self, other):
+
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def cumulative(self):
+
+        total = 0
+        result = []
+
+        for value in self.buckets:
+            total += value
+            result.append(total)
+
+        return result
+
+    def as_dict(self):
+
+        return {
+            u'count': self.count,
+            u'errors': self.errors,
+            u'bytes': self.bytes,
+            u'seconds': round(self.seconds, 6),
+            u'buckets': dict(
+                (str(bound), value) for bound, value in zip(BUCKETS, self.cumulative())
+            )
+        }
+
+
+class Metrics(object):
+    """
+    Thread safe registry of the measured operations, keyed by (operation,
+    phase, issue).
+
+    The phase and issue of an operation come from the path it handles, see
+    path_labels, or else from the labels set for the current thread with
+    labels().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._series = {}
+        self.started = time.time()
+
+    @contextmanager
+    def labels(self, phase=u'', issue=u''):
+        """
+        Labels the operations run by the current thread inside the block.
+        """
+
+        previous = getattr(self._local, 'labels', None)
+        self._local.labels = (phase, issue)
+
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    def _labels(self, path=None, phase=None):
+
+        if phase is not None:
+            return phase, u''
+
+        labels = path_labels(path) if path else None
+
+        return labels or getattr(self._local, 'labels', None) or (u'', u'')
+
+    def observe(self, operation, seconds, size=0, error=False, path=None, phase=None):
+        """
+        Records one operation. The labels come from phase when given, else
+        from path, else from the labels of the current thread.
+        """
+
+        phase, issue = self._labels(path, phase)
+        key = (operation, phase, issue)
+
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = Series()
+            self._series[key].observe(seconds, size, error)
+
+    @contextmanager
+    def timer(self, operation, path=None):
+        """
+        Measures the block as one operation, an exception counts as an error.
+        """
+
+        start = time.time()
+
+        try:
+            yield
+        except Exception:
+            self.observe(operation, time.time() - start, error=True, path=path)
+            raise
+
+        self.observe(operation, time.time() - start, path=path)
+
+    def timed(self, operation, path_arg=None, failed=None, phase=None):
+        """
+        Decorator measuring every call of the function as operation.
+        path_arg is the position of the argument holding the path used to
+        label the call, phase labels every call. failed(result) tells whether
+        the returned value means an error.
+        """
+
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                path = args[path_arg] if path_arg is not None and len(args) > path_arg else None
+                start = time.time()
+                error = True
+
+                try:
+                    result = function(*args, **kwargs)
+                    error = bool(failed and failed(result))
+                    return result
+                finally:
+                    self.observe(
+                        operation,
+                        time.time() - start,
+                        error=error,
+                        path=path,
+                        phase=phase
+                    )
+
+            return wrapper
+
+        return decorator
+
+    def instrument(self, client):
+        """
+        Measures the put, putfo, mkdir and chdir calls of a communicator. put
+        and putfo count the bytes sent.
+        """
+
+        for name in (u'put', u'mkdir', u'chdir'):
+            setattr(client, name, self._wrap(client, name))
+
+        setattr(client, u'putfo', self._wrap_putfo(client))
+
+        return client
+
+    def _wrap(self, client, name):
+
+        method = getattr(client, name)
+
+        @functools.wraps(method)
+        def wrapper(path, *args, **kwargs):
+            # put(from_fl, to_fl): rotulos e bytes vem do destino e da origem
+            target = args[0] if name == u'put' and args else path
+            before = client.sent_bytes
+            start = time.time()
+            error = True
+
+            try:
+                result = method(path, *args, **kwargs)
+                error = name == u'put' and not result
+                return result
+            finally:
+                self.observe(
+                    name,
+                    time.time() - start,
+                    size=client.sent_bytes - before,
+                    error=error,
+                    path=target
+                )
+
+        return wrapper
+
+    def _wrap_putfo(self, client):
+
+        method = client.putfo
+
+        @functools.wraps(method)
+        def wrapper(fl, to_fl):
+            before = client.sent_bytes
+            start = time.time()
+            error = True
+
+            try:
+                result = method(fl, to_fl)
+                error = not result
+                return result
+            finally:
+                self.observe(
+                    u'putfo',
+                    time.time() - start,
+                    size=client.sent_bytes - before,
+                    error=error,
+                    path=to_fl
+                )
+
+        return wrapper
+
+    def series(self):
+
+        with self._lock:
+            return dict(
+                (key, series) for key, series in self._series.items())
+
+    def summary(self):
+        """
+        Returns a dict with every series and the totals by operation, phase
+        and issue.
+        """
+
+        series = self.series()
+        totals = {u'operation': {}, u'phase': {}, u'issue': {}}
+
+        for (operation, phase, issue), item in series.items():
+            for group, value in ((u'operation', operation), (u'phase', phase), (u'issue', issue)):
+                if not value:
+                    continue
+                totals[group].setdefault(value, Series()).merge(item)
+
+        return {
+            u'started': self.started,
+            u'elapsed': round(time.time() - self.started, 3),
+            u'series': [
+                dict(item.as_dict(), operation=operation, phase=phase, issue=issue)
+                for (operation, phase, issue), item in sorted(series.items())
+            ],
+            u'totals': dict(
+                (group, dict((key, value.as_dict()) for key, value in values.items()))
+                for group, values in totals.items()
+            )
+        }
+
+    def log(self):
+        """
+        Logs the totals by operation and phase as JSON.
+        """
+
+        totals = self.summary()[u'totals']
+
+        for group in (u'operation', u'phase'):
+            logger.info(
+                u'Metrics by %s: %s',
+                group,
+                json.dumps(dict(
+                    (key, dict((name, value[name]) for name in (u'count', u'errors', u'bytes', u'seconds')))
+                    for key, value in totals[group].items()
+                ), sort_keys=True)
+            )
+
+    def emit(self, json_path=None, prometheus_path=None, by_issue=False):
+        """
+        Logs the totals and writes the JSON summary and the Prometheus
+        textfile when their paths are given. Failures are logged, the metrics
+        never fail a delivery.
+        """
+
+        self.log()
+
+        try:
+            if json_path:
+                self.write_json(json_path)
+            if prometheus_path:
+                self.write_prometheus(prometheus_path, by_issue)
+        except (IOError, OSError) as e:
+            logger.error(u'Fail while writing metrics: %s', e)
+
+    def write_json(self, path):
+
+        logger.info(u'Writing metrics summary (%s)', path)
+
+        _write_atomic(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path, by_issue=False):
+        """
+        Writes the metrics in the Prometheus text format, to be collected by
+        the node_exporter textfile collector. The issue label is left out
+        unless by_issue is set, it has one value per scilista issue.
+        """
+
+        logger.info(u'Writing Prometheus metrics (%s)', path)
+
+        merged = {}
+
+        for (operation, phase, issue), item in self.series().items():
+            key = (operation, phase, issue if by_issue else u'')
+            merged.setdefault(key, Series()).merge(item)
+
+        lines = [
+            u'# HELP paperboy_operation_seconds Latency of the delivery operations.',
+            u'# TYPE paperboy_operation_seconds histogram'
+        ]
+        counters = []
+
+        for key, item in sorted(merged.items()):
+            labels = _prometheus_labels(key, by_issue)
+
+            for bound, value in zip(BUCKETS, item.cumulative()):
+                lines.append(u'paperboy_operation_seconds_bucket{%s,le="%s"} %d' % (labels, bound, value))
+
+            lines.append(u'paperboy_operation_seconds_bucket{%s,le="+Inf"} %d' % (labels, item.count))
+            lines.append(u'paperboy_operation_seconds_sum{%s} %.6f' % (labels, item.seconds))
+            lines.append(u'paperboy_operation_seconds_count{%s} %d' % (labels, item.count))
+            counters.append((labels, item))
+
+        lines.append(u'# HELP paperboy_operation_errors_total Failed delivery operations.')
+        lines.append(u'# TYPE paperboy_operation_errors_total counter')
+        for labels, item in counters:
+            lines.append(u'paperboy_operation_errors_total{%s} %d' % (labels, item.errors))
+
+        lines.append(u'# HELP paperboy_operation_bytes_total Bytes sent by the delivery operations.')
+        lines.append(u'# TYPE paperboy_operation_bytes_total counter')
+        for labels, item in counters:
+            lines.append(u'paperboy_operation_bytes_total{%s} %d' % (labels, item.bytes))
+
+        lines.append(u'# HELP paperboy_last_run_timestamp_seconds End of the last delivery run.')
+        lines.append(u'# TYPE paperboy_last_run_timestamp_seconds gauge')
+        lines.append(u'paperboy_last_run_timestamp_seconds %.3f' % time.time())
+
+        _write_atomic(path, u'\n'.join(lines) + u'\n')
+
+
+def _prometheus_labels(key, by_issue):
+
+    operation, phase, issue = key
+    labels = [(u'operation', operation), (u'phase', phase)]
+
+    if by_issue:
+        labels.append((u'issue', issue))
+
+    return u','.join(
+        u'%s="%s"' % (name, value.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+        for name, value in labels
+    )
+
+
+def _write_atomic(path, content):
+    """
+    Writes content to a temporary file renamed to path, so readers never
+    see a partial file.
+    """
+
+    tmp = path + u'.tmp'
+
+    with io.open(tmp, 'w', encoding='utf-8') as fl:
+        fl.write(content if isinstance(content, type(u'')) else content.decode('utf-8'))
+
+    os.rename(tmp, path)
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    Runs the block under cProfile and dumps the stats to path, readable by
+    pstats or snakeviz. Only the calling thread is profiled, upload workers
+    and issue jobs show as time spent waiting for them. Does nothing when
+    path is empty.
+    """
+
+    if not path:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+        output = StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(20)
+        logger.info(u'Profile saved (%s), top functions:\n%s', path, output.getvalue())
+
+
+# Registry of the current process, one delivery run per process.
+registry = Metrics()
@@ -0,0 +1,274 @@
+# coding: utf-8
+"""
+Transfer plan of a delivery: the remote directories to create and the files
+to send, with their local size and modification time, built before any
+connection is opened.
+
+The history file keeps the throughput of the previous runs, as JSON lines,
+to estimate the duration of a plan.
+"""
+import io
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from paperboy.utils import walk_entries
+
+logger = logging.getLogger(__name__)
+
+# action: put (copy of local), convert (database converted before sent),
+# iso (extracted by mx from the local master, size estimated), report
+Job = namedtuple('Job', ['local', 'remote', 'size', 'mtime', 'action'])
+
+
+class Plan(object):
+    """
+    Directories are kept parents first, each one once. Jobs added with first
+    (scilista, databases) are sent before the others, in the order they were
+    added. ordered() returns the other jobs larger files first, so the long
+    transfers start early and the upload workers are not left waiting for
+    one big file at the end, unless larger_first is False.
+    """
+
+    def __init__(self, destiny_dir, larger_first=True):
+        self.destiny_dir = destiny_dir
+        self.larger_first = larger_first
+        self.directories = []
+        self.base_paths = []
+        self._known = set()
+        self._first = []
+        self._others = []
+
+    @property
+    def jobs(self):
+
+        return self._first + self._others
+
+    @property
+    def files(self):
+
+        return len(self._first) + len(self._others)
+
+    @property
+    def size(self):
+
+        return sum(job.size for job in self.jobs)
+
+    def add_directory(self, path):
+        """
+        Adds a remote directory and its missing parents below destiny_dir.
+        """
+
+        if path in self._known:
+            return
+
+        parent = path.rsplit(u'/', 1)[0]
+
+        if parent != path and len(parent) > len(self.destiny_dir):
+            self.add_directory(parent)
+
+        self._known.add(path)
+        self.directories.append(path)
+
+    def add(self, local, remote, size, mtime, action=u'put', first=False):
+
+        job = Job(local, remote, size, mtime, action)
+
+        if first:
+            self._first.append(job)
+        else:
+            self._others.append(job)
+
+    def scan(self, source_dir, base_path, extensions=None, action=u'put',
+             first=False):
+        """
+        Adds the tree of source_dir/base_path, sent to destiny_dir/base_path.
+        extensions restricts the files to the given extensions (mst, xrf).
+        """
+
+        source = source_dir + u'/' + base_path
+        remote = self.destiny_dir + u'/' + base_path
+
+        self.add_directory(remote)
+        self.base_paths.append((source_dir, base_path))
+
+        if not os.path.isdir(source):
+            return
+
+        for relative, entry in walk_entries(source):
+            relative = relative.replace(u'\\', u'/')
+
+            # links para diretorios sao criados mas nao percorridos, como no os.walk
+            if entry.is_dir():
+                self.add_directory(remote + u'/' + relative)
+                continue
+
+            if extensions and entry.name[-3:].lower() not in extensions:
+                continue
+
+            try:
+                local = entry.stat()
+            except OSError as e:
+                logger.warning(u'Fail while reading file (%s): %s', entry.path, e)
+                continue
+
+            self.add(
+                entry.path.replace(u'\\', u'/'),
+                remote + u'/' + relative,
+                local.st_size,
+                local.st_mtime,
+                action,
+                first
+            )
+
+    def ordered(self):
+
+        if not self.larger_first:
+            return self.jobs
+
+        return self._first + sorted(
+            self._others, key=lambda job: job.size, reverse=True)
+
+    def log(self):
+
+        logger.info(
+            u'Transfer plan: %d files, %.2f MB, %d directories',
+            self.files,
+            self.size / 1048576.0,
+            len(self.directories)
+        )
+
+    def dump(self):
+        """
+        Logs the whole plan, in the order it is sent.
+        """
+
+        self.log()
+
+        for directory in self.directories:
+            logger.info(u'mkdir %s', directory)
+
+        for job in self.ordered():
+            logger.info(u'%s %s %s (%d bytes)', job.action, job.local, job.remote, job.size)
+
+    def export(self, path):
+        """
+        Writes the plan as JSON lines, the directories followed by the jobs
+        in the order they are sent.
+        """
+
+        logger.info(u'Exporting transfer plan (%s)', path)
+
+        with io.open(path, 'w', encoding='utf-8') as fl:
+            for directory in self.directories:
+                fl.write(_json_line({u'action': u'mkdir', u'remote': directory}))
+
+            for job in self.ordered():
+                fl.write(_json_line(dict(zip(job._fields, job))))
+
+    def estimate(self, history, key):
+        """
+        Logs the duration of the plan estimated from the previous runs
+        recorded in history for key. Returns the seconds or None.
+        """
+
+        seconds, runs = estimate(history, key, self.files, self.size)
+
+        if seconds is None:
+            logger.info(u'No previous runs recorded for %s, duration not estimated', key)
+            return None
+
+        logger.info(
+            u'Estimated duration: %d seconds (%.1f minutes), from %d previous runs',
+            seconds,
+            seconds / 60.0,
+            runs
+        )
+
+        return seconds
+
+
+def _json_line(data):
+
+    return type(u'')(json.dumps(data, sort_keys=True)) + u'\n'
+
+
+def record_run(history, key, files, size, seconds):
+    """
+    Appends the files, bytes and seconds of a finished run to the history
+    file.
+    """
+
+    logger.info(u'Recording run throughput (%s)', history)
+
+    try:
+        with io.open(history, 'a', encoding='utf-8') as fl:
+            fl.write(_json_line({
+                u'key': key,
+                u'files': files,
+                u'bytes': size,
+                u'seconds': round(seconds, 3),
+                u'finished': time.time()
+            }))
+    except (IOError, OSError) as e:
+        logger.error(u'Fail while recording run throughput (%s): %s', history, e)
+
+
+def _runs(history, key, last):
+
+    runs = []
+
+    try:
+        with io.open(history, encoding='utf-8') as fl:
+            for line in fl:
+                try:
+                    run = json.loads(line)
+                except ValueError:
+                    continue
+                if run.get(u'key') == key and run.get(u'seconds', 0) > 0:
+                    runs.append(run)
+    except (IOError, OSError):
+        return []
+
+    return runs[-last:]
+
+
+def estimate(history, key, files, size, last=20):
+    """
+    Estimates the seconds needed to send files totaling size bytes, as
+    size / bandwidth + files * cost per file, fitted by least squares on the
+    last runs recorded for key. With a single run, or when the fit is not
+    meaningful, the average throughput is used. Returns (seconds, runs).
+    """
+
+    runs = _runs(history, key, last) if history else []
+
+    if not runs:
+        return None, 0
+
+    sbb = sum(float(run[u'bytes']) ** 2 for run in runs)
+    sff = sum(float(run[u'files']) ** 2 for run in runs)
+    sbf = sum(float(run[u'bytes']) * run[u'files'] for run in runs)
+    sbt = sum(float(run[u'bytes']) * run[u'seconds'] for run in runs)
+    sft = sum(float(run[u'files']) * run[u'seconds'] for run in runs)
+    det = sbb * sff - sbf * sbf
+
+    if det > 1e-9 * sbb * sff:
+        per_byte = (sbt * sff - sft * sbf) / det
+        per_file = (sft * sbb - sbt * sbf) / det
+        if per_byte >= 0 and per_file >= 0:
+            return per_byte * size + per_file * files, len(runs)
+
+    seconds = sum(run[u'seconds'] for run in runs)
+    total_bytes = sum(run[u'bytes'] for run in runs)
+    total_files = sum(run[u'files'] for run in runs)
+
+    if total_bytes:
+        return seconds * size / float(total_bytes), len(runs)
+
+    if total_files:
+        return seconds * files / float(total_files), len(runs)
+
+    return None, len(runs)
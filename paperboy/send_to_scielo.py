@@ -1,15 +1,48 @@
 # coding: utf-8
 import argparse
+import errno
+import fnmatch
+import gzip
+import io
 import logging
 import logging.config
 import os
+import re
+import shutil
 import subprocess
-
-from paperboy.utils import settings
-from paperboy.communicator import SFTP, FTP
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from paperboy.utils import settings, fsencode, walk_entries
+from paperboy.communicator import SFTP, FTP, client_options, server_port
+from paperboy.isis import split_iso, subfield, MasterFile, MasterFileError
+from paperboy.transfer import GzipReader
+from paperboy.metrics import registry, profiled
+from paperboy.plan import Plan, record_run
 
 logger = logging.getLogger(__name__)
 
+# Record type field of the artigo database and the ISO files receiving each
+# record type on the single pass extraction.
+ARTIGO_TYPE_TAG = 706
+ARTIGO_SPLIT = [
+    (u'i', u'/bases/issue/issues.iso', u'issues.iso'),
+    (u'h', u'/bases/artigo/artigo.iso', u'artigo.iso'),
+    (u'c', u'/bases/artigo/bib4cit.iso', u'bib4cit.iso'),
+]
+# Applies to the header records the same field 91 transformation used when
+# extracting artigo.iso with the TP=H filter.
+ARTIGO_SPLIT_PROC = u"proc=if s(mpu,v706,mpl)='H' then 'd91<91 0>',ref(mfn-1,v91),'</91>' fi"
+
+# Static file reports: (directory inside bases, file extension, report name)
+STATIC_FILE_REPORTS = [
+    (u'pdf', u'pdf', u'pdf'),
+    (u'translation', u'htm', u'html'),
+    (u'xml', u'xml', u'xml'),
+]
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -44,11 +77,7 @@ def _config_logging(logging_level='INFO'):
     logging.config.dictConfig(LOGGING)
 
 
-def make_iso(mst_input, iso_output, cisis_dir=None, fltr=None, proc=None):
-
-    logger.info(u'Making iso for %s', mst_input)
-
-    status = '1'  # erro de acordo com stdout do CISIS
+def _mx_iso_command(mst_input, iso_output, cisis_dir=None, fltr=None, proc=None):
 
     command = [remove_last_slash(cisis_dir) + u'/mx' if cisis_dir else u'mx']
     command.append(mst_input)
@@ -61,6 +90,18 @@ def make_iso(mst_input, iso_output, cisis_dir=None, fltr=None, proc=None):
     command.append(u'-all')
     command.append(u'now')
 
+    return command
+
+
+@registry.timed(u'make_iso', phase=u'isos', failed=lambda status: not status)
+def make_iso(mst_input, iso_output, cisis_dir=None, fltr=None, proc=None):
+
+    logger.info(u'Making iso for %s', mst_input)
+
+    status = '1'  # erro de acordo com stdout do CISIS
+
+    command = _mx_iso_command(mst_input, iso_output, cisis_dir, fltr, proc)
+
     logger.debug(u'Running: %s', u' '.join(command))
     try:
         status = subprocess.call(command)
@@ -78,10 +119,217 @@ def make_iso(mst_input, iso_output, cisis_dir=None, fltr=None, proc=None):
     return False
 
 
-def make_section_catalog_report(source_dir, cisis_dir):
+class MxIsoStream(object):
+    """
+    Runs mx exporting the ISO to a named pipe, so the records can be read
+    while they are extracted and no ISO file is written to the local disk.
+
+    with MxIsoStream(mst_input, cisis_dir) as fl:
+        client.putfo(fl, to_fl)
+
+    Reading the end of the stream raises IOError when mx failed, so a
+    truncated ISO is never taken as complete. status is True after the block
+    when mx finished successfully. Named pipes are not available on Windows.
+    """
+
+    def __init__(self, mst_input, cisis_dir=None, fltr=None, proc=None):
+        self.mst_input = mst_input
+        self.cisis_dir = cisis_dir
+        self.fltr = fltr
+        self.proc = proc
+        self.status = False
+        self._process = None
+        self._returncode = None
+        self._finished = threading.Event()
+        self._tmp_dir = None
+        self._fl = None
+        self._closed = False
+        self._started = None
+
+    def __enter__(self):
+
+        logger.info(u'Streaming iso for %s', self.mst_input)
+
+        self._started = time.time()
+        self._tmp_dir = tempfile.mkdtemp(prefix=u'paperboy')
+        fifo = os.path.join(self._tmp_dir, u'iso')
+        os.mkfifo(fifo)
+
+        command = _mx_iso_command(
+            self.mst_input, fifo, self.cisis_dir, self.fltr, self.proc)
+
+        logger.debug(u'Running: %s', u' '.join(command))
+        try:
+            self._process = subprocess.Popen(command)
+        except OSError:
+            logger.error(u'Error while running mx, check if the command is available on the syspath, or the CISIS path was correctly indicated in the config file')
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            raise
+
+        watcher = threading.Thread(target=self._release, args=(fifo,))
+        watcher.daemon = True
+        watcher.start()
+
+        try:
+            self._fl = open(fifo, 'rb')
+        except BaseException:
+            self._closed = True
+            self._process.kill()
+            self._finished.wait()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            raise
+
+        return self
+
+    def read(self, size=-1):
+
+        data = self._fl.read(size)
+
+        if not data and size != 0:
+            self._check()
+
+        return data
+
+    def __iter__(self):
+
+        for line in self._fl:
+            yield line
+
+        self._check()
+
+    def _check(self):
+
+        self._finished.wait()
+
+        if self._returncode != 0:
+            raise IOError(
+                u'mx finished with status %s for %s' % (self._returncode, self.mst_input))
+
+    def _release(self, fifo):
+        """
+        Opens the pipe for writing once mx finishes, so the reader is not kept
+        waiting forever when mx fails before opening it. When mx finishes
+        before the reader is attached, the open is retried until it is.
+        """
+
+        self._returncode = self._process.wait()
+        self._finished.set()
+
+        # sem leitor a abertura falha com ENXIO, repetida ate o leitor abrir
+        # o pipe ou desistir dele
+        while not self._closed:
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                return
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    return
+            time.sleep(0.01)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._closed = True
+        self._fl.close()
+
+        if exc_type is not None and self._process.poll() is None:
+            self._process.kill()
+
+        self._finished.wait()
+        self.status = self._returncode == 0
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        registry.observe(
+            u'make_iso', time.time() - self._started, error=not self.status, phase=u'isos')
+
+        if self.status:
+            logger.debug(u'ISO streaming done for %s', self.mst_input)
+        else:
+            logger.error(u'ISO streaming did not work for %s', self.mst_input)
+
+        return False
+
+
+def _pft_val(value):
+    """
+    Numeric value of a string, as the val() PFT function.
+    """
+
+    match = re.search(br'[-+]?\d+(\.\d+)?', value)
+
+    return float(match.group(0)) if match else 0
+
+
+def section_catalog(records):
+    """
+    Yields the lines of static_section_catalog.txt for the records of the
+    issue database, as the PFT:
+
+    if p(v49) then (v35[1],v65[1]*0.4,s(f(val(s(v36[1]*4.3))+10000,2,0))*1.4,
+    '|',v49^l,'|',v49^c,'|',v49^t,/) fi
+    """
+
+    for record in records:
+        sections = record.get(49)
+
+        if not sections:
+            continue
+
+        order = u'%.0f' % (_pft_val(record.first(36)[4:7]) + 10000)
+        prefix = record.first(35) + record.first(65)[:4] + order[1:5].encode('ascii')
+
+        for section in sections:
+            yield b'|'.join([
+                prefix,
+                subfield(section, b'l'),
+                subfield(section, b'c'),
+                subfield(section, b't')
+            ]) + b'\n'
+
+
+@registry.timed(u'report', phase=u'reports')
+def make_section_catalog_report(source_dir, cisis_dir, output=None):
+    """
+    Makes static_section_catalog.txt reading the issue database in process.
+    mx is used only when the master file layout is not supported.
+
+    output: binary file object receiving the report. By default the report
+    is written to bases/reports/static_section_catalog.txt.
+    """
 
     logger.info(u'Making report static_section_catalog.txt')
 
+    report = source_dir + u'/bases/reports/static_section_catalog.txt'
+
+    try:
+        master = MasterFile(source_dir + u'/bases/issue/issue')
+    except MasterFileError as e:
+        logger.warning(u'%s, using mx to make the report', e)
+        _mx_section_catalog_report(source_dir, cisis_dir)
+        if output is not None and os.path.isfile(report):
+            with open(report, 'rb') as fl:
+                shutil.copyfileobj(fl, output)
+        return
+    except (IOError, OSError) as e:
+        logger.error(u'Error while creating report, static_section_catalog.txt was not updated: %s', e)
+        return
+
+    try:
+        with master:
+            if output is None:
+                if not os.path.isdir(os.path.dirname(report)):
+                    os.makedirs(os.path.dirname(report))
+                with io.open(report, 'wb') as fl:
+                    fl.writelines(section_catalog(master))
+            else:
+                output.writelines(section_catalog(master))
+    except (IOError, OSError) as e:
+        logger.error(u'Error while creating report, static_section_catalog.txt was not updated: %s', e)
+        return
+
+    logger.debug(u'Report static_section_catalog.txt done')
+
+
+def _mx_section_catalog_report(source_dir, cisis_dir):
+
     command = u"""mkdir -p %s/bases/reports; %s/mx %s/bases/issue/issue btell=0 "pft=if p(v49) then (v35[1],v65[1]*0.4,s(f(val(s(v36[1]*4.3))+10000,2,0))*1.4,'|',v49^l,'|',v49^c,'|',v49^t,/) fi" lw=0 -all now > %s/bases/reports/static_section_catalog.txt""" % (
         source_dir,
         cisis_dir,
@@ -100,33 +348,67 @@ def make_section_catalog_report(source_dir, cisis_dir):
     logger.debug(u'Report static_section_catalog.txt done')
 
 
-def make_static_file_report(source_dir, report):
+@registry.timed(u'report', phase=u'reports')
+def make_static_file_report(source_dir, report, output=None):
+    """
+    Lists the files under bases/<report> whose names match *.<extension>*,
+    one per line as ./<relative path>, like find . -name "*.<extension>*".
+
+    output: binary file object receiving the report. By default the report
+    is written to bases/reports/static_<report name>_files.txt.
+    """
 
     extension_name = 'htm' if report == 'translation' else report
     report_name = 'html' if report == 'translation' else report
 
     logger.info(u'Making report static_%s_files.txt', report_name)
 
-    command = u'mkdir -p %s/bases/%s; mkdir -p %s/bases/reports; cd %s/bases/%s; find . -name "*.%s*" > %s/bases/reports/static_%s_files.txt' %(
-        source_dir,
-        report,
-        source_dir,
-        source_dir,
-        report,
-        extension_name,
-        source_dir,
-        report_name
-    )
+    pattern = fsencode(u'*.%s*' % extension_name)
+    root = fsencode(source_dir + u'/bases/' + report)
 
-    logger.debug(u'Running: %s', command)
     try:
-        status = subprocess.Popen(command, shell=True)
-        status.wait()
-    except OSError:
-        logger.error(u'Error while creating report, static_%s_files.txt was not updated', report_name)
+        if output is None:
+            reports_dir = source_dir + u'/bases/reports'
+            if not os.path.isdir(reports_dir):
+                os.makedirs(reports_dir)
+            fl = io.open(
+                reports_dir + u'/static_%s_files.txt' % report_name, 'wb')
+        else:
+            fl = output
+
+        try:
+            if os.path.isdir(root):
+                for relative, entry in walk_entries(root):
+                    if fnmatch.fnmatchcase(entry.name, pattern):
+                        fl.write(b'./' + relative + b'\n')
+        finally:
+            if output is None:
+                fl.close()
+    except (IOError, OSError) as e:
+        logger.error(u'Error while creating report, static_%s_files.txt was not updated: %s', report_name, e)
+        return False
 
     logger.debug(u'Report static_%s_files.txt done', report_name)
 
+    return True
+
+
+def make_static_file_reports(source_dir, outputs=None):
+    """
+    Makes the pdf, html and xml static file reports, walking each of
+    bases/pdf, bases/translation and bases/xml once, with no find subprocess.
+
+    outputs: optional dict mapping the report name (pdf, html, xml) to the
+    binary file object receiving the report.
+    """
+
+    for report, extension_name, report_name in STATIC_FILE_REPORTS:
+        make_static_file_report(
+            source_dir,
+            report,
+            outputs[report_name] if outputs else None
+        )
+
 
 def remove_last_slash(path):
     path = path.replace('\\', '/')
@@ -140,21 +422,82 @@ def remove_last_slash(path):
 class Delivery(object):
 
     def __init__(self, source_type, cisis_dir, source_dir, destiny_dir, server,
-                 server_type, port, user, password, original_dataset):
+                 server_type, port, user, password, original_dataset, jobs=1,
+                 single_pass=False, stream=False, compress=False,
+                 resume_threshold=None, retries=3, retry_backoff=1,
+                 compression=u'off', window_size=None, max_packet_size=None,
+                 put_confirm=True):
 
         self.source_type = source_type
         self.cisis_dir = remove_last_slash(cisis_dir)
         self.source_dir = remove_last_slash(source_dir)
         self.destiny_dir = remove_last_slash(destiny_dir)
         self.original_dataset = bool(original_dataset)
+        self.jobs = int(jobs)
+        self.single_pass = single_pass
+        self.stream = stream
+        self.compress = compress
+
+        if self.stream and not hasattr(os, 'mkfifo'):
+            logger.warning(u'Streaming is not available in this operating system, ISO files will be written to the disk')
+            self.stream = False
 
         if str(server_type) == 'sftp':
-            self.client = SFTP(server, int(port), user, password)
+            self._communicator = SFTP
         elif str(server_type) == 'ftp':
-            self.client = FTP(server, int(port), user, password)
+            self._communicator = FTP
         else:
             raise TypeError(u'server_type must be ftp or sftp')
 
+        self._credentials = (server, server_port(server_type, port), user, password)
+        self._client_options = client_options(
+            resume_threshold=resume_threshold,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            compression=compression,
+            window_size=window_size,
+            max_packet_size=max_packet_size,
+            put_confirm=put_confirm
+        )
+        self.retries = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+        self.client = self._new_client()
+
+    def _new_client(self):
+
+        client = self._communicator(*self._credentials)
+
+        for name, value in self._client_options.items():
+            setattr(client, name, value)
+
+        return registry.instrument(client)
+
+    def _task_client(self):
+        """
+        Client used by a ISO task. Tasks running in parallel have their own
+        connection.
+        """
+
+        return self.client if self.jobs < 2 else self._new_client()
+
+    def _release_task_client(self, client):
+
+        if client is self.client:
+            return
+
+        client.close()
+
+        with self._lock:
+            self.retries += client.retries
+            self.sent_bytes += client.sent_bytes
+
+    def _destiny(self, destiny_name):
+
+        destiny = self.destiny_dir + u'/' + destiny_name
+
+        return destiny + u'.gz' if self.compress else destiny
+
     def _local_remove(self, path):
 
         logger.info(u'Removing temporary file (%s)', path)
@@ -169,6 +512,284 @@ class Delivery(object):
                 e.strerror
             )
 
+    def _iso_task(self, mst_input, iso_output, destiny_name, fltr=None, proc=None):
+
+        if self.stream:
+            return self._iso_stream_task(mst_input, destiny_name, fltr, proc)
+
+        def task():
+            make_iso(mst_input, iso_output, self.cisis_dir, fltr, proc)
+            return [(iso_output, destiny_name)]
+
+        return task
+
+    def _iso_stream_task(self, mst_input, destiny_name, fltr=None, proc=None):
+        """
+        Sends the ISO while mx extracts it, without writing it to the disk.
+        """
+
+        def task():
+            client = self._task_client()
+
+            try:
+                with MxIsoStream(mst_input, self.cisis_dir, fltr, proc) as fl:
+                    client.putfo(
+                        GzipReader(fl) if self.compress else fl,
+                        self._destiny(destiny_name)
+                    )
+            except (IOError, OSError):
+                pass
+            finally:
+                self._release_task_client(client)
+
+            return []
+
+        return task
+
+    def _open_split_outputs(self, client):
+        """
+        Opens the ISO files receiving the records of the artigo split.
+
+        In stream mode they are written straight to the server when the
+        protocol allows several files open at once, otherwise they are
+        written to the local disk and listed in to_send.
+
+        Files written to the server get a temporary name, renamed by
+        _publish_split_outputs once the split is done.
+
+        Returns (outputs, handles, to_send), handles must be closed in order
+        once the split is done. When a file can not be opened, the handles
+        already opened are closed before the error is raised.
+        """
+
+        outputs = {}
+        handles = []
+        to_send = []
+
+        try:
+            for record_type, iso_output, destiny_name in ARTIGO_SPLIT:
+                if self.stream:
+                    try:
+                        fl = client.open(
+                            self._destiny(destiny_name) + client.partial_suffix)
+                    except NotImplementedError:
+                        logger.info(u'Protocol does not allow several files open at once, %s will be written to the disk', destiny_name)
+                    else:
+                        if self.compress:
+                            handles.append(gzip.GzipFile(fileobj=fl, mode='wb'))
+                        handles.append(fl)
+                        outputs[record_type] = handles[-2] if self.compress else fl
+                        continue
+
+                fl = open(self.source_dir + iso_output, 'wb')
+                handles.append(fl)
+                outputs[record_type] = fl
+                to_send.append((self.source_dir + iso_output, destiny_name))
+        except BaseException:
+            # fecha o que ja foi aberto antes de propagar a falha
+            for handle in handles:
+                try:
+                    handle.close()
+                except Exception as e:
+                    logger.debug(u'Fail while closing split output: %s', e)
+            raise
+
+        return outputs, handles, to_send
+
+    def _publish_split_outputs(self, client, to_send, done):
+        """
+        Renames the ISO files written straight to the server by the artigo
+        split, or removes them when the split did not finish.
+        """
+
+        local = [destiny_name for iso_output, destiny_name in to_send]
+
+        for record_type, iso_output, destiny_name in ARTIGO_SPLIT:
+            if not self.stream or destiny_name in local:
+                continue
+
+            destiny = self._destiny(destiny_name)
+            part = destiny + client.partial_suffix
+
+            if done:
+                client.rename(part, destiny)
+            else:
+                client.remove(part)
+
+    def _artigo_split_task(self):
+        """
+        Extracts issues.iso, artigo.iso and bib4cit.iso reading the artigo
+        database only once. A single mx exports every record, split by the
+        record type (field 706) while it is read from a named pipe. Where
+        named pipes are not available (Windows) the records go through a
+        temporary ISO file.
+        """
+
+        mst_input = self.source_dir + u'/bases/artigo/artigo'
+        iso_all = self.source_dir + u'/bases/artigo/artigo_all.iso'
+
+        def task():
+            client = self._task_client()
+            done = False
+
+            try:
+                try:
+                    outputs, handles, to_send = self._open_split_outputs(client)
+                except client.transfer_errors as e:
+                    logger.error(u'Fail while opening the ISO files split from %s: %s', mst_input, e)
+                    return []
+
+                try:
+                    if hasattr(os, 'mkfifo'):
+                        with MxIsoStream(mst_input, self.cisis_dir, proc=ARTIGO_SPLIT_PROC) as fl:
+                            counts = split_iso(fl, outputs, ARTIGO_TYPE_TAG)
+                    else:
+                        make_iso(mst_input, iso_all, self.cisis_dir, proc=ARTIGO_SPLIT_PROC)
+
+                        logger.info(u'Splitting %s by record type', iso_all)
+                        with open(iso_all, 'rb') as fl:
+                            counts = split_iso(fl, outputs, ARTIGO_TYPE_TAG)
+                        self._local_remove(iso_all)
+
+                    logger.debug(u'Records by type: %s', counts)
+                    done = True
+                except (IOError, OSError, ValueError) as e:
+                    # ValueError: ISO mal formado
+                    logger.error(u'Fail while splitting %s: %s', mst_input, e)
+                finally:
+                    for handle in handles:
+                        try:
+                            handle.close()
+                        except client.transfer_errors as e:
+                            logger.error(u'Fail while closing ISO file split from %s: %s', mst_input, e)
+                            done = False
+
+                self._publish_split_outputs(client, to_send, done)
+            finally:
+                self._release_task_client(client)
+
+            return to_send if done else []
+
+        return task
+
+    def _send_isos(self, isos):
+
+        for iso_output, destiny_name in isos:
+            if not self.compress:
+                self.client.put(iso_output, self._destiny(destiny_name))
+                continue
+
+            with open(iso_output, 'rb') as fl:
+                self.client.putfo(GzipReader(fl), self._destiny(destiny_name))
+
+    def make_and_send_isos(self, tasks):
+        """
+        Makes and sends ISO files.
+
+        tasks: list of callables making one or more ISO files and returning
+        them as a list of (iso_output, destiny_name) tuples.
+
+        When jobs is greater than one, up to jobs tasks run at the same time
+        and the ISO files of each task are sent as soon as it is done.
+        """
+
+        if self.jobs < 2:
+            for task in tasks:
+                self._send_isos(task())
+            return
+
+        pool = ThreadPool(min(self.jobs, len(tasks)))
+
+        try:
+            for isos in pool.imap_unordered(lambda task: task(), tasks):
+                self._send_isos(isos)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _full_isos(self):
+        """
+        ISO files of send_full_isos, as (mst_input, iso_output, destiny_name,
+        fltr, proc).
+        """
+
+        return [
+            # Making title ISO
+            (
+                self.source_dir + u'/bases-work/title/title',
+                self.source_dir + u'/bases-work/title/title_full.iso',
+                u'title_full.iso',
+                None,
+                None
+            ),
+            # Making issue ISO
+            (
+                self.source_dir + u'/bases-work/issue/issue',
+                self.source_dir + u'/bases-work/issue/issue_full.iso',
+                u'issue_full.iso',
+                None,
+                None
+            ),
+            # Making article ISO
+            (
+                self.source_dir + u'/bases-work/artigo/artigo',
+                self.source_dir + u'/bases-work/artigo/artigo_full.iso',
+                u'artigo_full.iso',
+                None,
+                None
+            )
+        ]
+
+    def _isos(self):
+        """
+        ISO files of send_isos, as (mst_input, iso_output, destiny_name, fltr,
+        proc). The ones after the first two are extracted from the artigo
+        database, all at once in single pass mode.
+        """
+
+        return [
+            # Making title ISO
+            (
+                self.source_dir + u'/bases/title/title',
+                self.source_dir + u'/bases/title/title.iso',
+                u'title.iso',
+                None,
+                None
+            ),
+            # Making issue ISO
+            (
+                self.source_dir + u'/bases/issue/issue',
+                self.source_dir + u'/bases/issue/issue.iso',
+                u'issue.iso',
+                None,
+                None
+            ),
+            # Making issues ISO
+            (
+                self.source_dir + u'/bases/artigo/artigo',
+                self.source_dir + u'/bases/issue/issues.iso',
+                u'issues.iso',
+                u'TP=I',
+                None
+            ),
+            # Making article ISO
+            (
+                self.source_dir + u'/bases/artigo/artigo',
+                self.source_dir + u'/bases/artigo/artigo.iso',
+                u'artigo.iso',
+                u'TP=H',
+                u'''"proc='d91<91 0>',ref(mfn-1,v91),'</91>'"'''
+            ),
+            # Making bib4cit ISO
+            (
+                self.source_dir + u'/bases/artigo/artigo',
+                self.source_dir + u'/bases/artigo/bib4cit.iso',
+                u'bib4cit.iso',
+                u'TP=C',
+                None
+            )
+        ]
+
     def send_full_isos(self):
         """
         This method will prepare and send article, issue, and title iso files to
@@ -179,38 +800,7 @@ class Delivery(object):
         This method will use the mst, xrf files available in bases-work directory
         """
 
-        # Making title ISO
-        make_iso(
-            self.source_dir + u'/bases-work/title/title',
-            self.source_dir + u'/bases-work/title/title_full.iso',
-            self.cisis_dir
-        )
-        self.client.put(
-            self.source_dir + u'/bases-work/title/title_full.iso',
-            self.destiny_dir + u'/title_full.iso'
-        )
-
-        # Making issue ISO
-        make_iso(
-            self.source_dir + u'/bases-work/issue/issue',
-            self.source_dir + u'/bases-work/issue/issue_full.iso',
-            self.cisis_dir
-        )
-        self.client.put(
-            self.source_dir + u'/bases-work/issue/issue_full.iso',
-            self.destiny_dir + u'/issue_full.iso'
-        )
-
-        # Making article ISO
-        make_iso(
-            self.source_dir + u'/bases-work/artigo/artigo',
-            self.source_dir + u'/bases-work/artigo/artigo_full.iso',
-            self.cisis_dir
-        )
-        self.client.put(
-            self.source_dir + u'/bases-work/artigo/artigo_full.iso',
-            self.destiny_dir + u'/artigo_full.iso'
-        )
+        self.make_and_send_isos([self._iso_task(*iso) for iso in self._full_isos()])
 
     def send_isos(self):
         """
@@ -222,64 +812,16 @@ class Delivery(object):
         This method will use the mst, xrf files available in bases directory
         """
 
-        # Making title ISO
-        make_iso(
-            self.source_dir + u'/bases/title/title',
-            self.source_dir + u'/bases/title/title.iso',
-            self.cisis_dir
-        )
-        self.client.put(
-            self.source_dir + u'/bases/title/title.iso',
-            self.destiny_dir + u'/title.iso'
-        )
-
-        # Making issue ISO
-        make_iso(
-            self.source_dir + u'/bases/issue/issue',
-            self.source_dir + u'/bases/issue/issue.iso',
-            self.cisis_dir
-        )
-        self.client.put(
-            self.source_dir + u'/bases/issue/issue.iso',
-            self.destiny_dir + u'/issue.iso'
-        )
+        isos = self._isos()
+        tasks = [self._iso_task(*iso) for iso in isos[:2]]
 
-        # Making issues ISO
-        make_iso(
-            self.source_dir + u'/bases/artigo/artigo',
-            self.source_dir + u'/bases/issue/issues.iso',
-            self.cisis_dir,
-            u'TP=I'
-        )
-        self.client.put(
-            self.source_dir + u'/bases/issue/issues.iso',
-            self.destiny_dir + u'/issues.iso'
-        )
-
-        # Making article ISO
-        make_iso(
-            self.source_dir + u'/bases/artigo/artigo',
-            self.source_dir + u'/bases/artigo/artigo.iso',
-            self.cisis_dir,
-            u'TP=H',
-            u'''"proc='d91<91 0>',ref(mfn-1,v91),'</91>'"'''
-        )
-        self.client.put(
-            self.source_dir + u'/bases/artigo/artigo.iso',
-            self.destiny_dir + u'/artigo.iso'
-        )
+        if self.single_pass:
+            # Making issues, article and bib4cit ISOs reading artigo once
+            tasks.append(self._artigo_split_task())
+        else:
+            tasks.extend(self._iso_task(*iso) for iso in isos[2:])
 
-        # Making bib4cit ISO
-        make_iso(
-            self.source_dir + u'/bases/artigo/artigo',
-            self.source_dir + u'/bases/artigo/bib4cit.iso',
-            self.cisis_dir,
-            u'TP=C'
-        )
-        self.client.put(
-            self.source_dir + u'/bases/artigo/bib4cit.iso',
-            self.destiny_dir + u'/bib4cit.iso'
-        )
+        self.make_and_send_isos(tasks)
 
     def send_static_reports(self):
         """
@@ -297,25 +839,151 @@ class Delivery(object):
         the Article Meta API.
         """
 
-        make_static_file_report(self.source_dir, u'pdf')
-        self.client.put(
-            self.source_dir + u'/bases/reports/static_pdf_files.txt',
-            self.destiny_dir + u'/static_pdf_files.txt'
-        )
-        make_static_file_report(self.source_dir, u'translation')
-        self.client.put(
-            self.source_dir + u'/bases/reports/static_html_files.txt',
-            self.destiny_dir + u'/static_html_files.txt'
+        if self.stream:
+            outputs = dict(
+                (report_name, io.BytesIO())
+                for report, extension_name, report_name in STATIC_FILE_REPORTS
+            )
+            make_static_file_reports(self.source_dir, outputs)
+            for report_name, output in outputs.items():
+                output.seek(0)
+                self.client.putfo(
+                    output,
+                    self.destiny_dir + u'/static_%s_files.txt' % report_name
+                )
+        else:
+            make_static_file_reports(self.source_dir)
+            for report, extension_name, report_name in STATIC_FILE_REPORTS:
+                self.client.put(
+                    self.source_dir + u'/bases/reports/static_%s_files.txt' % report_name,
+                    self.destiny_dir + u'/static_%s_files.txt' % report_name
+                )
+
+        if self.stream:
+            output = io.BytesIO()
+            make_section_catalog_report(self.source_dir, self.cisis_dir, output)
+            output.seek(0)
+            self.client.putfo(
+                output,
+                self.destiny_dir + u'/static_section_catalog.txt'
+            )
+        else:
+            make_section_catalog_report(self.source_dir, self.cisis_dir)
+            self.client.put(
+                self.source_dir + u'/bases/reports/static_section_catalog.txt',
+                self.destiny_dir + u'/static_section_catalog.txt'
+            )
+
+    def _plan_isos(self, plan):
+
+        isos = self._full_isos() if self.original_dataset is True else self._isos()
+        artigo = len([iso for iso in isos if iso[0].endswith(u'/artigo/artigo')])
+
+        for mst_input, iso_output, destiny_name, fltr, proc in isos:
+            try:
+                master = os.stat(mst_input + u'.mst')
+            except OSError:
+                logger.warning(u'Master file not found (%s)', mst_input + u'.mst')
+                plan.add(mst_input, self._destiny(destiny_name), 0, None, u'iso')
+                continue
+
+            # sem o mx o tamanho do ISO e estimado pelo tamanho do master, as
+            # ISOs extraidas do artigo dividem o tamanho do artigo
+            size = master.st_size
+
+            if artigo > 1 and mst_input.endswith(u'/artigo/artigo'):
+                size //= artigo
+
+            plan.add(mst_input, self._destiny(destiny_name), size, master.st_mtime, u'iso')
+
+    def _plan_reports(self, plan):
+
+        outputs = dict(
+            (report_name, io.BytesIO())
+            for report, extension_name, report_name in STATIC_FILE_REPORTS
         )
-        make_static_file_report(self.source_dir, u'xml')
-        self.client.put(
-            self.source_dir + u'/bases/reports/static_xml_files.txt',
-            self.destiny_dir + u'/static_xml_files.txt'
+        make_static_file_reports(self.source_dir, outputs)
+
+        for report, extension_name, report_name in STATIC_FILE_REPORTS:
+            plan.add(
+                self.source_dir + u'/bases/' + report,
+                self.destiny_dir + u'/static_%s_files.txt' % report_name,
+                len(outputs[report_name].getvalue()),
+                None,
+                u'report'
+            )
+
+        size = 0
+
+        try:
+            with MasterFile(self.source_dir + u'/bases/issue/issue') as master:
+                size = sum(len(line) for line in section_catalog(master))
+        except (IOError, OSError, MasterFileError) as e:
+            logger.warning(u'Size of static_section_catalog.txt not estimated: %s', e)
+
+        plan.add(
+            self.source_dir + u'/bases/issue/issue',
+            self.destiny_dir + u'/static_section_catalog.txt',
+            size,
+            None,
+            u'report'
         )
-        make_section_catalog_report(self.source_dir, self.cisis_dir)
-        self.client.put(
-            self.source_dir + u'/bases/reports/static_section_catalog.txt',
-            self.destiny_dir + u'/static_section_catalog.txt'
+
+    def plan(self, source_type=None):
+        """
+        Lists the ISO files and reports run would send, in the order they are
+        sent, without running mx. ISO sizes are estimated, reports are built
+        in memory.
+        """
+
+        source_type = source_type if source_type else self.source_type
+
+        plan = Plan(self.destiny_dir, larger_first=False)
+
+        if source_type != u'reports':
+            self._plan_isos(plan)
+
+        if source_type != u'isos':
+            self._plan_reports(plan)
+
+        return plan
+
+    @property
+    def history_key(self):
+        """
+        Identifies the comparable runs in the history file.
+        """
+
+        return u'scielo %s:%s' % self._credentials[:2]
+
+    def dry_run(self, source_type=None, plan_file=None, history=None):
+        """
+        Logs the plan, exports it as JSON lines to plan_file and estimates
+        its duration from the runs recorded in history, without connecting
+        to the server or running mx.
+        """
+
+        plan = self.plan(source_type)
+        plan.dump()
+
+        if plan_file:
+            plan.export(plan_file)
+
+        plan.estimate(history, self.history_key)
+
+        return plan
+
+    def record_history(self, history, seconds):
+
+        totals = registry.summary()[u'totals'][u'operation']
+        sent = [totals[i] for i in (u'put', u'putfo') if i in totals]
+
+        record_run(
+            history,
+            self.history_key,
+            sum(i[u'count'] - i[u'errors'] for i in sent),
+            self.sent_bytes + self.client.sent_bytes,
+            seconds
         )
 
     def run(self, source_type=None):
@@ -323,14 +991,30 @@ class Delivery(object):
         source_type = source_type if source_type else self.source_type
 
         sender = self.send_full_isos if self.original_dataset is True else self.send_isos
+        started = time.time()
 
-        if source_type == u'isos':
-            sender()
-        elif source_type == u'reports':
-            self.send_static_reports()
-        else:
-            sender()
-            self.send_static_reports()
+        try:
+            if source_type == u'isos':
+                sender()
+            elif source_type == u'reports':
+                self.send_static_reports()
+            else:
+                sender()
+                self.send_static_reports()
+        finally:
+            self.client.close()
+            sent_bytes = self.sent_bytes + self.client.sent_bytes
+            elapsed = time.time() - started
+            logger.info(
+                u'Transfer rate: %.2f MB/s (%d bytes in %.1f seconds)',
+                sent_bytes / 1048576.0 / max(elapsed, 0.001),
+                sent_bytes,
+                elapsed
+            )
+            logger.info(
+                u'Remote operations retried %d times after transient failures',
+                self.retries + self.client.retries
+            )
 
 
 def main():
@@ -362,6 +1046,32 @@ def main():
         help=u'Send the original dataset [title, issue, artigo] without bib4cit, all the content is available at artigo field 706=c 706=h 706=i 706=o.'
     )
 
+    parser.add_argument(
+        u'--jobs',
+        u'-j',
+        type=int,
+        default=int(setts.get(u'jobs', 1)),
+        help=u'Number of ISO files extracted at the same time. Each ISO is sent as soon as its extraction is done.'
+    )
+
+    parser.add_argument(
+        u'--single_pass',
+        action=u'store_true',
+        help=u'Extract issues.iso, artigo.iso and bib4cit.iso reading the artigo database only once and splitting the records by type (field 706).'
+    )
+
+    parser.add_argument(
+        u'--stream',
+        action=u'store_true',
+        help=u'Send the ISO files while mx extracts them and the static file reports while they are built, without writing them to the disk. ISO streaming is not available on Windows.'
+    )
+
+    parser.add_argument(
+        u'--compress',
+        action=u'store_true',
+        help=u'Compress the ISO files with gzip while sending them. The files are sent with the .gz extension.'
+    )
+
     parser.add_argument(
         u'--source_dir',
         u'-s',
@@ -376,6 +1086,53 @@ def main():
         help=u'absolute path (server site) where the SciELO site was installed. this directory must contain the directories bases, htcos, proc and serial'
     )
 
+    parser.add_argument(
+        u'--retries',
+        type=int,
+        default=setts.get(u'retries', 3),
+        help=u'Number of tries of each remote operation failing with a transient error. The connection is reopened before each new try. Default 3.'
+    )
+
+    parser.add_argument(
+        u'--retry_backoff',
+        type=float,
+        default=setts.get(u'retry_backoff', 1),
+        help=u'Seconds waited before the first retry, doubled at each new try. Default 1.'
+    )
+
+    parser.add_argument(
+        u'--compression',
+        default=setts.get(u'compression', u'off'),
+        choices=[u'on', u'off', u'auto'],
+        help=u'SSH compression. auto decides once per SSH session, compressing it when the first file sent is not already compressed (pdf, jpg, gif, gz...). Default off.'
+    )
+
+    parser.add_argument(
+        u'--window_size',
+        type=int,
+        default=setts.get(u'window_size', None),
+        help=u'SFTP channel window size in bytes. Larger windows are faster on high latency links. Default paramiko window size.'
+    )
+
+    parser.add_argument(
+        u'--max_packet_size',
+        type=int,
+        default=setts.get(u'max_packet_size', None),
+        help=u'SFTP maximum packet size in bytes. Default paramiko packet size.'
+    )
+
+    parser.add_argument(
+        u'--no_put_confirm',
+        action=u'store_true',
+        help=u'Do not check the remote size after each SFTP upload, saving one round trip per file.'
+    )
+
+    parser.add_argument(
+        u'--resume_threshold',
+        default=setts.get(u'resume_threshold', None),
+        help=u'Size in MB from which files are sent to a temporary name, resumed after connection failures and renamed once complete. Default 16.'
+    )
+
     parser.add_argument(
         u'--server',
         u'-f',
@@ -393,8 +1150,8 @@ def main():
     parser.add_argument(
         u'--port',
         u'-x',
-        default=setts.get(u'port', u'22'),
-        help=u'usually 22 for SFTP connection or 21 for FTP connection'
+        default=setts.get(u'port', None),
+        help=u'Server port. Default 22 for SFTP and 21 for FTP. Port 22 with FTP is replaced by 21.'
     )
 
     parser.add_argument(
@@ -411,6 +1168,48 @@ def main():
         help=u'FTP or SFTP password'
     )
 
+    parser.add_argument(
+        u'--dry_run',
+        action=u'store_true',
+        help=u'Log the ISO files and reports that would be sent, with their estimated sizes and the estimated duration, without connecting to the server or running mx'
+    )
+
+    parser.add_argument(
+        u'--plan_file',
+        default=None,
+        help=u'path of a file receiving the plan of --dry_run as JSON lines'
+    )
+
+    parser.add_argument(
+        u'--history',
+        default=setts.get(u'history', None),
+        help=u'path of a file recording the files, bytes and duration of every run (JSON lines), used by --dry_run to estimate the duration'
+    )
+
+    parser.add_argument(
+        u'--metrics_json',
+        default=setts.get(u'metrics_json', None),
+        help=u'path of a JSON file receiving the counts, bytes, latency histograms and errors of every operation, by phase and scilista issue'
+    )
+
+    parser.add_argument(
+        u'--prometheus_textfile',
+        default=setts.get(u'prometheus_textfile', None),
+        help=u'path of a Prometheus textfile (node_exporter textfile collector) receiving the metrics of the run'
+    )
+
+    parser.add_argument(
+        u'--prometheus_by_issue',
+        action=u'store_true',
+        help=u'Label the Prometheus metrics by scilista issue, one series per issue'
+    )
+
+    parser.add_argument(
+        u'--profile',
+        default=None,
+        help=u'path of a file receiving the cProfile stats of the run, the top functions are logged. Only the main thread is profiled.'
+    )
+
     parser.add_argument(
         u'--logging_level',
         u'-l',
@@ -432,7 +1231,28 @@ def main():
         args.port,
         args.user,
         args.password,
-        args.original_dataset
+        args.original_dataset,
+        jobs=args.jobs,
+        single_pass=args.single_pass,
+        stream=args.stream,
+        compress=args.compress,
+        resume_threshold=args.resume_threshold,
+        retries=args.retries,
+        retry_backoff=args.retry_backoff,
+        compression=args.compression,
+        window_size=args.window_size,
+        max_packet_size=args.max_packet_size,
+        put_confirm=not args.no_put_confirm
     )
 
-    delivery.run()
+    try:
+        with profiled(args.profile):
+            started = time.time()
+            if args.dry_run:
+                delivery.dry_run(plan_file=args.plan_file, history=args.history)
+            else:
+                delivery.run()
+                if args.history:
+                    delivery.record_history(args.history, time.time() - started)
+    finally:
+        registry.emit(args.metrics_json, args.prometheus_textfile, args.prometheus_by_issue)
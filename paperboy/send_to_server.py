@@ -2,16 +2,45 @@
 import argparse
 import logging
 import logging.config
+import multiprocessing
 import os
 import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from paperboy.utils import settings
-from paperboy.communicator import SFTP, FTP
+from paperboy.communicator import SFTP, FTP, ConnectionFailure, client_options, server_port
+from paperboy.isis import convert_master, MasterFileError
+from paperboy.manifest import Manifest, file_md5
+from paperboy.metrics import registry, profiled
+from paperboy.plan import Plan, record_run
+from paperboy.transfer import TransferPool, TransferSummary
 
 logger = logging.getLogger(__name__)
 
 ALLOWED_ITENS = ['serial', 'pdfs', 'images', 'translations']
 
+DATABASE_EXTENSIONS = [u'mst', u'xrf']
+
+# Directories sent for each scilista issue, by source type.
+CONTENT_PATHS = [
+    (u'databases', u'serial/%s/%s/base'),
+    (u'images', u'htdocs/img/revistas/%s/%s'),
+    (u'pdfs', u'bases/pdf/%s/%s'),
+    (u'translations', u'bases/translation/%s/%s'),
+    (u'xmls', u'bases/xml/%s/%s'),
+]
+
+# Remote trees of a scilista issue, removed for del items.
+ISSUE_PATHS = [
+    u'serial/%s/%s',
+    u'htdocs/img/revistas/%s/%s',
+    u'bases/pdf/%s/%s',
+    u'bases/translation/%s/%s',
+    u'bases/xml/%s/%s',
+]
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -46,6 +75,7 @@ def _config_logging(logging_level='INFO'):
     logging.config.dictConfig(LOGGING)
 
 
+@registry.timed(u'convert', path_arg=0, failed=lambda status: not status)
 def master_conversor(mst_input, mst_output, cisis_dir=None):
 
     logger.debug(u'Running database conversion for %s', mst_input)
@@ -70,6 +100,58 @@ def master_conversor(mst_input, mst_output, cisis_dir=None):
     return False
 
 
+@registry.timed(u'convert', path_arg=0, failed=lambda status: not status)
+def native_master_conversor(mst_input, mst_output, cisis_dir=None):
+    """
+    In process replacement of master_conversor, see isis.convert_master.
+    """
+
+    logger.debug(u'Running native database conversion for %s', mst_input)
+
+    try:
+        convert_master(mst_input, mst_output)
+    except (IOError, OSError, MasterFileError) as e:
+        logger.error(u'Conversion did not work for %s: %s', mst_input, e)
+        return False
+
+    logger.debug(u'Conversion done for %s', mst_input)
+
+    return True
+
+
+def native_conversion(conversion):
+    """
+    Runs a native conversion in a worker process, the conversion is pure
+    Python and threads would take turns on the GIL. Returns the conversion
+    with its duration and error message, logged and recorded by the parent
+    process, see Delivery._native_done.
+    """
+
+    from_fl_name, converted_fl, to_fl = conversion
+
+    started = time.time()
+
+    try:
+        convert_master(from_fl_name, converted_fl)
+    except (IOError, OSError, MasterFileError) as e:
+        return from_fl_name, converted_fl, to_fl, time.time() - started, u'%s' % e
+
+    return from_fl_name, converted_fl, to_fl, time.time() - started, None
+
+
+def conversion_context():
+    """
+    multiprocessing context of the native conversion workers. Workers are
+    spawned where available, forking while the upload threads hold locks
+    would copy them locked into the workers.
+    """
+
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn')
+
+    return multiprocessing
+
+
 def parse_scilista(scilista):
 
     logger.info(u'Loading scilista (%s)', scilista)
@@ -126,7 +208,13 @@ def remove_last_slash(path):
 class Delivery(object):
 
     def __init__(self, source_type, cisis_dir, scilista, source_dir, destiny_dir,
-            compatibility_mode, server, server_type, port, user, password, serial_source_dir=None):
+            compatibility_mode, server, server_type, port, user, password, serial_source_dir=None,
+            workers=1, sync=False, manifest=None, verify_remote=False,
+            conversion_jobs=1, conversor=u'crunchmf', resume_threshold=None,
+            retries=3, retry_backoff=1, compression=u'off', window_size=None,
+            max_packet_size=None, put_confirm=True, tar_stream=False,
+            issue_jobs=1, delete=False, delete_dry_run=False, mirror=False,
+            batch_mkdir=False):
         self._scilista = parse_scilista(scilista)
         self.scilista = scilista
         self.cisis_dir = remove_last_slash(cisis_dir)
@@ -135,14 +223,135 @@ class Delivery(object):
         self.serial_source_dir = remove_last_slash(serial_source_dir) if serial_source_dir else self.source_dir
         self.destiny_dir = remove_last_slash(destiny_dir)
         self.compatibility_mode = compatibility_mode
+        self.conversion_jobs = int(conversion_jobs)
+        self._master_conversor = native_master_conversor if conversor == u'native' else master_conversor
+        self._conversions = None
+        self.workers = int(workers)
+        self.sync = sync
+        self.verify_remote = verify_remote
+        self.tar_stream = tar_stream
+        self.issue_jobs = int(issue_jobs)
+        self.delete = delete
+        self.delete_dry_run = delete_dry_run
+        self.mirror = mirror
+        self._local = threading.local()
+        self._job_clients = []
+        self._job_clients_lock = threading.Lock()
+        self.summary = TransferSummary()
+        self._pool = None
 
         if str(server_type) == 'sftp':
-            self.client = SFTP(server, int(port), user, password)
+            self._communicator = SFTP
         elif str(server_type) == 'ftp':
-            self.client = FTP(server, int(port), user, password)
+            self._communicator = FTP
         else:
             raise TypeError(u'server_type must be ftp or sftp')
 
+        self._credentials = (server, server_port(server_type, port), user, password)
+        self._client_options = client_options(
+            resume_threshold=resume_threshold,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            compression=compression,
+            window_size=window_size,
+            max_packet_size=max_packet_size,
+            put_confirm=put_confirm,
+            batch_mkdir=batch_mkdir
+        )
+        self._client = self._new_client()
+        # chave do manifesto com a porta informada, como antes do padrao por protocolo
+        self.manifest = Manifest(
+            manifest, u'%s:%s' % (server, port if port else self._credentials[1])) if manifest else None
+
+    @property
+    def client(self):
+        """
+        Session used by the current thread: the one of the issue job it runs,
+        or the main session.
+        """
+
+        return getattr(self._local, 'client', None) or self._client
+
+    def _new_client(self):
+
+        client = self._communicator(*self._credentials)
+
+        for name, value in self._client_options.items():
+            setattr(client, name, value)
+
+        return registry.instrument(client)
+
+    def _unchanged(self, client, from_fl, to_fl, local):
+        """
+        Checks whether the file must be sent. local is the os.stat result of
+        from_fl.
+
+        The manifest, when available, is trusted unless verify_remote is set.
+        Otherwise, in sync mode, a remote file is considered unchanged when it
+        has the same size of the local file and was written after the last
+        local modification.
+        """
+
+        if self.manifest and not self.verify_remote:
+            return self.manifest.unchanged(from_fl, to_fl, local)
+
+        if not (self.sync or self.verify_remote):
+            return False
+
+        remote = client.stat(to_fl)
+
+        if remote is None:
+            return False
+
+        remote_size, remote_mtime = remote
+        unchanged = remote_size == local.st_size and remote_mtime >= int(local.st_mtime)
+
+        if unchanged and self.manifest:
+            self.manifest.update(to_fl, remote_size, remote_mtime)
+
+        return unchanged
+
+    def _transfer(self, client, from_fl, to_fl):
+
+        try:
+            local = os.stat(from_fl)
+        except OSError:
+            local = None
+
+        if local and self._unchanged(client, from_fl, to_fl, local):
+            logger.debug(u'File unchanged, skipping (%s)', to_fl)
+            self.summary.skipped(to_fl, local.st_size)
+            return True
+
+        if not client.put(from_fl, to_fl):
+            self.summary.failed(from_fl, to_fl, u'copy failed')
+            return False
+
+        self.summary.sent(to_fl, local.st_size)
+
+        if self.manifest:
+            self.manifest.update(
+                to_fl, local.st_size, local.st_mtime, file_md5(from_fl))
+
+        return True
+
+    def _put(self, from_fl, to_fl, callback=None):
+        """
+        Sends a file to the server. When running with more than one worker the
+        transfer is queued to the upload pool, otherwise it is done right away
+        through the main client. callback, when given, is called with the
+        transfer status after the file was processed.
+        """
+
+        if self._pool:
+            self._pool.submit(from_fl, to_fl, callback)
+            return
+
+        status = self._transfer(self.client, from_fl, to_fl)
+
+        if callback:
+            callback(status)
+
     def _local_remove(self, path):
 
         logger.info(u'Removing temporary file (%s)', path)
@@ -157,31 +366,144 @@ class Delivery(object):
                 e.strerror
             )
 
+    def _remove_callback(self, path):
+
+        def remove(status):
+            self._local_remove(path)
+
+        return remove
+
+    def _remote_commands_refused(self):
+
+        logger.info(u'Server does not run remote commands, files will be sent one by one')
+        self.tar_stream = False
+
+    def _tar_transfer(self, base_path):
+        """
+        Sends the files under base_path that must be sent as a single tar
+        stream, extracted by the server. Returns False when the server could
+        not extract it, so nothing was accounted and the files must be sent
+        one by one.
+        """
+
+        source = self.source_dir + u'/' + base_path
+        remote_dir = self.destiny_dir + u'/' + base_path
+        skipped = []
+        files = []
+
+        if not getattr(self.client, u'remote_commands', True):
+            self._remote_commands_refused()
+            return False
+
+        if not os.path.isdir(source):
+            return False
+
+        for root, dirs, names in os.walk(source):
+            root = root.replace(u'\\', u'/')
+
+            for name in names:
+                from_fl = root + u'/' + name
+                relative = from_fl[len(source) + 1:]
+                to_fl = remote_dir + u'/' + relative
+                local = os.stat(from_fl)
+
+                if self._unchanged(self.client, from_fl, to_fl, local):
+                    skipped.append((to_fl, local))
+                else:
+                    files.append((from_fl, relative, to_fl, local))
+
+        if files:
+            try:
+                sent = self.client.tar_put(
+                    [(from_fl, relative) for from_fl, relative, to_fl, local in files],
+                    remote_dir
+                )
+            except NotImplementedError:
+                logger.info(u'Protocol does not run remote commands, files will be sent one by one')
+                self.tar_stream = False
+                return False
+
+            if not sent:
+                logger.warning(u'Tar stream not extracted at (%s), files will be sent one by one', remote_dir)
+                if not self.client.remote_commands:
+                    self._remote_commands_refused()
+                return False
+
+        for to_fl, local in skipped:
+            logger.debug(u'File unchanged, skipping (%s)', to_fl)
+            self.summary.skipped(to_fl, local.st_size)
+
+        for from_fl, relative, to_fl, local in files:
+            self.summary.sent(to_fl, local.st_size)
+
+            if self.manifest:
+                self.manifest.update(
+                    to_fl, local.st_size, local.st_mtime, file_md5(from_fl))
+
+        return True
+
     def transfer_data_general(self, base_path):
 
         base_path = base_path.replace(u'\\', u'/')
 
-        # Cria a estrutura de diretorio informada em base_path dentro de destiny_dir
-        path = u''
-        for item in base_path.split(u'/'):
-            path += u'/' + item
-            self.client.mkdir(self.destiny_dir + path)
+        # Envia toda a arvore de base_path em um unico fluxo tar, quando possivel
+        if self.tar_stream and self._tar_transfer(base_path):
+            if self.mirror:
+                self._mirror(self.source_dir, base_path)
+            return
 
-        # Cria recursivamente todo conteudo baixo o source_dir + base_path
-        tree = os.walk(self.source_dir + u'/' + base_path)
-        for item in tree:
-            root = item[0].replace(u'\\', u'/')
-            current = root.replace(self.source_dir+u'/', '')
-            dirs = item[1]
-            files = item[2]
+        # Lista a arvore de source_dir + base_path e cria todos os diretorios
+        # antes dos envios, em lote quando batch_mkdir esta ativo
+        plan = Plan(self.destiny_dir)
+        plan.scan(self.source_dir, base_path)
 
+        self.client.makedirs(plan.directories)
+
+        for job in plan.jobs:
+            self._put(job.local, job.remote)
+
+        if self.mirror:
+            self._mirror(self.source_dir, base_path)
+
+    def _mirror(self, source_dir, base_path):
+        """
+        Removes the remote files under base_path with no local counterpart.
+        The remote tree is listed once and compared with the local tree.
+        Partial uploads (.part files) are left alone, they may belong to
+        transfers still running. Nothing is removed when the local directory
+        does not exist, a wrong source_dir must not empty the server.
+        """
+
+        local_dir = source_dir + u'/' + base_path
+        remote_dir = self.destiny_dir + u'/' + base_path
+        local = set()
+
+        if not os.path.isdir(local_dir):
+            logger.warning(
+                u'Local directory not found (%s), remote files will not be mirrored', local_dir)
+            return
+
+        for root, dirs, files in os.walk(local_dir):
+            root = root.replace(u'\\', u'/')
             for fl in files:
-                from_fl = root + u'/' + fl
-                to_fl = self.destiny_dir + u'/' + current + u'/' + fl
-                self.client.put(from_fl, to_fl)
+                local.add((root + u'/' + fl)[len(local_dir) + 1:])
 
-            for directory in dirs:
-                self.client.mkdir(self.destiny_dir + u'/' + current + u'/' + directory)
+        for path, size, mtime in self.client.walk(remote_dir):
+            relative = path[len(remote_dir) + 1:]
+
+            if relative in local or relative.endswith(self.client.partial_suffix):
+                continue
+
+            logger.info(u'Removing file not available in the source (%s)', path)
+
+            if not self.client.remove(path):
+                self.summary.failed(path, path, u'remove failed')
+                continue
+
+            self.summary.removed(path, size)
+
+            if self.manifest:
+                self.manifest.remove(path)
 
     def transfer_data_databases(self, base_path):
         """
@@ -196,7 +518,7 @@ class Delivery(object):
 
         base_path = base_path.replace(u'\\', u'/')
 
-        allowed_extensions = [u'mst', u'xrf']
+        allowed_extensions = DATABASE_EXTENSIONS
 
         # Cria a estrutura de diretorio informada em base_path dentro de destiny_dir
         path = u''
@@ -222,14 +544,21 @@ class Delivery(object):
                 to_fl = self.destiny_dir + u'/' + current + u'/' + fl
 
                 if not self.compatibility_mode:
-                    self.client.put(from_fl, to_fl)
+                    self._put(from_fl, to_fl)
                     continue
 
                 if from_fl_name in converted:
                     continue
 
                 converted.add(from_fl_name)
-                convertion_status = master_conversor(
+
+                # conversoes em paralelo, enviadas ao final de run_serial
+                if self._conversions is not None:
+                    self._conversions.append(
+                        (from_fl_name, converted_fl, to_fl[:-4]))
+                    continue
+
+                convertion_status = self._master_conversor(
                     from_fl_name,
                     converted_fl,
                     cisis_dir=self.cisis_dir
@@ -238,23 +567,95 @@ class Delivery(object):
                 if not convertion_status:
                     continue
 
-                if convertion_status:
-                    from_fl = converted_fl
-
-                to_fl = to_fl[:-4]
-                for extension in allowed_extensions:
-                    self.client.put(from_fl + u'.' + extension, to_fl + u'.' + extension)
-                    self._local_remove(from_fl + u'.' + extension)
+                self._send_converted(converted_fl, to_fl[:-4])
 
             for directory in dirs:
                 self.client.mkdir(self.destiny_dir + u'/' + current + u'/' + directory)
 
+        if self.mirror:
+            self._mirror(self.serial_source_dir, base_path)
+
+    def _send_converted(self, converted_fl, to_fl):
+        """
+        Sends the mst and xrf files produced by master_conversor, removing the
+        local copies once they were transfered.
+        """
+
+        for extension in DATABASE_EXTENSIONS:
+            self._put(
+                converted_fl + u'.' + extension,
+                to_fl + u'.' + extension,
+                callback=self._remove_callback(converted_fl + u'.' + extension)
+            )
+
+    def _convert(self, conversion):
+
+        from_fl_name, converted_fl, to_fl = conversion
+
+        status = self._master_conversor(
+            from_fl_name,
+            converted_fl,
+            cisis_dir=self.cisis_dir
+        )
+
+        return converted_fl, to_fl, status
+
+    def _native_done(self, result):
+
+        from_fl_name, converted_fl, to_fl, seconds, error = result
+
+        registry.observe(u'convert', seconds, error=bool(error), path=from_fl_name)
+
+        if error:
+            logger.error(u'Conversion did not work for %s: %s', from_fl_name, error)
+        else:
+            logger.debug(u'Conversion done for %s', from_fl_name)
+
+        return converted_fl, to_fl, not error
+
+    def _run_conversions(self):
+        """
+        Runs the queued database conversions in parallel, sending each pair of
+        converted files as soon as its conversion is done. Native conversions
+        run in worker processes, crunchmf conversions are subprocesses already
+        and only need a thread each.
+        """
+
+        conversions, self._conversions = self._conversions, None
+
+        logger.info(
+            u'Converting %d databases with %d simultaneous jobs',
+            len(conversions),
+            self.conversion_jobs
+        )
+
+        if self._master_conversor is native_master_conversor:
+            pool = conversion_context().Pool(self.conversion_jobs)
+            results = (
+                self._native_done(result)
+                for result in pool.imap_unordered(native_conversion, conversions)
+            )
+        else:
+            pool = ThreadPool(self.conversion_jobs)
+            results = pool.imap_unordered(self._convert, conversions)
+
+        try:
+            for converted_fl, to_fl, status in results:
+                if status:
+                    self._send_converted(converted_fl, to_fl)
+        finally:
+            pool.close()
+            pool.join()
+
     def run_serial(self):
 
+        if self.compatibility_mode and self.conversion_jobs > 1:
+            self._conversions = []
+
         self.client.mkdir(self.destiny_dir + u'/serial')
 
         logger.info(u'Copying scilista.lst file')
-        self.client.put(self.scilista, self.destiny_dir + u'/serial/scilista.lst')
+        self._put(self.scilista, self.destiny_dir + u'/serial/scilista.lst')
 
         logger.info(u'Copying issue database')
         self.transfer_data_databases(u'serial/issue')
@@ -280,6 +681,9 @@ class Delivery(object):
                 journal_acronym, issue_label)
             )
 
+        if self._conversions is not None:
+            self._run_conversions()
+
     def run_pdfs(self):
 
         for item in self._scilista:
@@ -360,26 +764,351 @@ class Delivery(object):
                 journal_acronym, issue_label)
             )
 
+    def plan(self, content_types):
+        """
+        Builds the transfer plan of the content types for the whole scilista,
+        walking each source directory once. Databases are planned as plain
+        copies, see run_planned. As in run_serial, the scilista and the
+        databases are sent before the issue content.
+        """
+
+        plan = Plan(self.destiny_dir)
+
+        if u'databases' in content_types:
+            plan.add_directory(self.destiny_dir + u'/serial')
+
+            try:
+                scilista = os.stat(self.scilista)
+                size, mtime = scilista.st_size, scilista.st_mtime
+            except OSError as e:
+                # o envio registra a falha, como antes do plano
+                logger.error(u'Fail while reading scilista (%s): %s', self.scilista, e)
+                size, mtime = 0, None
+
+            plan.add(
+                self.scilista,
+                self.destiny_dir + u'/serial/scilista.lst',
+                size,
+                mtime,
+                first=True
+            )
+
+            for database in (u'serial/issue', u'serial/title'):
+                plan.scan(
+                    self.serial_source_dir,
+                    database,
+                    DATABASE_EXTENSIONS,
+                    u'convert' if self.compatibility_mode else u'put',
+                    first=True
+                )
+
+        for journal_acronym, issue_label, delete in self._scilista:
+            # pulando itens do scilista indicados para exclusao, ex: rsap v12n3 del
+            if delete:
+                continue
+
+            for content, pattern in CONTENT_PATHS:
+                if content not in content_types:
+                    continue
+
+                base_path = pattern % (journal_acronym, issue_label)
+
+                if content == u'databases':
+                    plan.scan(
+                        self.serial_source_dir,
+                        base_path,
+                        DATABASE_EXTENSIONS,
+                        u'convert' if self.compatibility_mode else u'put',
+                        first=True
+                    )
+                else:
+                    plan.scan(self.source_dir, base_path)
+
+        return plan
+
+    def run_planned(self, content_types):
+        """
+        Sends the content types following a single plan: the remote
+        directories are created first, then the scilista and the databases
+        are sent, then the issue content larger first.
+        In compatibility mode the databases are converted and sent by
+        run_serial.
+        """
+
+        if self.compatibility_mode and u'databases' in content_types:
+            self.run_serial()
+            content_types = [i for i in content_types if i != u'databases']
+
+        plan = self.plan(content_types)
+        plan.log()
+
+        self.client.makedirs(plan.directories)
+
+        for job in plan.ordered():
+            self._put(job.local, job.remote)
+
+        if self.mirror:
+            for source_dir, base_path in plan.base_paths:
+                self._mirror(source_dir, base_path)
+
+    @property
+    def history_key(self):
+        """
+        Identifies the comparable runs in the history file.
+        """
+
+        return u'server %s:%s' % self._credentials[:2]
+
+    def dry_run(self, source_type=None, plan_file=None, history=None):
+        """
+        Logs the transfer plan, exports it as JSON lines to plan_file and
+        estimates its duration from the runs recorded in history, without
+        connecting to the server or converting databases. Files skipped as
+        unchanged at transfer time are counted.
+        """
+
+        source_type = source_type if source_type else self.source_type
+
+        plan = self.plan(self._content_types(source_type))
+        plan.dump()
+
+        if plan_file:
+            plan.export(plan_file)
+
+        plan.estimate(history, self.history_key)
+
+        return plan
+
+    def record_history(self, history, seconds):
+
+        record_run(
+            history,
+            self.history_key,
+            self.summary.sent_files,
+            self.summary.sent_bytes,
+            seconds
+        )
+
+    def _deleted_trees(self):
+        """
+        Yields the remote trees of the scilista del items.
+        """
+
+        for journal_acronym, issue_label, delete in self._scilista:
+            if not delete:
+                continue
+
+            # nunca remover a partir de um caminho vazio ou relativo
+            names = (journal_acronym, issue_label)
+            if not all(names) or any(u'/' in i or u'\\' in i or i in (u'.', u'..') for i in names):
+                logger.warning(
+                    u'Invalid scilista item, nothing will be removed: %s %s',
+                    journal_acronym,
+                    issue_label
+                )
+                continue
+
+            for pattern in ISSUE_PATHS:
+                yield self.destiny_dir + u'/' + pattern % names
+
+    def remove_deleted(self):
+        """
+        Removes from the server the trees of the issues marked as del in the
+        scilista. In dry run mode the trees and the files they hold are only
+        listed.
+        """
+
+        for path in self._deleted_trees():
+            if self.delete_dry_run:
+                files = list(self.client.walk(path))
+                logger.info(
+                    u'Dry run, would remove directory tree (%s) with %d files',
+                    path,
+                    len(files)
+                )
+                for item in files:
+                    logger.info(u'Dry run, would remove file (%s)', item[0])
+                continue
+
+            if not self.client.rmtree(path):
+                self.summary.failed(path, path, u'remove failed')
+                continue
+
+            if self.manifest:
+                self.manifest.remove_tree(path)
+
+            # diretorios removidos precisam ser criados novamente
+            for known in list(self.client.known_dirs):
+                if known == path or known.startswith(path + u'/'):
+                    del self.client.known_dirs[known]
+
+    def _content_types(self, source_type):
+
+        if source_type in [content for content, pattern in CONTENT_PATHS]:
+            return [source_type]
+
+        return [content for content, pattern in CONTENT_PATHS]
+
+    def _run_job(self, job):
+        """
+        Sends the content of one scilista issue. Each thread of the issue
+        scheduler keeps its own session for the jobs it runs.
+        """
+
+        content, base_path = job
+
+        if getattr(self._local, 'client', None) is None:
+            self._local.client = self._new_client()
+            with self._job_clients_lock:
+                self._job_clients.append(self._local.client)
+
+        logger.info(u'Copying %s from %s', content, base_path)
+
+        try:
+            if content == u'databases':
+                self.transfer_data_databases(base_path)
+            else:
+                self.transfer_data_general(base_path)
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            logger.exception(u'Fail while copying %s from %s', content, base_path)
+            self.summary.failed(base_path, base_path, repr(e))
+
+    def run_scheduled(self, content_types):
+        """
+        Runs every (scilista issue, content type) as an independent job, up
+        to issue_jobs at the same time, each one with its own session to the
+        server. The scilista and the issue and title databases are sent
+        before any job starts, converted first in compatibility mode. The
+        conversions of the issue databases run once the jobs are done.
+        """
+
+        jobs = []
+
+        for journal_acronym, issue_label, delete in self._scilista:
+            # pulando itens do scilista indicados para exclusao, ex: rsap v12n3 del
+            if delete:
+                continue
+
+            for content, pattern in CONTENT_PATHS:
+                if content in content_types:
+                    jobs.append(
+                        (content, pattern % (journal_acronym, issue_label)))
+
+        if u'databases' in content_types:
+            if self.compatibility_mode and self.conversion_jobs > 1:
+                self._conversions = []
+
+            self.client.mkdir(self.destiny_dir + u'/serial')
+
+            logger.info(u'Copying scilista.lst file')
+            self._put(self.scilista, self.destiny_dir + u'/serial/scilista.lst')
+
+            logger.info(u'Copying issue database')
+            self.transfer_data_databases(u'serial/issue')
+
+            logger.info(u'Copying title database')
+            self.transfer_data_databases(u'serial/title')
+
+            # issue e title convertidos e enviados antes dos jobs, apenas as
+            # bases dos fasciculos esperam o fim dos jobs
+            if self._conversions is not None:
+                self._run_conversions()
+                self._conversions = []
+
+        logger.info(
+            u'Running %d issue jobs, %d at a time', len(jobs), self.issue_jobs)
+
+        pool = ThreadPool(self.issue_jobs)
+
+        try:
+            for result in pool.imap_unordered(self._run_job, jobs):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+            for client in self._job_clients:
+                client.close()
+                self.summary.collect(client)
+
+            self._job_clients = []
+
+        if self._conversions is not None:
+            self._run_conversions()
+
     def run(self, source_type=None):
 
         source_type = source_type if source_type else self.source_type
 
-        if source_type == u'pdfs':
-            self.run_pdfs()
-        elif source_type == u'images':
-            self.run_images()
-        elif source_type == u'translations':
-            self.run_translations()
-        elif source_type == u'databases':
-            self.run_serial()
-        elif source_type == u'xmls':
-            self.run_xmls()
-        else:
-            self.run_serial()
-            self.run_images()
-            self.run_pdfs()
-            self.run_translations()
-            self.run_xmls()
+        if self.workers > 1:
+            self._pool = TransferPool(
+                self._new_client, self.workers, self._transfer, self.summary)
+            self._pool.start()
+
+        try:
+            # remocoes antes do envio, um item pode ser removido e reenviado
+            if self.delete or self.delete_dry_run:
+                self.remove_deleted()
+
+            if self.issue_jobs > 1:
+                self.run_scheduled(self._content_types(source_type))
+            elif not self.tar_stream:
+                self.run_planned(self._content_types(source_type))
+            elif source_type == u'pdfs':
+                self.run_pdfs()
+            elif source_type == u'images':
+                self.run_images()
+            elif source_type == u'translations':
+                self.run_translations()
+            elif source_type == u'databases':
+                self.run_serial()
+            elif source_type == u'xmls':
+                self.run_xmls()
+            else:
+                self.run_serial()
+                self.run_images()
+                self.run_pdfs()
+                self.run_translations()
+                self.run_xmls()
+        finally:
+            if self._pool:
+                self._pool.join()
+                self._pool = None
+            if self.manifest:
+                self.manifest.close()
+            self.client.close()
+            self.summary.collect(self.client)
+            self.summary.log()
+
+    def rebuild_manifest(self):
+        """
+        Rebuilds the manifest from the listing of the remote directories of
+        every scilista issue, without sending any file.
+        """
+
+        base_paths = [u'serial/issue', u'serial/title']
+
+        for journal_acronym, issue_label, delete in self._scilista:
+            if delete:
+                continue
+
+            for source_type, template in CONTENT_PATHS:
+                base_paths.append(template % (journal_acronym, issue_label))
+
+        try:
+            for base_path in base_paths:
+                logger.info(u'Listing remote directory (%s)', base_path)
+
+                for path, size, mtime in self.client.walk(
+                        self.destiny_dir + u'/' + base_path):
+                    self.manifest.update(path, size, mtime)
+        finally:
+            self.manifest.close()
+            self.client.close()
+
+        logger.info(u'Manifest rebuilt (%s)', self.manifest.filepath)
 
 
 def main():
@@ -438,6 +1167,20 @@ def main():
         help=u'Activate the compatibility mode between operating systems. It is necessary to have the CISIS configured in the syspath or in the configuration file'
         )
 
+    parser.add_argument(
+        u'--conversor',
+        choices=[u'crunchmf', u'native'],
+        default=setts.get(u'conversor', u'crunchmf'),
+        help=u'Database converter used in compatibility mode. native converts the databases in process, switching the record layout without CISIS.'
+    )
+
+    parser.add_argument(
+        u'--conversion_jobs',
+        type=int,
+        default=int(setts.get(u'conversion_jobs', 1)),
+        help=u'Number of simultaneous database conversions in compatibility mode. Converted databases are sent as soon as their conversion is done. native conversions run in worker processes.'
+    )
+
     parser.add_argument(
         u'--server',
         u'-f',
@@ -455,8 +1198,8 @@ def main():
     parser.add_argument(
         u'--port',
         u'-x',
-        default=setts.get(u'port', u'22'),
-        help=u'usually 22 for SFTP connection or 21 for FTP connection'
+        default=setts.get(u'port', None),
+        help=u'Server port. Default 22 for SFTP and 21 for FTP. Port 22 with FTP is replaced by 21.'
     )
 
     parser.add_argument(
@@ -473,6 +1216,178 @@ def main():
         help=u'FTP or SFTP password'
     )
 
+    parser.add_argument(
+        u'--workers',
+        u'-w',
+        type=int,
+        default=int(setts.get(u'workers', 1)),
+        help=u'Number of simultaneous connections used to upload files. Each worker opens its own SFTP or FTP session.'
+    )
+
+    parser.add_argument(
+        u'--issue_jobs',
+        type=int,
+        default=int(setts.get(u'issue_jobs', 1)),
+        help=u'Number of scilista issues sent at the same time, each one with its own connection to the server. Every issue content (databases, images, pdfs, translations, xmls) is a separate job. Default 1, the issues are sent one after the other. Not available with the asyncio backend.'
+    )
+
+    parser.add_argument(
+        u'--delete',
+        action=u'store_true',
+        help=u'Remove from the server the serial, htdocs/img/revistas and bases/pdf|translation|xml trees of the scilista items marked as del, before sending anything.'
+    )
+
+    parser.add_argument(
+        u'--delete_dry_run',
+        action=u'store_true',
+        help=u'List the remote trees and files --delete would remove, without removing them.'
+    )
+
+    parser.add_argument(
+        u'--mirror',
+        action=u'store_true',
+        help=u'After sending each issue directory, remove the remote files not available in the local directory (renamed or removed files). The remote directory is listed once per issue. Not available with the asyncio backend.'
+    )
+
+    parser.add_argument(
+        u'--backend',
+        default=setts.get(u'backend', u'threads'),
+        choices=[u'threads', u'asyncio'],
+        help=u'threads: uploads run in --workers threads. asyncio: uploads run as coroutines, up to --concurrency in flight (Python 3.7+, requires asyncssh for SFTP or aioftp for FTP).'
+    )
+
+    parser.add_argument(
+        u'--concurrency',
+        type=int,
+        default=int(setts.get(u'concurrency', 100)),
+        help=u'Maximum number of transfers in flight with the asyncio backend. FTP transfers are spread over --workers connections.'
+    )
+
+    parser.add_argument(
+        u'--sync',
+        action=u'store_true',
+        help=u'Send only the files that are new or changed. A file is considered unchanged when the server already has a copy with the same size written after the last local modification.'
+    )
+
+    parser.add_argument(
+        u'--manifest',
+        default=setts.get(u'manifest', None),
+        help=u'absolute path to a local manifest file (SQLite) recording the files already sent to the server. Files unchanged since their last upload are skipped without checking the server.'
+    )
+
+    parser.add_argument(
+        u'--verify_remote',
+        action=u'store_true',
+        help=u'Do not trust the manifest, check every file against the server as in the sync mode and refresh the manifest.'
+    )
+
+    parser.add_argument(
+        u'--retries',
+        type=int,
+        default=setts.get(u'retries', 3),
+        help=u'Number of tries of each remote operation failing with a transient error. The connection is reopened before each new try. Default 3.'
+    )
+
+    parser.add_argument(
+        u'--retry_backoff',
+        type=float,
+        default=setts.get(u'retry_backoff', 1),
+        help=u'Seconds waited before the first retry, doubled at each new try. Default 1.'
+    )
+
+    parser.add_argument(
+        u'--compression',
+        default=setts.get(u'compression', u'off'),
+        choices=[u'on', u'off', u'auto'],
+        help=u'SSH compression. auto decides once per SSH session, compressing it when the first file sent is not already compressed (pdf, jpg, gif, gz...). With the asyncio backend auto is off. Default off.'
+    )
+
+    parser.add_argument(
+        u'--window_size',
+        type=int,
+        default=setts.get(u'window_size', None),
+        help=u'SFTP channel window size in bytes. Larger windows are faster on high latency links. Default paramiko window size.'
+    )
+
+    parser.add_argument(
+        u'--max_packet_size',
+        type=int,
+        default=setts.get(u'max_packet_size', None),
+        help=u'SFTP maximum packet size in bytes. Default paramiko packet size.'
+    )
+
+    parser.add_argument(
+        u'--no_put_confirm',
+        action=u'store_true',
+        help=u'Do not check the remote size after each SFTP upload, saving one round trip per file.'
+    )
+
+    parser.add_argument(
+        u'--batch_mkdir',
+        action=u'store_true',
+        help=u'Create the remote directories of each issue, or of the whole plan, at once: a single mkdir -p over SSH, or pipelined SFTP mkdir requests when the server does not run commands. No effect with FTP. Not available with the asyncio backend.'
+    )
+
+    parser.add_argument(
+        u'--tar_stream',
+        action=u'store_true',
+        help=u'Send each issue directory as a single tar stream extracted by the server (SFTP with shell access). Falls back to one file at a time when the server does not run tar. Not available with the asyncio backend.'
+    )
+
+    parser.add_argument(
+        u'--resume_threshold',
+        default=setts.get(u'resume_threshold', None),
+        help=u'Size in MB from which files are sent to a temporary name, resumed after connection failures and renamed once complete. Default 16. Not available with the asyncio backend.'
+    )
+
+    parser.add_argument(
+        u'--rebuild_manifest',
+        action=u'store_true',
+        help=u'Rebuild the manifest from the listing of the server directories of the scilista issues. No file is sent.'
+    )
+
+    parser.add_argument(
+        u'--dry_run',
+        action=u'store_true',
+        help=u'Log the directories to create and the files to send, with the total files and bytes and the estimated duration, without connecting to the server'
+    )
+
+    parser.add_argument(
+        u'--plan_file',
+        default=None,
+        help=u'path of a file receiving the plan of --dry_run as JSON lines'
+    )
+
+    parser.add_argument(
+        u'--history',
+        default=setts.get(u'history', None),
+        help=u'path of a file recording the files, bytes and duration of every run (JSON lines), used by --dry_run to estimate the duration'
+    )
+
+    parser.add_argument(
+        u'--metrics_json',
+        default=setts.get(u'metrics_json', None),
+        help=u'path of a JSON file receiving the counts, bytes, latency histograms and errors of every operation, by phase and scilista issue'
+    )
+
+    parser.add_argument(
+        u'--prometheus_textfile',
+        default=setts.get(u'prometheus_textfile', None),
+        help=u'path of a Prometheus textfile (node_exporter textfile collector) receiving the metrics of the run'
+    )
+
+    parser.add_argument(
+        u'--prometheus_by_issue',
+        action=u'store_true',
+        help=u'Label the Prometheus metrics by scilista issue, one series per issue'
+    )
+
+    parser.add_argument(
+        u'--profile',
+        default=None,
+        help=u'path of a file receiving the cProfile stats of the run, the top functions are logged. Only the main thread is profiled.'
+    )
+
     parser.add_argument(
         u'--logging_level',
         u'-l',
@@ -483,6 +1398,19 @@ def main():
 
     args = parser.parse_args()
 
+    if args.rebuild_manifest and not args.manifest:
+        parser.error(u'--rebuild_manifest requires --manifest')
+
+    if args.backend == u'asyncio':
+        unsupported = [name for name, value in (
+            (u'--mirror', args.mirror),
+            (u'--tar_stream', args.tar_stream),
+            (u'--batch_mkdir', args.batch_mkdir),
+            (u'--issue_jobs', args.issue_jobs > 1),
+            (u'--resume_threshold', args.resume_threshold is not None)) if value]
+        if unsupported:
+            parser.error(u'%s not available with --backend asyncio' % u', '.join(unsupported))
+
     _config_logging(args.logging_level)
 
     delivery = Delivery(
@@ -497,6 +1425,42 @@ def main():
         args.port,
         args.user,
         args.password,
-        args.serial_source_dir
+        args.serial_source_dir,
+        workers=args.workers,
+        sync=args.sync,
+        manifest=args.manifest,
+        verify_remote=args.verify_remote,
+        conversion_jobs=args.conversion_jobs,
+        conversor=args.conversor,
+        resume_threshold=args.resume_threshold,
+        retries=args.retries,
+        retry_backoff=args.retry_backoff,
+        compression=args.compression,
+        window_size=args.window_size,
+        max_packet_size=args.max_packet_size,
+        put_confirm=not args.no_put_confirm,
+        tar_stream=args.tar_stream,
+        batch_mkdir=args.batch_mkdir,
+        issue_jobs=args.issue_jobs,
+        delete=args.delete,
+        delete_dry_run=args.delete_dry_run,
+        mirror=args.mirror
     )
-    delivery.run()
+
+    try:
+        with profiled(args.profile):
+            started = time.time()
+            if args.dry_run:
+                delivery.dry_run(plan_file=args.plan_file, history=args.history)
+            elif args.rebuild_manifest:
+                delivery.rebuild_manifest()
+            else:
+                if args.backend == u'asyncio':
+                    from paperboy import aio
+                    aio.run(delivery, concurrency=args.concurrency, connections=args.workers)
+                else:
+                    delivery.run()
+                if args.history:
+                    delivery.record_history(args.history, time.time() - started)
+    finally:
+        registry.emit(args.metrics_json, args.prometheus_textfile, args.prometheus_by_issue)
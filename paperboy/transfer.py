@@ -0,0 +1,231 @@
+# coding: utf-8
+import logging
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+class TransferSummary(object):
+    """
+    Thread safe accounting of the transfers done during a delivery run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.avoided_roundtrips = 0
+        self.retries = 0
+        self.failures = []
+        self.started = time.time()
+
+    def sent(self, to_fl, size):
+
+        with self._lock:
+            self.sent_files += 1
+            self.sent_bytes += size
+
+    def skipped(self, to_fl, size):
+
+        with self._lock:
+            self.skipped_files += 1
+            self.skipped_bytes += size
+
+    def removed(self, to_fl, size):
+
+        with self._lock:
+            self.removed_files += 1
+            self.removed_bytes += size
+
+    def failed(self, from_fl, to_fl, reason):
+
+        with self._lock:
+            self.failures.append((from_fl, to_fl, reason))
+
+    def collect(self, client):
+        """
+        Adds the counters kept by a communicator during its session.
+        """
+
+        with self._lock:
+            self.avoided_roundtrips += client.avoided_roundtrips
+            self.retries += client.retries
+
+    def log(self):
+
+        logger.info(
+            u'Transfer summary: %d files sent (%d bytes), %d files skipped (%d bytes), %d failures',
+            self.sent_files,
+            self.sent_bytes,
+            self.skipped_files,
+            self.skipped_bytes,
+            len(self.failures)
+        )
+
+        if self.removed_files:
+            logger.info(
+                u'%d remote files removed (%d bytes)',
+                self.removed_files,
+                self.removed_bytes
+            )
+
+        elapsed = time.time() - self.started
+
+        logger.info(
+            u'Transfer rate: %.2f MB/s (%d bytes in %.1f seconds)',
+            self.sent_bytes / 1048576.0 / max(elapsed, 0.001),
+            self.sent_bytes,
+            elapsed
+        )
+
+        logger.info(
+            u'Remote directories cache avoided %d round trips',
+            self.avoided_roundtrips
+        )
+
+        logger.info(
+            u'Remote operations retried %d times after transient failures',
+            self.retries
+        )
+
+        for from_fl, to_fl, reason in self.failures:
+            logger.error(
+                u'Fail while copying file from (%s) to (%s): %s',
+                from_fl,
+                to_fl,
+                reason
+            )
+
+
+class TransferPool(object):
+    """
+    Bounded pool of workers draining a queue of (from_fl, to_fl) transfer jobs.
+
+    Each worker owns its own connection to the server, created through
+    client_factory, and runs handler(client, from_fl, to_fl) for every job it
+    takes from the queue. The handler must return True when the file was
+    transfered. A failing job is recorded in the summary and does not stop the
+    worker.
+    """
+
+    def __init__(self, client_factory, workers, handler, summary):
+        self.client_factory = client_factory
+        self.workers = workers
+        self.handler = handler
+        self.summary = summary
+        self._queue = queue.Queue(maxsize=workers * 100)
+        self._threads = []
+
+    def start(self):
+
+        logger.info(u'Starting %d upload workers', self.workers)
+
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                name=u'paperboy-upload-%d' % i
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, from_fl, to_fl, callback=None):
+        """
+        Queues a transfer job. callback, when given, is called with the
+        transfer status once the job was processed.
+        """
+
+        self._queue.put((from_fl, to_fl, callback))
+
+    def join(self):
+        """
+        Waits until every queued job is processed and stops the workers.
+        """
+
+        for thread in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+        logger.info(u'Upload workers finished')
+
+    def _work(self):
+
+        client = self.client_factory()
+
+        try:
+            while True:
+                job = self._queue.get()
+
+                if job is None:
+                    break
+
+                self._run(client, *job)
+        finally:
+            client.close()
+            self.summary.collect(client)
+
+    def _run(self, client, from_fl, to_fl, callback):
+
+        try:
+            status = self.handler(client, from_fl, to_fl)
+        except Exception as e:
+            logger.exception(
+                u'Unexpected error while copying file (%s)', from_fl)
+            self.summary.failed(from_fl, to_fl, repr(e))
+            status = False
+
+        if callback:
+            callback(status)
+
+
+class GzipReader(object):
+    """
+    Read only file object returning the content of fl compressed in the gzip
+    format, so a stream can be compressed while it is uploaded.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fl, level=6):
+        self.fl = fl
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._eof = False
+
+    def read(self, size=-1):
+
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self.fl.read(self.chunk_size)
+
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    def close(self):
+
+        self.fl.close()
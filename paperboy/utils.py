@@ -1,5 +1,6 @@
 #coding: utf-8
 import os
+import sys
 import weakref
 import logging
 
@@ -8,9 +9,93 @@ try:
 except ImportError:
     from ConfigParser import ConfigParser
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 logger = logging.getLogger(__name__)
 
 
+class _DirEntry(object):
+    """
+    Minimal os.DirEntry replacement used when scandir is not available.
+    """
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def is_file(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isfile(self.path)
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+
+def _scandir(path):
+
+    if scandir is not None:
+        return scandir(path)
+
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def fsencode(path):
+    """
+    Returns the path as bytes, encoded as the file system does.
+    """
+
+    if isinstance(path, bytes):
+        return path
+
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+
+def walk_entries(root):
+    """
+    Walks the tree under root, top-down and without following symbolic links,
+    yielding (relative_path, entry) for every file and directory. entry
+    behaves as os.DirEntry. Unreadable directories are skipped.
+    """
+
+    sep = b'/' if isinstance(root, bytes) else u'/'
+    pending = [(root, None)]
+
+    while pending:
+        path, relative = pending.pop()
+
+        try:
+            entries = list(_scandir(path))
+        except OSError as e:
+            logger.warning(u'Fail while reading directory (%s): %s', path, e)
+            continue
+
+        subdirs = []
+        for entry in entries:
+            entry_relative = entry.name if relative is None else relative + sep + entry.name
+
+            yield entry_relative, entry
+
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, entry_relative))
+
+        pending.extend(reversed(subdirs))
+
+
 class SingletonMixin(object):
     """
     Adds a singleton behaviour to an existing class.
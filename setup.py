@@ -28,6 +28,9 @@ setup(
     ],
     dependency_links=[
     ],
+    extras_require={
+        'asyncio': ['asyncssh', 'aioftp'],
+    },
     tests_require=tests_require,
     test_suite='tests',
     install_requires=install_requires,
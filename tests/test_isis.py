@@ -0,0 +1,182 @@
+# coding: utf-8
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from paperboy.isis import (
+    MasterFile, MasterFileError, Record, convert_master, subfield,
+    write_master)
+
+
+def sample_records(count=300):
+    """
+    Records crossing several master and cross reference blocks, with odd
+    length values and repeated fields.
+    """
+
+    for mfn in range(1, count + 1):
+        yield Record(mfn, [
+            (35, b'0034-8910'),
+            (36, str(2016000 + mfn).encode('ascii')),
+            (49, b'^lpt^cRSP%d^tArtigos' % mfn),
+            (49, b'^len^cRSP%d^tArticles' % mfn),
+            (10, b'x' * (mfn % 7)),
+        ])
+
+
+class MasterFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, records, **kwargs):
+
+        path = os.path.join(self.tmp_dir, name)
+
+        with open(path + u'.mst', 'wb') as mst:
+            with open(path + u'.xrf', 'wb') as xrf:
+                write_master(records, mst, xrf, **kwargs)
+
+        return path
+
+    def read(self, path, deleted=False):
+
+        with MasterFile(path) as master:
+            return [
+                (record.mfn, record.fields, record.deleted)
+                for record in master.records(deleted=deleted)
+            ]
+
+    def content(self, path):
+
+        with open(path + u'.mst', 'rb') as mst:
+            with open(path + u'.xrf', 'rb') as xrf:
+                return mst.read(), xrf.read()
+
+    def test_round_trip(self):
+
+        expected = [
+            (record.mfn, record.fields, False) for record in sample_records()]
+
+        for layout in (u'packed', u'aligned'):
+            for byteorder in ('<', '>'):
+                path = self.write(
+                    u'%s%s' % (layout, ord(byteorder)), sample_records(),
+                    layout=layout, byteorder=byteorder)
+
+                with MasterFile(path) as master:
+                    self.assertEqual(master.layout, layout)
+                    self.assertEqual(master.byteorder, byteorder)
+                    self.assertEqual(master.next_mfn, 301)
+
+                self.assertEqual(self.read(path), expected)
+
+    def test_convert_switches_layout(self):
+
+        original = self.write(u'original', sample_records())
+        aligned = os.path.join(self.tmp_dir, u'aligned')
+        packed = os.path.join(self.tmp_dir, u'packed')
+
+        self.assertEqual(convert_master(original, aligned), (u'aligned', '<'))
+        self.assertEqual(convert_master(aligned, packed), (u'packed', '<'))
+
+        self.assertEqual(self.read(aligned), self.read(original))
+        self.assertEqual(self.content(packed), self.content(original))
+
+    def test_convert_byte_order(self):
+
+        original = self.write(u'original', sample_records(), layout=u'aligned')
+        big = os.path.join(self.tmp_dir, u'big')
+        little = os.path.join(self.tmp_dir, u'little')
+
+        self.assertEqual(
+            convert_master(original, big, u'aligned', '>'), (u'aligned', '>'))
+        self.assertEqual(
+            convert_master(big, little, u'aligned', '<'), (u'aligned', '<'))
+
+        with MasterFile(big) as master:
+            self.assertEqual(master.byteorder, '>')
+
+        self.assertEqual(self.read(big), self.read(original))
+        self.assertEqual(self.content(little), self.content(original))
+
+    def test_deleted_records(self):
+
+        path = self.write(u'deleted', [
+            Record(1, [(10, b'first')]),
+            Record(3, [(10, b'logically deleted')], deleted=True),
+            Record(4, [(10, b'last')]),
+        ], next_mfn=6)
+
+        with MasterFile(path) as master:
+            self.assertEqual(master.next_mfn, 6)
+            # mfn 2 e 5 nunca foram gravados
+            self.assertIsNone(master.record(2))
+            self.assertIsNone(master.record(5))
+            self.assertTrue(master.record(3).deleted)
+            self.assertEqual(master.record(3).first(10), b'logically deleted')
+
+        self.assertEqual(
+            [mfn for mfn, fields, deleted in self.read(path)], [1, 4])
+        self.assertEqual(
+            [(mfn, deleted) for mfn, fields, deleted in self.read(path, True)],
+            [(1, False), (3, True), (4, False)])
+
+    def test_convert_keeps_deleted_records(self):
+
+        original = self.write(u'original', [
+            Record(1, [(10, b'first')]),
+            Record(2, [(10, b'deleted')], deleted=True),
+        ], next_mfn=4)
+        converted = os.path.join(self.tmp_dir, u'converted')
+
+        convert_master(original, converted)
+
+        self.assertEqual(self.read(converted, True), self.read(original, True))
+
+        with MasterFile(converted) as master:
+            self.assertEqual(master.next_mfn, 4)
+
+    def test_invalid_master_file(self):
+
+        path = os.path.join(self.tmp_dir, u'invalid')
+
+        with io.open(path + u'.mst', 'wb') as mst:
+            mst.write(b'not a master file')
+
+        with io.open(path + u'.xrf', 'wb') as xrf:
+            xrf.write(b'')
+
+        with self.assertRaises(MasterFileError):
+            MasterFile(path)
+
+
+class SubfieldTests(unittest.TestCase):
+
+    def test_subfield(self):
+
+        self.assertEqual(subfield(b'^lpt^cRSP1^tArtigos', b'c'), b'RSP1')
+        self.assertEqual(subfield(b'^lpt^cRSP1^tArtigos', b'T'), b'Artigos')
+
+    def test_missing_subfield(self):
+
+        self.assertEqual(subfield(b'^lpt^cRSP1', b't'), b'')
+        self.assertEqual(subfield(b'no subfields', b'a'), b'')
+        self.assertEqual(subfield(b'', b'a'), b'')
+
+    def test_first_subfield(self):
+
+        # ^* e o conteudo antes do primeiro delimitador ou o primeiro subcampo
+        self.assertEqual(subfield(b'Artigos^len', b'*'), b'Artigos')
+        self.assertEqual(subfield(b'^lpt^cRSP1', b'*'), b'pt')
+        self.assertEqual(subfield(b'no subfields', b'*'), b'no subfields')
+        self.assertEqual(subfield(b'', b'*'), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
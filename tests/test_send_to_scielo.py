@@ -0,0 +1,68 @@
+# coding: utf-8
+import unittest
+
+from paperboy.isis import Record
+from paperboy.send_to_scielo import section_catalog
+
+
+class SectionCatalogTests(unittest.TestCase):
+
+    def lines(self, *records):
+
+        return list(section_catalog(records))
+
+    def test_lines(self):
+
+        self.assertEqual(self.lines(Record(1, [
+            (35, b'0034-8910'),
+            (65, b'20160300'),
+            (36, b'2016003'),
+            (49, b'^lpt^cRSP010^tArtigos Originais'),
+            (49, b'^len^cRSP010^tOriginal Articles'),
+        ])), [
+            b'0034-891020160003|pt|RSP010|Artigos Originais\n',
+            b'0034-891020160003|en|RSP010|Original Articles\n',
+        ])
+
+    def test_issue_order(self):
+
+        # val(v36*4.3) + 10000, sem o primeiro digito
+        self.assertEqual(self.lines(Record(1, [
+            (35, b'1234-5678'),
+            (65, b'19990000'),
+            (36, b'1999123'),
+            (49, b'^les^cSEC^tSecciones'),
+        ])), [b'1234-567819990123|es|SEC|Secciones\n'])
+
+    def test_absent_issue_order(self):
+
+        self.assertEqual(self.lines(Record(1, [
+            (35, b'0034-8910'),
+            (65, b'20160300'),
+            (49, b'^lpt^cRSP1^tArtigos'),
+        ])), [b'0034-891020160000|pt|RSP1|Artigos\n'])
+
+    def test_missing_subfields(self):
+
+        self.assertEqual(self.lines(Record(1, [
+            (35, b'0034-8910'),
+            (65, b'20160300'),
+            (36, b'2016001'),
+            (49, b'^cRSP1'),
+        ])), [b'0034-891020160001||RSP1|\n'])
+
+    def test_records_without_sections(self):
+
+        self.assertEqual(self.lines(
+            Record(1, [(35, b'0034-8910'), (65, b'20160300')]),
+            Record(2, [
+                (35, b'0034-8910'),
+                (65, b'20160300'),
+                (36, b'2016002'),
+                (49, b'^lpt^cRSP2^tArtigos'),
+            ]),
+        ), [b'0034-891020160002|pt|RSP2|Artigos\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()